@@ -2,14 +2,64 @@
 
 # Mcmahon pairing for MGA tournament
 
+import array
+import bisect
+import collections.abc
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import hashlib
+import html
+import io
+import itertools
+import json
 import random
+import time
+import unicodedata
 import unittest
 
 import yaml
 
+try:
+    import numpy
+except ImportError:  # batch scoring falls back to plain python
+    numpy = None
+
+import mm_matching
+
+# marks an aga_id where Tournament.resolve_player expects a player, e.g. aga:12345
+AGA_PREFIX = 'aga:'
+
+# pairing modes accepted by Tournament.generate_pairing
+PAIRING_MODES = ('random', 'matching', 'anytime')
+
+# pairs re-paired at random to leave a local optimum in anytime mode
+ANYTIME_KICK = 3
+
+# boards on either side in score of each unseated player that repair_round
+# may re-pair at first; it widens the neighbourhood when they are not enough
+REPAIR_RADIUS = 2
+
+# tiebreaks Tournament.tiebreaks computes: score, sum of opponents' scores,
+# sum of defeated opponents' scores and sum of opponents' sos
+TIEBREAKS = ('score', 'sos', 'sodos', 'sosos')
+
+# default standings order, the order of mm_score
+STANDINGS_ORDER = ('score', 'sos', 'sodos')
+
+# output formats of Tournament.write_wall
+WALL_FORMATS = ('text', 'csv', 'html', 'json')
+
+# shuffles drawn from each seeded RNG stream in random mode; chunks are the
+# unit of work handed to pool workers
+SAMPLE_CHUNK = 1000
+
 
 class Player(object):
 
+    __slots__ = ('name', 'rank', 'aga_id', 'mm_score', 'mm_init', 'division')
+
     def __init__(self, name, rank, aga_id, mm_score, mm_init, division):
         self.name = name
         self.rank = rank
@@ -23,20 +73,31 @@ class Player(object):
                 .format(self.__class__.__name__, self.name, self.rank, self.aga_id,
                         self.mm_score, self.mm_init, self.division))
 
+    def _values(self):
+        return [getattr(self, name) for name in self.__slots__]
+
     def __eq__(self, other):
-        return type(other) is type(self) and self.__dict__ == other.__dict__
+        return type(other) is type(self) and self._values() == other._values()
 
     def __ne__(self, other):
-        return type(other) is not type(self) or self.__dict__ != other.__dict__
+        return type(other) is not type(self) or self._values() != other._values()
 
 
 def player_representer(dumper, data):
-    return dumper.represent_mapping('!player', data.__dict__)
+    return dumper.represent_mapping('!player', dict(zip(data.__slots__, data._values())))
 
 yaml.add_representer(Player, player_representer)
 
 
 def player_constructor(loader, node):
+    if isinstance(node, yaml.SequenceNode):
+        # [name, rank, aga_id, mm_score, mm_init, division], as TournamentDumper
+        # writes it
+        name, rank, aga_id, mm_score, mm_init, division = node.value
+        return Player(loader.construct_object(name), _construct_int(loader, rank),
+                      _construct_int(loader, aga_id),
+                      [_construct_int(loader, score) for score in mm_score.value],
+                      _construct_int(loader, mm_init), _construct_int(loader, division))
     player_dict = loader.construct_mapping(node)
     return Player(player_dict['name'], player_dict['rank'], player_dict['aga_id'],
                   player_dict['mm_score'], player_dict['mm_init'], player_dict['division'])
@@ -46,6 +107,8 @@ yaml.add_constructor('!player', player_constructor)
 
 class Match(object):
 
+    __slots__ = ('white', 'black', '_winner')
+
     def __init__(self, white, black, winner=None):
         self.white = white
         self.black = black
@@ -61,6 +124,14 @@ class Match(object):
 
     winner = property(get_winner, set_winner)
 
+    def __eq__(self, other):
+        # a board of a Round equals the Match it was made from
+        return (isinstance(other, Match) and
+                (self.white, self.black, self.winner) == (other.white, other.black, other.winner))
+
+    def __ne__(self, other):
+        return not self == other
+
     def __repr__(self):
         safe_winner = self.winner
         if safe_winner is None:
@@ -71,14 +142,488 @@ class Match(object):
                 .format(self.__class__.__name__, self.white, self.black, safe_winner))
 
 
+def match_representer(dumper, data):
+    # the python/object form earlier versions wrote for the __dict__ of a Match
+    return dumper.represent_mapping('tag:yaml.org,2002:python/object:mcmahon.Match',
+                                    {'white': data.white, 'black': data.black,
+                                     '_winner': data.winner})
+
+yaml.add_multi_representer(Match, match_representer)
+
+
+class BoardMatch(Match):
+    # a board of a Round, reading and writing the round's columns
+
+    __slots__ = ('_round', '_board')
+
+    def __init__(self, round_, board):
+        self._round = round_
+        self._board = board
+
+    white = property(lambda self: self._round.white[self._round.index(self._board)])
+    black = property(lambda self: self._round.black[self._round.index(self._board)])
+
+    def get_winner(self):
+        winner = self._round.winner[self._round.index(self._board)]
+        return None if winner == Round.NO_WINNER else winner
+
+    def set_winner(self, value):
+        if value not in [self.white, self.black, None]:
+            raise ValueError("'winner' must be equal to either 'white' or 'black' (or 'None')")
+        self._round.winner[self._round.index(self._board)] = (Round.NO_WINNER if value is None
+                                                               else value)
+
+    winner = property(get_winner, set_winner)
+
+
+class Round(collections.abc.MutableMapping):
+    # the boards of one round as a mapping of board number to Match, stored as
+    # columns of board numbers, white, black and winner (NO_WINNER until the
+    # result is in). Reading a board gives a BoardMatch view of the columns;
+    # scoring and rendering loops read the columns directly.
+
+    __slots__ = ('boards', 'white', 'black', 'winner', '_numbered')
+
+    NO_WINNER = -1
+
+    def __init__(self, matches=None):
+        self._numbered = True  # boards are exactly 1..len
+        self.boards = array.array('q')
+        self.white = array.array('q')
+        self.black = array.array('q')
+        self.winner = array.array('q')
+        if matches is not None:
+            for board, match in matches.items():
+                self[board] = match
+
+    def index(self, board):
+        # column of board; boards are numbered from 1 in order unless a repair
+        # left gaps, then they are searched
+        i = board - 1
+        if self._numbered:
+            if 0 <= i < len(self.boards):
+                return i
+            raise KeyError(board)
+        if 0 <= i < len(self.boards) and self.boards[i] == board:
+            return i
+        try:
+            return self.boards.index(board)
+        except ValueError:
+            raise KeyError(board)
+
+    def add(self, board, white, black, winner=None):
+        # append a new board
+        if board != len(self.boards) + 1:
+            self._numbered = False
+        self.boards.append(board)
+        self.white.append(white)
+        self.black.append(black)
+        self.winner.append(self.NO_WINNER if winner is None else winner)
+
+    def extend(self, boards, white, black, winner):
+        # append whole columns, winner is NO_WINNER where there is none yet
+        if not len(boards) == len(white) == len(black) == len(winner):
+            raise ValueError('columns of a round must have the same length')
+        first = len(self.boards) + 1
+        self.boards.extend(boards)
+        self.white.extend(white)
+        self.black.extend(black)
+        self.winner.extend(winner)
+        if self.boards[first - 1:] != array.array('q', range(first, len(self.boards) + 1)):
+            self._numbered = False
+
+    def finished(self):
+        return self.NO_WINNER not in self.winner
+
+    def pending(self):
+        return self.winner.count(self.NO_WINNER)
+
+    def __getitem__(self, board):
+        self.index(board)
+        return BoardMatch(self, board)
+
+    def __setitem__(self, board, match):
+        winner = self.NO_WINNER if match.winner is None else match.winner
+        try:
+            i = self.index(board)
+        except KeyError:
+            self.add(board, match.white, match.black, match.winner)
+            return
+        self.white[i] = match.white
+        self.black[i] = match.black
+        self.winner[i] = winner
+
+    def __delitem__(self, board):
+        i = self.index(board)
+        if i != len(self.boards) - 1:
+            self._numbered = False
+        for column in (self.boards, self.white, self.black, self.winner):
+            del column[i]
+
+    def pop(self, board, *default):
+        # a detached Match, since views of the removed board are left empty
+        try:
+            view = self[board]
+            match = Match(view.white, view.black, view.winner)
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[board]
+        return match
+
+    def __iter__(self):
+        return iter(self.boards)
+
+    def __len__(self):
+        return len(self.boards)
+
+    def __contains__(self, board):
+        try:
+            self.index(board)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def values(self):
+        return [BoardMatch(self, board) for board in self.boards]
+
+    def items(self):
+        return [(board, BoardMatch(self, board)) for board in self.boards]
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, dict(self.items()))
+
+
+def _int_nodes(values):
+    # scalar nodes for a column of ints, None is null; cheaper than
+    # represent_data for each value
+    return [yaml.ScalarNode('tag:yaml.org,2002:null', 'null') if value is None else
+            yaml.ScalarNode('tag:yaml.org,2002:int', str(value)) for value in values]
+
+
+def _plain_int(value):
+    # the int of a plain decimal scalar, None for anything else (YAML reads
+    # 010 as octal)
+    digits = value[1:] if value[:1] == '-' else value
+    if value.isascii() and digits.isdigit() and (digits[0] != '0' or digits == '0'):
+        return int(value)
+    return None
+
+
+def _construct_int(loader, node):
+    # an int scalar without going through construct_object
+    if node.tag == 'tag:yaml.org,2002:int':
+        value = _plain_int(node.value)
+        if value is not None:
+            return value
+    return loader.construct_object(node)
+
+
+def round_representer(dumper, data):
+    # each column is one scalar of space separated numbers, ~ where there is
+    # no winner yet
+    columns = [('boards', data.boards), ('white', data.white), ('black', data.black),
+               ('winner', ['~' if winner == Round.NO_WINNER else winner
+                           for winner in data.winner])]
+    return yaml.MappingNode('!round', [
+        (dumper.represent_data(name),
+         yaml.ScalarNode('tag:yaml.org,2002:str', ' '.join(map(str, values))))
+        for name, values in columns], flow_style=False)
+
+yaml.add_representer(Round, round_representer)
+
+
+def round_constructor(loader, node):
+    columns = {}
+    for key, value in node.value:
+        if isinstance(value, yaml.ScalarNode):
+            columns[loader.construct_object(key)] = [
+                Round.NO_WINNER if number == '~' else int(number)
+                for number in value.value.split()]
+        else:
+            # a flow sequence per column, with null winners, as first written
+            columns[loader.construct_object(key)] = [
+                Round.NO_WINNER if number is None else number
+                for number in loader.construct_sequence(value)]
+    round_ = Round()
+    round_.extend(columns['boards'], columns['white'], columns['black'], columns['winner'])
+    return round_
+
+yaml.add_constructor('!round', round_constructor)
+
+
+class Instrument(object):
+    # collects phase timings and pairing statistics from Tournament while it is
+    # set as Tournament.instrument; with the default of None nothing is
+    # recorded
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}  # name -> [calls, seconds]
+        self.counters = {}
+        self.best = []  # (seconds, division, score) whenever a division's best improves
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, [0, 0.0])
+            phase[0] += 1
+            phase[1] += time.perf_counter() - start
+
+    def timed(self, name, function):
+        # function wrapped to run as phase name
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def improved(self, division, score):
+        self.best.append((time.perf_counter() - self.start, division, score))
+
+    def report(self):
+        # everything recorded, as plain data for JSON
+        candidates = self.counters.get('candidates', 0)
+        return {'seconds': time.perf_counter() - self.start,
+                'phases': {name: {'calls': calls, 'seconds': seconds}
+                           for name, (calls, seconds) in self.phases.items()},
+                'counters': dict(self.counters),
+                'valid_fraction': (self.counters.get('valid', 0) / candidates
+                                   if candidates else None),
+                'best_over_time': [{'seconds': seconds, 'division': division, 'score': score}
+                                   for seconds, division, score in self.best]}
+
+    def summary(self):
+        report = self.report()
+        res = []
+        res.append('{:40} | {:>6} | {:>9}'.format('Phase', 'Calls', 'Seconds'))
+        res.append('-' * 62)
+        for name, phase in sorted(report['phases'].items(), key=lambda item: item[1]['seconds'],
+                                  reverse=True):
+            res.append('{:40} | {:6} | {:9.4f}'.format(name, phase['calls'], phase['seconds']))
+        res.append('{:40} | {:6} | {:9.4f}'.format('total', '', report['seconds']))
+        for name, value in sorted(report['counters'].items()):
+            res.append('{}: {}'.format(name, value))
+        if report['valid_fraction'] is not None:
+            res.append('valid fraction: {:.4f}'.format(report['valid_fraction']))
+        for best in report['best_over_time']:
+            res.append('{:9.4f}s division {} best score {}'.format(
+                best['seconds'], best['division'], best['score']))
+        return '\n'.join(res)
+
+
+class OpponentIndex(object):
+    # pairs of players that may not meet: everyone who has already played
+    # plus extra forbidden pairs (same club, same family). Each player id has
+    # a bitset row over player ids, so a lookup is two indexing operations and
+    # allocates nothing, and a list of the players they are blocked against.
+
+    def __init__(self, size=0):
+        self.rows = []  # player_id -> bytearray bitset of blocked player ids
+        self.neighbors = []  # player_id -> list of blocked player ids
+        self.width = 0  # bytes per row
+        self.grow(size)
+
+    def grow(self, size):
+        # make room for player ids below size
+        width = (size + 7) // 8
+        if width > self.width:
+            width = max(width, 2 * self.width)
+            for row in self.rows:
+                row.extend(bytes(width - self.width))
+            self.width = width
+        while len(self.rows) < size:
+            self.rows.append(bytearray(self.width))
+            self.neighbors.append([])
+
+    def add(self, first, second):
+        self.grow(max(first, second) + 1)
+        if not self.blocked(first, second):
+            self.rows[first][second >> 3] |= 1 << (second & 7)
+            self.rows[second][first >> 3] |= 1 << (first & 7)
+            self.neighbors[first].append(second)
+            self.neighbors[second].append(first)
+
+    def discard(self, first, second):
+        if self.blocked(first, second):
+            self.rows[first][second >> 3] &= ~(1 << (second & 7)) & 0xff
+            self.rows[second][first >> 3] &= ~(1 << (first & 7)) & 0xff
+            self.neighbors[first].remove(second)
+            self.neighbors[second].remove(first)
+
+    def blocked(self, first, second):
+        # truthy when first and second may not be paired
+        return self.rows[first][second >> 3] >> (second & 7) & 1
+
+
+def normalize_name(name):
+    # name as matched by PlayerIndex: case folded, accents dropped, single spaces
+    decomposed = unicodedata.normalize('NFKD', name)
+    return ' '.join(''.join(c for c in decomposed if not unicodedata.combining(c))
+                    .casefold().split())
+
+
+class PlayerIndex(object):
+    # players by aga_id and by name for check-in. Every word of a normalized
+    # name is a key as well as the whole name, so 'smi', 'john s' and 'john'
+    # all find John Smith; a prefix search is a bisection of the sorted keys.
+
+    def __init__(self, players=()):
+        self.aga_ids = {}  # aga_id -> list of player ids
+        self.keys = []  # sorted (name key, player_id)
+        self.full_names = {}  # normalized name -> list of player ids
+        self.ids = set()
+        for player_id, player in players:
+            self.add(player_id, player)
+
+    def add(self, player_id, player):
+        self.ids.add(player_id)
+        self.aga_ids.setdefault(player.aga_id, []).append(player_id)
+        name = normalize_name(player.name)
+        self.full_names.setdefault(name, []).append(player_id)
+        words = name.split()
+        for key in set([name] + [' '.join(words[i:]) for i in range(1, len(words))]):
+            bisect.insort(self.keys, (key, player_id))
+
+    def by_aga_id(self, aga_id):
+        return list(self.aga_ids.get(aga_id, []))
+
+    def by_name(self, prefix):
+        # sorted ids of the players with a name, or a word in it onwards,
+        # starting with prefix
+        prefix = normalize_name(prefix)
+        start = bisect.bisect_left(self.keys, (prefix,))
+        end = bisect.bisect_left(self.keys, (prefix + '\U0010ffff',), start)
+        return sorted(set(player_id for key, player_id in self.keys[start:end]
+                          if key.startswith(prefix)))
+
+    def find(self, query):
+        # sorted ids of the players with aga_id query when it is a number,
+        # else by_name
+        query = query.strip()
+        if query.isdigit():
+            return sorted(self.by_aga_id(int(query)))
+        return self.by_name(query)
+
+    def resolve(self, key):
+        # player id from an id (an int or digits), AGA_PREFIX followed by an
+        # aga_id, or a name prefix that picks one player; an exact name wins
+        # over longer ones. Raises KeyError for no player, ValueError for
+        # several
+        if isinstance(key, int) or key.strip().isdigit():
+            player_id = int(key)
+            if player_id not in self.ids:
+                raise KeyError('No player {}'.format(player_id))
+            return player_id
+        key = key.strip()
+        if key.startswith(AGA_PREFIX):
+            found = self.by_aga_id(int(key[len(AGA_PREFIX):]))
+        else:
+            found = self.by_name(key)
+            if len(found) > 1:
+                found = self.full_names.get(normalize_name(key), found)
+        if not found:
+            raise KeyError('No player matches {!r}'.format(key))
+        if len(found) > 1:
+            raise ValueError('{!r} matches players {}'.format(
+                key, ', '.join(str(player_id) for player_id in sorted(found))))
+        return found[0]
+
+
+def instrumented(method):
+    # runs a Tournament method as a phase of Tournament.instrument, when set
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.instrument is None:
+            return method(self, *args, **kwargs)
+        with self.instrument.phase(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class BatchEvaluator(object):
+    # scores a batch of candidate pairings for one division at once. The batch
+    # is a 2-D array, each row a permutation of indexes into player_ids, and
+    # consecutive columns are paired. Requires numpy.
+
+    def __init__(self, tournament, player_ids):
+        self.player_ids = list(player_ids)
+        index = {player_id: i for i, player_id in enumerate(self.player_ids)}
+        players = [tournament.players[player_id] for player_id in self.player_ids]
+        self.scores = numpy.array([player.mm_score[0] for player in players], dtype=numpy.int64)
+        self.ranks = numpy.array([player.rank for player in players], dtype=numpy.int64)
+        # forbidden[i, j] is True when players i and j may not be paired
+        self.forbidden = numpy.zeros((len(players), len(players)), dtype=bool)
+        opponents = tournament._opponent_index()
+        for i, player_id in enumerate(self.player_ids):
+            for opponent in opponents.neighbors[player_id]:
+                j = index.get(opponent)
+                if j is not None:
+                    self.forbidden[i, j] = True
+        self.cost = tournament._cost
+
+    def sample(self, rng, sample_size):
+        # sample_size random permutations drawn from a numpy Generator
+        base = numpy.tile(numpy.arange(len(self.player_ids)), (sample_size, 1))
+        return rng.permuted(base, axis=1)
+
+    def evaluate(self, candidates):
+        # returns (scores, valid) arrays with one entry per candidate
+        first = candidates[:, 0::2]
+        second = candidates[:, 1::2]
+        scores = self.cost(self.scores[first] - self.scores[second],
+                           self.ranks[first] - self.ranks[second]).sum(axis=1)
+        valid = ~self.forbidden[first, second].any(axis=1)
+        return scores, valid
+
+    def best(self, candidates):
+        # (score, pairing, valid count) with the lowest scoring valid candidate,
+        # earliest wins ties, or (None, None, 0) when no candidate is valid
+        scores, valid = self.evaluate(candidates)
+        valid_count = int(valid.sum())
+        if not valid_count:
+            return None, None, 0
+        best = numpy.flatnonzero(valid)[numpy.argmin(scores[valid])]
+        return int(scores[best]), [self.player_ids[i] for i in candidates[best]], valid_count
+
+
 class Tournament(object):
 
-    def __init__(self, players, id_ctr, rounds, old_pairs, current_players):
+    # Instrument recording timings and pairing statistics, off when None
+    instrument = None
+
+    # attributes that make up the tournament; everything else is derived state
+    _fields = ('players', 'id_ctr', 'rounds', 'old_pairs', 'current_players',
+               'forbidden_pairs')
+
+    def __init__(self, players, id_ctr, rounds, old_pairs, current_players,
+                 forbidden_pairs=None):
         self.players = players
         self.id_ctr = id_ctr
-        self.rounds = rounds
+        # mappings of board to Match are accepted and stored as Round
+        self.rounds = [round_ if isinstance(round_, Round) else Round(round_)
+                       for round_ in rounds]
         self.old_pairs = old_pairs
         self.current_players = current_players
+        # pairs kept apart on top of repeat games, see forbid_pair
+        self.forbidden_pairs = set() if forbidden_pairs is None else forbidden_pairs
+        # game index for incremental scoring, built on first use
+        self._games = None  # player_id -> list of (round index, board)
+        self._pending = None  # boards without a result, per round
+        # OpponentIndex of pairs that may not be paired, built on first use
+        self._opponents = None
+        # PlayerIndex for find_players and resolve_player, built on first use
+        self._lookup = None
+
+    def _state(self):
+        return {field: getattr(self, field) for field in self._fields}
 
     @classmethod
     def new_tournament(cls, players=None):
@@ -88,80 +633,452 @@ class Tournament(object):
                 tournament.add_player(player)
         return tournament
 
+    @instrumented
     def calculate_mm_score(self):
-        # set all mm_scores to original mm_score
-        for player in self.players.values():
-            player.mm_score[0] = player.mm_init  # score
-            player.mm_score[1] = 0  # sos
-            player.mm_score[2] = 0  # sodos
-
-        # iterate through each board in each round, add to mm_score when winner
-        for i, round_ in enumerate(self.rounds):
-            if self.round_is_finished(i):
-                for board in round_.values():
-                    self.players[board.winner].mm_score[0] += 1  # score
-
-        # now that all sos scores are calculated, can do sos and sodos
-        # by iterating through all the boards
-        for i, round_ in enumerate(self.rounds):
-            if self.round_is_finished(i):
-                for board in round_.values():
-                    if board.winner == board.white:
-                        loser = board.black
-                    else:
-                        loser = board.white
-                    # sos
-                    self.players[board.winner].mm_score[1] += self.players[loser].mm_score[0]
-                    self.players[loser].mm_score[1] += self.players[board.winner].mm_score[0]
-                    # sodos
-                    self.players[board.winner].mm_score[2] += self.players[loser].mm_score[0]
-
-    def standings(self):
-        return sorted(list(self.players.keys()), key=lambda k: self.players[k].mm_score,
-                      reverse=True)
+        # full recompute of every mm_score from the rounds; scores are otherwise
+        # maintained incrementally by add_result, so this is the verification
+        # and repair path
+        self._games = None
+        values = self.tiebreaks(STANDINGS_ORDER)
+        for player_id, player in self.players.items():
+            player.mm_score[:] = [values[name][player_id] for name in STANDINGS_ORDER]
+
+    def verify_mm_score(self):
+        # recompute all scores and return the ids of players whose maintained
+        # mm_score was wrong (they hold the recomputed value afterwards)
+        maintained = {player_id: list(player.mm_score)
+                      for player_id, player in self.players.items()}
+        self.calculate_mm_score()
+        return sorted(player_id for player_id, player in self.players.items()
+                      if player.mm_score != maintained[player_id])
+
+    def _game_index(self):
+        if self._games is None:
+            self._games = {player_id: [] for player_id in self.players}
+            self._pending = []
+            for i in range(len(self.rounds)):
+                self._index_round(i)
+        return self._games
+
+    def _index_round(self, round_):
+        columns = self.rounds[round_]
+        for board, white, black in zip(columns.boards, columns.white, columns.black):
+            self._games[white].append((round_, board))
+            self._games[black].append((round_, board))
+        self._pending.append(columns.pending())
+
+    def _count_round(self, round_, sign):
+        # add (or remove) a finished round's wins, returns the players seated
+        columns = self.rounds[round_]
+        for winner in columns.winner:
+            self.players[winner].mm_score[0] += sign
+        return set(columns.white) | set(columns.black)
+
+    def _update_tiebreaks(self, dirty):
+        # sos and sodos change for players whose score changed and for everyone
+        # who played them in a finished round
+        games = self._game_index()
+        affected = set(dirty)
+        for player_id in dirty:
+            for round_, board in games[player_id]:
+                if not self._pending[round_]:
+                    columns = self.rounds[round_]
+                    i = columns.index(board)
+                    affected.add(columns.white[i] + columns.black[i] - player_id)
+        for player_id in affected:
+            sos = 0
+            sodos = 0
+            for round_, board in games[player_id]:
+                if self._pending[round_]:
+                    continue
+                columns = self.rounds[round_]
+                i = columns.index(board)
+                opponent_score = self.players[columns.white[i] + columns.black[i] -
+                                              player_id].mm_score[0]
+                sos += opponent_score
+                if columns.winner[i] == player_id:
+                    sodos += opponent_score
+            self.players[player_id].mm_score[1] = sos
+            self.players[player_id].mm_score[2] = sodos
+
+    def _results(self):
+        # player ids, and the positions in them of the winner and loser of
+        # every game of the finished rounds; one game is one entry of the
+        # sparse win matrix, the opponent matrix is its symmetric sum
+        ids = list(self.players)
+        winners = array.array('q')
+        losers = array.array('q')
+        for round_ in self.rounds:
+            if round_.finished():
+                winners.extend(round_.winner)
+                losers.extend([white + black - winner for white, black, winner
+                               in zip(round_.white, round_.black, round_.winner)])
+        if ids != list(range(len(ids))):
+            position = {player_id: i for i, player_id in enumerate(ids)}
+            winners = [position[player_id] for player_id in winners]
+            losers = [position[player_id] for player_id in losers]
+        return ids, winners, losers
+
+    def tiebreaks(self, names=TIEBREAKS):
+        # {name: {player_id: value}} for the names in TIEBREAKS, recomputed from
+        # the rounds. Each tiebreak is a product of the win or opponent matrix
+        # with the score (or sos) vector, done as bincounts with numpy
+        for name in names:
+            if name not in TIEBREAKS:
+                raise ValueError("tiebreaks must be among {}, not {!r}".format(
+                    ', '.join(TIEBREAKS), name))
+        ids, winners, losers = self._results()
+        size = len(ids)
+        init = [self.players[player_id].mm_init for player_id in ids]
+        if numpy is not None:
+            winners = numpy.asarray(winners, dtype=numpy.intp)
+            losers = numpy.asarray(losers, dtype=numpy.intp)
+
+            def wins(vector):
+                return numpy.bincount(winners, vector[losers], size).astype(numpy.int64)
+
+            def opponents(vector):
+                return wins(vector) + numpy.bincount(losers, vector[winners],
+                                                     size).astype(numpy.int64)
+
+            score = numpy.array(init, dtype=numpy.int64) + numpy.bincount(winners,
+                                                                          minlength=size)
+        else:
+            def wins(vector):
+                res = [0] * size
+                for winner, loser in zip(winners, losers):
+                    res[winner] += vector[loser]
+                return res
+
+            def opponents(vector):
+                res = wins(vector)
+                for winner, loser in zip(winners, losers):
+                    res[loser] += vector[winner]
+                return res
+
+            score = list(init)
+            for winner in winners:
+                score[winner] += 1
+        values = {'score': score}
+        if 'sos' in names or 'sosos' in names:
+            values['sos'] = opponents(score)
+        if 'sodos' in names:
+            values['sodos'] = wins(score)
+        if 'sosos' in names:
+            values['sosos'] = opponents(values['sos'])
+        return {name: dict(zip(ids, (int(value) for value in values[name]))) for name in names}
+
+    def standings(self, order=None):
+        # player ids, best first. order is a list of names from TIEBREAKS,
+        # compared in turn; the default compares mm_score as maintained
+        if order is None:
+            return sorted(list(self.players.keys()), key=lambda k: self.players[k].mm_score,
+                          reverse=True)
+        values = self.tiebreaks(order)
+        return sorted(list(self.players.keys()),
+                      key=lambda k: [values[name][k] for name in order], reverse=True)
 
     def __eq__(self, other):
-        return type(other) is type(self) and self.__dict__ == other.__dict__
+        return type(other) is type(self) and self._state() == other._state()
 
     def __ne__(self, other):
-        return type(other) is not type(self) or self.__dict__ != other.__dict__
+        return type(other) is not type(self) or self._state() != other._state()
 
     def add_player(self, player):
+        # a new player has played no games yet, scores start from mm_init;
+        # a fresh list, the caller may share the one it passed
         player_key = self.id_ctr
+        player.mm_score = [player.mm_init, 0, 0]
         self.players[player_key] = player
         self.current_players.add(player_key)
         self.id_ctr += 1
+        if self._games is not None:
+            self._games[player_key] = []
+        if self._opponents is not None:
+            self._opponents.grow(self.id_ctr)
+        if self._lookup is not None:
+            self._lookup.add(player_key, player)
 
     def drop_player(self, player_id):
         self.current_players.remove(player_id)
 
+    def player_index(self):
+        # kept up to date by add_player
+        if self._lookup is None:
+            self._lookup = PlayerIndex(self.players.items())
+        return self._lookup
+
+    def find_players(self, query):
+        # see PlayerIndex.find
+        return self.player_index().find(query)
+
+    def resolve_player(self, key):
+        # see PlayerIndex.resolve
+        return self.player_index().resolve(key)
+
+    def _opponent_index(self):
+        # every pairing of every round, old_pairs and forbidden_pairs; kept up
+        # to date by start_new_round, add_player and forbid_pair
+        if self._opponents is None:
+            self._opponents = OpponentIndex(self.id_ctr)
+            for round_ in self.rounds:
+                for match in round_.values():
+                    self._opponents.add(match.white, match.black)
+            for pair in itertools.chain(self.old_pairs, self.forbidden_pairs):
+                self._opponents.add(*pair)
+        return self._opponents
+
+    def pairing_key(self, mode, seed=None):
+        # stable hash of everything a pairing depends on: the players to pair
+        # with their scores, ranks and divisions, the pairs that may not meet,
+        # the tournament kind, the mode and the seed
+        opponents = self._opponent_index()
+        state = {'kind': type(self).__name__, 'mode': mode, 'seed': seed,
+                 'players': [[player_id, self.players[player_id].mm_score[0],
+                              self.players[player_id].rank, self.players[player_id].division]
+                             for player_id in sorted(self.current_players)],
+                 'blocked': [[player_id, sorted(opponents.neighbors[player_id])]
+                             for player_id in sorted(self.current_players)]}
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+    def forbid_pair(self, first, second):
+        # never pair these two players, e.g. members of the same family
+        if first == second or first not in self.players or second not in self.players:
+            raise KeyError('No pair of players {} and {}'.format(first, second))
+        self.forbidden_pairs.add(frozenset([first, second]))
+        if self._opponents is not None:
+            self._opponents.add(first, second)
+
+    def allow_pair(self, first, second):
+        # undo forbid_pair; pairs that already played stay apart
+        self.forbidden_pairs.remove(frozenset([first, second]))
+        self._opponents = None
+
     def _pairing_is_valid(self, player_list):
-        valid = True
-        pairs = []
-        temp_list = list(player_list)
-        while temp_list:
-            pairs.append(frozenset([temp_list.pop(), temp_list.pop()]))
-        for pair in pairs:
-            if pair in self.old_pairs:
-                valid = False
-                break
-        return valid
+        rows = self._opponent_index().rows
+        for i in range(0, len(player_list), 2):
+            first = player_list[i]
+            second = player_list[i + 1]
+            if rows[first][second >> 3] >> (second & 7) & 1:
+                return False
+        return True
+
+    def _cost(self, score_diff, rank_diff):
+        # pairing cost from mm_score and rank differences, works on numpy arrays
+        return abs(score_diff)
+
+    def pair_cost(self, player1, player2):
+        # cost of pairing two players, difference of mm_score
+        player1 = self.players[player1]
+        player2 = self.players[player2]
+        return self._cost(player1.mm_score[0] - player2.mm_score[0], player1.rank - player2.rank)
 
     def pairing_score(self, player_list):
-        # measures sum of difference of mm_score per pairing
+        # measures sum of pair_cost per pairing
         # assumes even number of people?
         score = 0
         temp_list = list(player_list)
         while temp_list:
-            score += abs(self.players[temp_list.pop()].mm_score[0] -
-                         self.players[temp_list.pop()].mm_score[0])
+            score += self.pair_cost(temp_list.pop(), temp_list.pop())
         return score
 
-    def generate_pairing(self, sample_size):
+    def _sample_chunk(self, div, sample_size, chunk_seed, evaluator=None):
+        # best valid pairing out of sample_size shuffles drawn from one seeded
+        # stream, returns (score, pairing, valid count) or (None, None, 0)
+        rng = random.Random(chunk_seed)
+        if numpy is not None:
+            if evaluator is None:
+                evaluator = BatchEvaluator(self, sorted(div))
+            candidates = evaluator.sample(numpy.random.default_rng(rng.getrandbits(64)),
+                                          sample_size)
+            return evaluator.best(candidates)
+
+        candidate = sorted(div)
+        best_score = None
+        best_pairing = None
+        valid_count = 0
+        for i in range(sample_size):
+            rng.shuffle(candidate)
+            if not self._pairing_is_valid(candidate):
+                continue
+            valid_count += 1
+            pairing_score = self.pairing_score(candidate)
+            if best_score is None or pairing_score < best_score:
+                best_score = pairing_score
+                best_pairing = list(candidate)
+        return best_score, best_pairing, valid_count
+
+    def _sample_chunks(self, div_key, div, sample_size, seed, pool=None):
+        # split the samples into fixed size chunks, each with its own RNG stream,
+        # so that the result only depends on the seed and not on the pool size.
+        # Returns an iterator of chunk results; on a pool the chunks are
+        # submitted right away.
+        chunk_sizes = [SAMPLE_CHUNK] * (sample_size // SAMPLE_CHUNK)
+        if sample_size % SAMPLE_CHUNK:
+            chunk_sizes.append(sample_size % SAMPLE_CHUNK)
+        chunk_seeds = ['{}:{}:{}'.format(seed, div_key, i) for i in range(len(chunk_sizes))]
+        divs = [div] * len(chunk_sizes)
+        if pool is not None:
+            return pool.map(_sample_chunk, divs, chunk_sizes, chunk_seeds)
+        evaluator = None
+        if numpy is not None:
+            evaluator = BatchEvaluator(self, sorted(div))
+        return (self._sample_chunk(div, chunk_size, chunk_seed, evaluator)
+                for chunk_size, chunk_seed in zip(chunk_sizes, chunk_seeds))
+
+    def _best_sample(self, div_key, sample_size, results):
+        # look for most optimized pairings, earliest chunk wins ties
+        best_score = None
+        best_pairing = None
+        for pairing_score, pairing, valid_count in results:
+            if pairing is not None and (best_score is None or pairing_score < best_score):
+                best_score = pairing_score
+                best_pairing = pairing
+                if self.instrument is not None:
+                    self.instrument.improved(div_key, best_score)
+            if self.instrument is not None:
+                self.instrument.count('valid', valid_count)
+        if self.instrument is not None:
+            self.instrument.count('candidates', sample_size)
+        return best_pairing
+
+    def _match_division(self, div):
+        # exact minimum cost perfect matching, players who may not meet have
+        # no edge
+        blocked = self._opponent_index().blocked
+        edges = []
+        for i, j in itertools.combinations(range(len(div)), 2):
+            if not blocked(div[i], div[j]):
+                edges.append((i, j, self.pair_cost(div[i], div[j])))
+        mate = mm_matching.min_weight_perfect_matching(len(div), edges)
+        if mate is None:
+            raise RuntimeError('No pairing without repeat games exists for players {}'
+                               .format(sorted(div)))
+        pairing = []
+        for i, j in enumerate(mate):
+            if i < j:
+                pairing.extend([div[i], div[j]])
+        return pairing
+
+    def _anytime_division(self, div_key, div, seed, deadline=None, initial=None):
+        # greedy pairing down the score groups (or initial, a pairing list of
+        # the division to warm start from), improved by exchanging partners
+        # between two pairs (2-opt) until no exchange helps. With a deadline (a
+        # time.perf_counter() value) the search then restarts from random
+        # re-pairings of the best pairing until the deadline passes. Repeat
+        # games cost more than any pairing without them, so they are swapped
+        # out first. If some remain, the exact matching is the fallback without
+        # a deadline; with one, the best pairing found is returned when it
+        # passes, repeats and all, so the time limit holds.
+        rng = random.Random('{}:{}'.format(seed, div_key))
+        players = sorted(div, key=lambda k: (self.players[k].mm_score[0], self.players[k].rank),
+                         reverse=True)
+        scores = {k: self.players[k].mm_score[0] for k in players}
+        ranks = {k: self.players[k].rank for k in players}
+        blocked = self._opponent_index().blocked
+        penalty = 1 + len(players) // 2 * self._cost(
+            max(scores.values()) - min(scores.values()), max(ranks.values()) - min(ranks.values()))
+
+        def cost(a, b):
+            res = self._cost(scores[a] - scores[b], ranks[a] - ranks[b])
+            if blocked(a, b):
+                res += penalty
+            return res
+
+        def descend(pairs, costs):
+            # first improvement descent, False when stopped by the deadline
+            improved = True
+            while improved:
+                improved = False
+                for i in range(len(pairs)):
+                    if deadline is not None and time.perf_counter() > deadline:
+                        return False
+                    for j in range(i + 1, len(pairs)):
+                        a, b = pairs[i]
+                        c, d = pairs[j]
+                        current = costs[i] + costs[j]
+                        for first, second in (((a, c), (b, d)), ((a, d), (b, c))):
+                            first_cost = cost(*first)
+                            second_cost = cost(*second)
+                            if first_cost + second_cost < current:
+                                pairs[i], pairs[j] = first, second
+                                costs[i], costs[j] = first_cost, second_cost
+                                improved = True
+                                if self.instrument is not None:
+                                    self.instrument.count('moves')
+                                break
+            return True
+
+        # greedy start: the strongest unpaired player meets the next one down
+        # that they have not played
+        pairs = []
+        if initial is not None and sorted(initial) == sorted(div):
+            pairs = list(zip(initial[0::2], initial[1::2]))
+        unpaired = [] if pairs else list(players)
+        while unpaired:
+            first = unpaired.pop(0)
+            partner = next((i for i, second in enumerate(unpaired)
+                            if not blocked(first, second)), 0)
+            pairs.append((first, unpaired.pop(partner)))
+        costs = [cost(*pair) for pair in pairs]
+
+        best_pairs = list(pairs)
+        best_score = sum(costs)
+        while True:
+            finished = descend(pairs, costs)
+            if sum(costs) < best_score:
+                best_pairs = list(pairs)
+                best_score = sum(costs)
+                if self.instrument is not None:
+                    self.instrument.improved(div_key, best_score)
+            if not finished or deadline is None or len(pairs) < 2 or best_score == 0:
+                break
+            # kick: re-pair a few pairs of the best pairing at random
+            pairs = list(best_pairs)
+            kicked = rng.sample(range(len(pairs)), min(ANYTIME_KICK, len(pairs)))
+            kicked_players = [player for i in kicked for player in pairs[i]]
+            rng.shuffle(kicked_players)
+            for n, i in enumerate(kicked):
+                pairs[i] = (kicked_players[2 * n], kicked_players[2 * n + 1])
+            costs = [cost(*pair) for pair in pairs]
+
+        if best_score >= penalty:
+            if deadline is None:
+                return self._match_division(div)
+            if self.instrument is not None:
+                self.instrument.count('repeats_at_deadline')
+        return [player for pair in best_pairs for player in pair]
+
+    @instrumented
+    def generate_pairing(self, sample_size, mode='random', seed=None, workers=1,
+                         time_limit=None, initial=None):
+        # mode 'random' keeps the best of sample_size shuffles, mode 'matching'
+        # computes the optimal pairing exactly and mode 'anytime' improves a
+        # greedy pairing by local search (both ignore sample_size)
+        # with workers > 1 the divisions are paired concurrently on a process
+        # pool, the largest first, and random sampling is split into chunks
+        # over the pool; a given seed gives the same pairing for any number of
+        # workers, and divisions are always merged in sorted order
+        # time_limit bounds the anytime search in seconds; without it the
+        # search stops at a local optimum. With it, a division that still has a
+        # repeat game when its time runs out keeps it rather than waiting for
+        # the exact matching. A single limit is the budget for the
+        # round: shared between the divisions by size when run one after
+        # another, and scaled down on a pool with more divisions than workers.
+        # sample_size and time_limit may also be dicts by division, giving
+        # each division its own sample count or time limit; a sample_size dict
+        # must cover every division, one missing from time_limit has no limit
+        # initial is an earlier pairing of the same players that the anytime
+        # search starts from instead of the greedy pairing
+        if mode not in PAIRING_MODES:
+            raise ValueError("'mode' must be one of {}".format(', '.join(PAIRING_MODES)))
+        if seed is None:
+            seed = random.getrandbits(64)
+
         # populate old pairs set, skip if first round
         if self.rounds:
-            for match in self.rounds[-1].values():
-                self.old_pairs.add(frozenset([match.black, match.white]))
+            for white, black in zip(self.rounds[-1].white, self.rounds[-1].black):
+                self.old_pairs.add(frozenset([black, white]))
 
         # Generate candidate pairings for one division
         pairings = []  # list initialized for all pairings in a round
@@ -174,25 +1091,72 @@ class Tournament(object):
             else:
                 div_dict[player.division] = [player_id]
 
-        # for each division, generate pairings and optimize.
+        div_keys = sorted(div_dict)
         for div in div_dict.values():
-            # generating possible pairings
-            div_pairings = []  # list of lists of possible pairings
-            for i in range(sample_size):
-                random.shuffle(div)
-                div_pairings.append(list(div))
-            valid_pairings = [pairing for pairing in div_pairings
-                              if self._pairing_is_valid(pairing)]
-            # look for most optimized pairings
-            best_score = 900000
-            best_pairing = None
-            for pairing in valid_pairings:
-                pairing_score = self.pairing_score(pairing)
-                if pairing_score < best_score:
-                    best_score = pairing_score
-                    best_pairing = pairing
-            # append best pairing to pairings list
-            pairings.append(best_pairing)
+            div.sort()
+        sample_sizes = {div_key: _division_value(sample_size, div_key) for div_key in div_keys}
+        if mode == 'random' and None in sample_sizes.values():
+            raise ValueError('No sample size for divisions {}'.format(
+                [div_key for div_key in div_keys if sample_sizes[div_key] is None]))
+        total = len(self.current_players)
+
+        pool = None
+        if workers > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(self,))
+
+        # for each division, generate pairings and optimize.
+        start = time.perf_counter()
+        remaining = total
+        try:
+            pending = {}
+            if pool is not None:
+                for div_key in sorted(div_keys, key=lambda k: len(div_dict[k]), reverse=True):
+                    div = div_dict[div_key]
+                    if mode == 'random':
+                        pending[div_key] = self._sample_chunks(div_key, div,
+                                                               sample_sizes[div_key], seed, pool)
+                        continue
+                    budget = _division_value(time_limit, div_key)
+                    if budget is not None and not isinstance(time_limit, dict):
+                        budget = min(budget, budget * workers * len(div) / total)
+                    pending[div_key] = pool.submit(_pair_division, mode, div_key, div, seed,
+                                                   budget, _division_pairing(initial, div))
+
+            for div_key in div_keys:
+                div = div_dict[div_key]
+                phase = contextlib.nullcontext()
+                if self.instrument is not None:
+                    phase = self.instrument.phase('{} division {}'.format(mode, div_key))
+                with phase:
+                    if mode == 'random':
+                        results = pending.get(div_key)
+                        if results is None:
+                            results = self._sample_chunks(div_key, div, sample_sizes[div_key],
+                                                          seed)
+                        best_pairing = self._best_sample(div_key, sample_sizes[div_key],
+                                                         results)
+                    elif div_key in pending:
+                        best_pairing = pending[div_key].result()
+                    elif mode == 'anytime':
+                        deadline = None
+                        budget = _division_value(time_limit, div_key)
+                        now = time.perf_counter()
+                        if isinstance(time_limit, dict):
+                            if budget is not None:
+                                deadline = now + budget
+                        elif budget is not None:
+                            deadline = now + (start + budget - now) * len(div) / remaining
+                        best_pairing = self._anytime_division(div_key, div, seed, deadline,
+                                                              _division_pairing(initial, div))
+                    else:
+                        best_pairing = self._match_division(div)
+                # append best pairing to pairings list
+                pairings.append(best_pairing)
+                remaining -= len(div)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
         res = [player for division in pairings for player in division]
         # Here is where we sort if it's the first round
         if len(self.rounds) == 0:
@@ -201,23 +1165,47 @@ class Tournament(object):
         return res
 
     def add_result(self, round_, board, winner):
+        # scores only count finished rounds, so a result changes mm_scores when
+        # it completes a round or corrects one that was already complete
+        self._game_index()
         match = self.rounds[round_][board]
+        previous = match.winner
+        was_finished = not self._pending[round_]
+        if was_finished and winner is None:
+            # clearing a result takes the whole round back out of the scores
+            dirty = self._count_round(round_, -1)
         match.winner = winner
-        self.players[winner].mm_score[0] += 1
+        if previous is None and winner is not None:
+            self._pending[round_] -= 1
+        elif previous is not None and winner is None:
+            self._pending[round_] += 1
+
+        if not self._pending[round_]:
+            if not was_finished:
+                dirty = self._count_round(round_, 1)
+            elif previous == winner:
+                return
+            else:
+                self.players[previous].mm_score[0] -= 1
+                self.players[winner].mm_score[0] += 1
+                dirty = {previous, winner}
+        elif not was_finished:
+            return
+        self._update_tiebreaks(dirty)
 
     def round_is_finished(self, round_):
-        finished = True
-        for match in self.rounds[round_].values():
-            if match.winner is None:
-                finished = False
-                break
-        return finished
+        return self.rounds[round_].finished()
 
     def start_new_round(self, pairing):
         # check that last round is finished
         if len(self.rounds) > 0 and not self.round_is_finished(len(self.rounds) - 1):
             raise RuntimeError('Last round is not yet finished')
 
+        # remember who played whom in the finished round
+        if self.rounds:
+            for white, black in zip(self.rounds[-1].white, self.rounds[-1].black):
+                self.old_pairs.add(frozenset([black, white]))
+
         # break pairing list into tuples
         pair_tuples = []
         while pairing:
@@ -234,62 +1222,225 @@ class Tournament(object):
         # sort pairing and assign corresponding new Matches to boards
         sorted_pairing = sorted(pair_tuples, key=lambda p: self.players[p[0]].mm_score,
                                 reverse=True)
-        round_ = dict()
-        for board in range(1, len(sorted_pairing) + 1):
-            pair = sorted_pairing[board - 1]
-            round_[board] = Match(pair[0], pair[1])
+        round_ = Round()
+        for board, (white, black) in enumerate(sorted_pairing, 1):
+            round_.add(board, white, black)
         self.rounds.append(round_)
+        if self._games is not None:
+            self._index_round(len(self.rounds) - 1)
+        if self._opponents is not None:
+            for white, black in sorted_pairing:
+                self._opponents.add(white, black)
+
+    def repair_round(self, radius=REPAIR_RADIUS):
+        # re-pair the current round after late drops and additions without
+        # touching most boards. Boards without a result that lost a player are
+        # broken up; their remaining players and players on no board are
+        # matched exactly together with the players of the radius boards on
+        # either side of each of them in score, in the same division. Repeat games
+        # and forbidden pairs stay excluded, the pairing cost is minimized and
+        # ties keep existing boards. Returns the board numbers that changed.
+        round_idx = len(self.rounds) - 1
+        if round_idx < 0 or self.round_is_finished(round_idx):
+            raise RuntimeError('There is no unfinished round to repair')
+        round_ = self.rounds[round_idx]
+        seated = set()
+        broken = []
+        for board, match in round_.items():
+            seated.update((match.white, match.black))
+            if match.winner is None and not {match.white, match.black} <= self.current_players:
+                broken.append(board)
+        unseated = set(self.current_players - seated)
+        for board in broken:
+            unseated.update({round_[board].white, round_[board].black} & self.current_players)
+        if not unseated and not broken:
+            return []
+
+        # open boards that may be re-paired, per division
+        open_boards = {}
+        for board, match in round_.items():
+            if match.winner is None and board not in broken:
+                division = self.players[match.white].division
+                open_boards.setdefault(division, []).append(board)
+        by_division = {}
+        for player_id in unseated:
+            by_division.setdefault(self.players[player_id].division, []).append(player_id)
 
-    def wall_list(self):
-        # results board sorts players by mmscore, and then shows each round's win
-        # or loss per player
-        # player, rank, round1, round2, .. roundn, mmscore.
-
-        # build id_to_wall dict to hold conversion between tournament id and
-        # wall list id (0 indexed, for now, convert to 1 index at end)
-        current_standings = self.standings()
-        id_to_wall = {player_id: current_standings.index(player_id)
-                      for player_id in current_standings}
-
-        # dictionary representation of the wall standings
-        # key is tournament id, value is list of str representaiton (
-        # opponent tournament id, win/loss)
-        # no mm_score (will be pulled in at the end, along with player name)
-        wall_dict = {player_id: list() for player_id in current_standings}
-
-        # for each round, create record of each player's opponents and win/loss
+        pairs = []
+        freed = list(broken)
+        for division, players in sorted(by_division.items()):
+            if len(players) % 2:
+                raise RuntimeError('Odd number of players to seat in division {}: {}'
+                                   .format(division, ', '.join(str(player_id) for player_id
+                                                               in sorted(players))))
+            boards = sorted(open_boards.get(division, []),
+                            key=lambda b: (self.players[round_[b].white].mm_score[0], b))
+            board_scores = [self.players[round_[b].white].mm_score[0] for b in boards]
+            width = radius
+            while True:
+                chosen = set()
+                for player_id in players:
+                    i = bisect.bisect_left(board_scores, self.players[player_id].mm_score[0])
+                    chosen.update(boards[max(0, i - width):i + width])
+                result = self._repair_pairs(round_, players, sorted(chosen))
+                if result is not None or width >= len(boards):
+                    break
+                width *= 2
+            if result is None:
+                raise RuntimeError('No pairing without repeat games exists for division {}'
+                                   .format(division))
+            pairs.extend(result[0])
+            freed.extend(result[1])
+
+        # kept boards were not freed; new pairs take the freed board numbers,
+        # then numbers after the last board
+        removed = [round_.pop(board) for board in freed]
+        last = max(round_, default=0)
+        numbers = sorted(freed) + list(range(last + 1, last + 1 + len(pairs) - len(freed)))
+        added = {}
+        for board, (first, second) in zip(numbers, sorted(pairs)):
+            if self.players[second].mm_score > self.players[first].mm_score:
+                first, second = second, first
+            round_[board] = added[board] = Match(first, second)
+        changed = sorted(set(freed) | set(added))
+
+        # bring the derived indexes up to date
+        if self._opponents is not None:
+            for match in removed:
+                pair = frozenset([match.white, match.black])
+                if pair not in self.old_pairs and pair not in self.forbidden_pairs:
+                    self._opponents.discard(match.white, match.black)
+            for match in added.values():
+                self._opponents.add(match.white, match.black)
+        if self._games is not None:
+            for match in removed:
+                for player_id in (match.white, match.black):
+                    self._games[player_id] = [game for game in self._games[player_id]
+                                              if game[0] != round_idx or game[1] not in freed]
+            for board, match in added.items():
+                self._games[match.white].append((round_idx, board))
+                self._games[match.black].append((round_idx, board))
+            self._pending[round_idx] = round_.pending()
+        if self.round_is_finished(round_idx):
+            # only boards with results are left, the round now counts
+            self._game_index()
+            self._update_tiebreaks(self._count_round(round_idx, 1))
+        return changed
+
+    def _repair_pairs(self, round_, players, boards):
+        # min cost pairing of players with the players on boards, returns
+        # (new pairs, boards given up) or None when there is none. Pairs that
+        # sit on one of the boards are allowed even though the opponent index
+        # blocks them, and are preferred over equal cost alternatives.
+        pool = sorted(players) + [player_id for board in boards
+                                  for player_id in (round_[board].white, round_[board].black)]
+        current = {frozenset([round_[board].white, round_[board].black]): board
+                   for board in boards}
+        blocked = self._opponent_index().blocked
+        # costs are scaled so that keeping a board only ever breaks ties
+        scale = len(pool) + 1
+        edges = []
+        for i, j in itertools.combinations(range(len(pool)), 2):
+            pair = frozenset([pool[i], pool[j]])
+            if pair in current:
+                edges.append((i, j, scale * self.pair_cost(pool[i], pool[j])))
+            elif not blocked(pool[i], pool[j]):
+                edges.append((i, j, scale * self.pair_cost(pool[i], pool[j]) + 1))
+        mate = mm_matching.min_weight_perfect_matching(len(pool), edges)
+        if mate is None:
+            return None
+        pairs = []
+        kept = set()
+        for i, j in enumerate(mate):
+            if i < j:
+                pair = frozenset([pool[i], pool[j]])
+                if pair in current:
+                    kept.add(current[pair])
+                else:
+                    pairs.append((pool[i], pool[j]))
+        return pairs, [board for board in boards if board not in kept]
+
+    def wall_rows(self, order=None):
+        # (place, player_id, results) in standings order (see standings), where
+        # results holds one entry per round: '+W12' for a win as white against
+        # the player in place 12, '-B3' for a loss as black against place 3,
+        # '' without a game or before the round is finished. One pass over the
+        # standings and one over the games.
+        current_standings = self.standings(order)
+        place = {player_id: i for i, player_id in enumerate(current_standings, 1)}
+        results = {player_id: [''] * len(self.rounds) for player_id in current_standings}
         for idx, round_ in enumerate(self.rounds):
-            if self.round_is_finished(idx):
-                for match in round_.values():
-                    winner_str = '+'
-                    loser_str = '-'
-                    if match.winner == match.black:
-                        winner_str += 'B' + str(id_to_wall[match.white] + 1)
-                        loser_str += 'W' + str(id_to_wall[match.black] + 1)
-                        wall_dict[match.white].append('{:>5}'.format(loser_str))
-                    else:
-                        winner_str += 'W' + str(id_to_wall[match.black] + 1)
-                        loser_str += 'B' + str(id_to_wall[match.white] + 1)
-                        wall_dict[match.black].append('{:>5}'.format(loser_str))
-                    wall_dict[match.winner].append('{:>5}'.format(winner_str))
-            for player, results in wall_dict.items():
-                if len(results) <= idx:
-                    results.extend(' ' * 6)
+            if not round_.finished():
+                continue
+            for white, black, winner in zip(round_.white, round_.black, round_.winner):
+                if winner == black:
+                    results[black][idx] = '+B{}'.format(place[white])
+                    results[white][idx] = '-W{}'.format(place[black])
+                else:
+                    results[white][idx] = '+W{}'.format(place[black])
+                    results[black][idx] = '-B{}'.format(place[white])
+        for player_id in current_standings:
+            yield place[player_id], player_id, results[player_id]
+
+    @instrumented
+    def write_wall(self, h, format='text', order=None):
+        # write the wall list to the file h a row at a time, as text, csv, html
+        # or json (see WALL_FORMATS)
+        rows = self.wall_rows(order)
+        if format == 'text':
+            h.write('{:5} {:20} | {:4} |{:3} {:4} | {:15}\n'.format(' ', 'Player', 'Rank', ' S',
+                                                                    ' SOS', 'Opponents'))
+            h.write('-' * 78 + '\n')
+            for place, player_id, results in rows:
+                player = self.players[player_id]
+                opponents = ' '.join('{:>5}'.format(result) for result in results)
+                h.write('{:4}. {:20} | {:4} |{:3} {:4} |{:15}\n'.format(
+                    place, player.name, player.rank, player.mm_score[0], player.mm_score[1],
+                    opponents))
+        elif format == 'csv':
+            writer = csv.writer(h, lineterminator='\n')
+            writer.writerow(['Place', 'Name', 'Rank', 'AGA ID', 'Score', 'SOS', 'SODOS'] +
+                            ['Round {}'.format(i) for i in range(1, len(self.rounds) + 1)])
+            for place, player_id, results in rows:
+                player = self.players[player_id]
+                writer.writerow([place, player.name, player.rank, player.aga_id] +
+                                player.mm_score + results)
+        elif format == 'html':
+            h.write('<table class="wall">\n<thead><tr>')
+            for heading in (['Place', 'Name', 'Rank', 'Score', 'SOS'] +
+                            ['Round {}'.format(i) for i in range(1, len(self.rounds) + 1)]):
+                h.write('<th>{}</th>'.format(heading))
+            h.write('</tr></thead>\n<tbody>\n')
+            for place, player_id, results in rows:
+                player = self.players[player_id]
+                cells = [place, player.name, player.rank, player.mm_score[0],
+                         player.mm_score[1]] + results
+                h.write('<tr>{}</tr>\n'.format(''.join(
+                    '<td>{}</td>'.format(html.escape(str(cell))) for cell in cells)))
+            h.write('</tbody>\n</table>\n')
+        elif format == 'json':
+            # an array with one object per line
+            separator = '[\n'
+            for place, player_id, results in rows:
+                player = self.players[player_id]
+                h.write(separator + json.dumps({
+                    'place': place, 'id': player_id, 'name': player.name, 'rank': player.rank,
+                    'aga_id': player.aga_id, 'mm_score': player.mm_score, 'results': results}))
+                separator = ',\n'
+            h.write('[]\n' if separator == '[\n' else '\n]\n')
+        else:
+            raise ValueError("'format' must be one of {}".format(', '.join(WALL_FORMATS)))
 
-        res = []
-        res.append('{:5} {:20} | {:4} |{:3} {:4} | {:15}'.format(' ', 'Player', 'Rank', ' S',
-                   ' SOS', 'Opponents'))
-        res.append('-' * 78)
-        for standing, player_id in enumerate(current_standings):
-            player_obj = self.players[player_id]
-            # format opponents string
-            opponents = ' '.join(wall_dict[player_id])
-            # full string for each player
-            res.append('{:4}. {:20} | {:4} |{:3} {:4} |{:15}'.format((standing + 1),
-                       player_obj.name, player_obj.rank, player_obj.mm_score[0],
-                       player_obj.mm_score[1], opponents))
-        return '\n'.join(res)
+    @instrumented
+    def wall_list(self, order=None):
+        # results board sorts players by mmscore (or the tiebreaks in order, see
+        # standings), and then shows each round's win or loss per player
+        # player, rank, round1, round2, .. roundn, mmscore.
+        h = io.StringIO()
+        self.write_wall(h, order=order)
+        return h.getvalue()[:-1]
 
+    @instrumented
     def pairings_list(self):
         # pretty printing pairings list with board#, names.
         res = []
@@ -307,38 +1458,79 @@ class Tournament(object):
         return '\n'.join(res)
 
 
+# tournament copy held by each process pool worker, see generate_pairing
+_worker_tournament = None
+# BatchEvaluators built by this worker, keyed by division player ids
+_worker_evaluators = {}
+
+
+def _init_worker(tournament):
+    global _worker_tournament
+    _worker_tournament = tournament
+    _worker_evaluators.clear()
+
+
+def _division_value(value, div_key):
+    # sample sizes and time limits are given for all divisions or as a dict
+    if isinstance(value, dict):
+        return value.get(div_key)
+    return value
+
+
+def _division_pairing(pairing, div):
+    # the pairs of pairing between players of div, as a pairing list
+    if pairing is None:
+        return None
+    members = set(div)
+    return [player for pair in zip(pairing[0::2], pairing[1::2])
+            if pair[0] in members and pair[1] in members for player in pair]
+
+
+def _pair_division(mode, div_key, div, seed, budget, initial=None):
+    # pair one whole division in a pool worker, budget is in seconds
+    if mode == 'matching':
+        return _worker_tournament._match_division(div)
+    deadline = None
+    if budget is not None:
+        deadline = time.perf_counter() + budget
+    return _worker_tournament._anytime_division(div_key, div, seed, deadline, initial)
+
+
+def _sample_chunk(div, sample_size, chunk_seed):
+    evaluator = None
+    if numpy is not None:
+        key = tuple(sorted(div))
+        if key not in _worker_evaluators:
+            _worker_evaluators[key] = BatchEvaluator(_worker_tournament, key)
+        evaluator = _worker_evaluators[key]
+    return _worker_tournament._sample_chunk(div, sample_size, chunk_seed, evaluator)
+
+
 def tournament_representer(dumper, data):
-    return dumper.represent_mapping('!tournament', data.__dict__)
+    return dumper.represent_mapping('!tournament', data._state())
 
 yaml.add_representer(Tournament, tournament_representer)
 
 
 def tournament_constructor(loader, node):
-    tourn_dict = loader.construct_mapping(node)
+    # deep, so that rounds written as mappings of Match are filled in before
+    # they are converted to Round
+    tourn_dict = loader.construct_mapping(node, deep=True)
     return Tournament(tourn_dict['players'], tourn_dict['id_ctr'], tourn_dict['rounds'],
-                      tourn_dict['old_pairs'], tourn_dict['current_players'])
+                      tourn_dict['old_pairs'], tourn_dict['current_players'],
+                      tourn_dict.get('forbidden_pairs'))
 
 yaml.add_constructor('!tournament', tournament_constructor)
 
 
 class HandiTournament(Tournament):
 
-    def pairing_score(self, player_list):
-        # measures sum of difference of mm_score per pairing
+    def _cost(self, score_diff, rank_diff):
+        # difference of mm_score per pairing
         # handi adds in difference of rank as a metric
-        # assumes even number of people?
-        score_mm = 0
-        score_handi = 0
-        temp_list = list(player_list)
-        while temp_list:
-            player1 = temp_list.pop()
-            player2 = temp_list.pop()
-            score_mm += abs(self.players[player1].mm_score[0]
-                            - self.players[player2].mm_score[0])
-            score_handi += abs(self.players[player1].rank
-                               - self.players[player2].rank)
-        return 3 * score_mm + score_handi
+        return 3 * abs(score_diff) + abs(rank_diff)
 
+    @instrumented
     def pairings_list(self):
         # pretty printing pairings list with board#, names.
         res = []
@@ -359,19 +1551,151 @@ class HandiTournament(Tournament):
 
 
 def handi_tournament_representer(dumper, data):
-    return dumper.represent_mapping('!handitournament', data.__dict__)
+    return dumper.represent_mapping('!handitournament', data._state())
 
 yaml.add_representer(HandiTournament, handi_tournament_representer)
 
 
 def handi_tournament_constructor(loader, node):
-    tourn_dict = loader.construct_mapping(node)
+    tourn_dict = loader.construct_mapping(node, deep=True)
     return HandiTournament(tourn_dict['players'], tourn_dict['id_ctr'], tourn_dict['rounds'],
-                           tourn_dict['old_pairs'], tourn_dict['current_players'])
+                           tourn_dict['old_pairs'], tourn_dict['current_players'],
+                           tourn_dict.get('forbidden_pairs'))
 
 yaml.add_constructor('!handitournament', handi_tournament_constructor)
 
 
+# Tournament files are read and written with TournamentLoader and
+# TournamentDumper through load and dump. They build on the safe loader and
+# dumper, in their LibYAML versions when PyYAML has it, so only the tags
+# registered here are ever constructed. A player is written as a flow
+# sequence on one line; round columns, old_pairs, forbidden_pairs and
+# current_players are each one scalar of space separated numbers, so that a
+# large tournament makes few YAML nodes. Files from earlier versions, with
+# player mappings, flow sequences for these, or python/object tags for Match
+# and frozenset, still load.
+
+class _IntResolver(object):
+    # plain decimal integers, nearly every scalar in a tournament file, are
+    # resolved without trying the regular expressions of every implicit tag
+
+    def resolve(self, kind, value, implicit):
+        if kind is yaml.ScalarNode and implicit[0] and _plain_int(value) is not None:
+            return 'tag:yaml.org,2002:int'
+        return super().resolve(kind, value, implicit)
+
+
+class TournamentLoader(_IntResolver, getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+
+    # set when a round was read in the format written before !round
+    legacy_rounds = False
+
+    def construct_yaml_int(self, node):
+        value = _plain_int(node.value)
+        if value is not None:
+            return value
+        return super().construct_yaml_int(node)
+
+
+class TournamentDumper(_IntResolver, getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+    pass
+
+
+def load(stream):
+    # a tournament from a file or string written by dump. Files with rounds
+    # of python/object:mcmahon.Match predate incremental scoring and may hold
+    # scores counted from unfinished rounds, so their scores are recomputed
+    loader = TournamentLoader(stream)
+    try:
+        tournament = loader.get_single_data()
+    finally:
+        loader.dispose()
+    if loader.legacy_rounds and isinstance(tournament, Tournament):
+        tournament.calculate_mm_score()
+    return tournament
+
+
+def dump(tournament, stream=None):
+    return yaml.dump(tournament, stream, Dumper=TournamentDumper, default_flow_style=False)
+
+
+def _flow_player_representer(dumper, data):
+    # [name, rank, aga_id, mm_score, mm_init, division]
+    return yaml.SequenceNode('!player', [dumper.represent_data(data.name)] +
+                             _int_nodes([data.rank, data.aga_id]) +
+                             [yaml.SequenceNode('tag:yaml.org,2002:seq',
+                                                _int_nodes(data.mm_score), flow_style=True)] +
+                             _int_nodes([data.mm_init, data.division]), flow_style=True)
+
+
+def _flow_match_representer(dumper, data):
+    return dumper.represent_sequence('!match', [data.white, data.black, data.winner],
+                                     flow_style=True)
+
+
+def _flow_tournament_representer(dumper, data):
+    # the sets are written as scalars, pairs as 0-1; represent_data cannot
+    # write a set of frozensets with the safe dumper
+    tag = '!handitournament' if isinstance(data, HandiTournament) else '!tournament'
+    items = []
+    for name, value in sorted(data._state().items()):
+        if name in ('old_pairs', 'forbidden_pairs'):
+            node = yaml.ScalarNode('!pairs', ' '.join(
+                '{}-{}'.format(*pair) for pair in sorted(sorted(pair) for pair in value)))
+        elif name == 'current_players':
+            node = yaml.ScalarNode('!players', ' '.join(map(str, sorted(value))))
+        else:
+            node = dumper.represent_data(value)
+        items.append((dumper.represent_data(name), node))
+    return yaml.MappingNode(tag, items, flow_style=False)
+
+
+def _match_constructor(loader, node):
+    return Match(*loader.construct_sequence(node))
+
+
+def _pairs_constructor(loader, node):
+    if isinstance(node, yaml.ScalarNode):
+        return set(frozenset(map(int, pair.split('-'))) for pair in node.value.split())
+    return set(frozenset(pair) for pair in loader.construct_sequence(node, deep=True))
+
+
+def _players_constructor(loader, node):
+    if isinstance(node, yaml.ScalarNode):
+        return set(map(int, node.value.split()))
+    return set(loader.construct_sequence(node))
+
+
+def _legacy_match_constructor(loader, node):
+    # python/object:mcmahon.Match, the __dict__ of a Match
+    loader.legacy_rounds = True
+    fields = loader.construct_mapping(node)
+    return Match(fields['white'], fields['black'], fields['_winner'])
+
+
+def _legacy_frozenset_constructor(loader, node):
+    # python/object/apply:builtins.frozenset, a pair in old_pairs
+    return frozenset(loader.construct_sequence(node, deep=True)[0])
+
+
+TournamentDumper.add_representer(Player, _flow_player_representer)
+TournamentDumper.add_multi_representer(Match, _flow_match_representer)
+TournamentDumper.add_representer(Round, round_representer)
+TournamentDumper.add_representer(Tournament, _flow_tournament_representer)
+TournamentDumper.add_representer(HandiTournament, _flow_tournament_representer)
+for tag, constructor in [('!player', player_constructor), ('!match', _match_constructor),
+                         ('!round', round_constructor), ('!pairs', _pairs_constructor),
+                         ('!players', _players_constructor),
+                         ('!tournament', tournament_constructor),
+                         ('!handitournament', handi_tournament_constructor),
+                         ('tag:yaml.org,2002:python/object:mcmahon.Match',
+                          _legacy_match_constructor),
+                         ('tag:yaml.org,2002:python/object/apply:builtins.frozenset',
+                          _legacy_frozenset_constructor)]:
+    TournamentLoader.add_constructor(tag, constructor)
+TournamentLoader.add_constructor('tag:yaml.org,2002:int', TournamentLoader.construct_yaml_int)
+
+
 class PlayerTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -401,6 +1725,48 @@ class MatchTestCase(unittest.TestCase):
         self.assertEqual(repr(self.match), '<Match(white=1, black=3, winner=3>')
 
 
+class RoundTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.round = Round({1: Match(4, 5), 2: Match(1, 3, 3), 3: Match(0, 2)})
+
+    def test_views(self):
+        self.assertEqual(list(self.round), [1, 2, 3])
+        self.assertEqual(self.round[2], Match(1, 3, 3))
+        self.assertFalse(self.round.finished())
+        self.round[1].winner = 5
+        self.round[3].winner = 0
+        self.assertEqual(list(self.round.winner), [5, 3, 0])
+        self.assertTrue(self.round.finished())
+        with self.assertRaises(ValueError):
+            self.round[1].winner = 2
+        with self.assertRaises(KeyError):
+            self.round[4]
+
+    def test_gaps(self):
+        view = self.round[3]
+        self.assertEqual(self.round.pop(2), Match(1, 3, 3))
+        self.assertNotIn(2, self.round)
+        self.assertEqual(view, Match(0, 2))
+        self.round[5] = Match(6, 7)
+        self.assertEqual(self.round.pending(), 3)
+        self.assertEqual(dict(self.round), {1: Match(4, 5), 3: Match(0, 2), 5: Match(6, 7)})
+
+    def test_yaml(self):
+        self.round.pop(2)
+        text = yaml.dump(self.round)
+        self.assertIn('white: 4 0\n', text)
+        self.assertEqual(yaml.load(text, Loader=yaml.Loader), self.round)
+        # rounds written as mappings of Match by earlier versions
+        old = ('!tournament {current_players: !!set {0: null}, id_ctr: 1, old_pairs: !!set {},'
+               ' players: {}, rounds: [{1: !!python/object:mcmahon.Match'
+               ' {_winner: 0, black: 2, white: 0}}]}')
+        tournament = yaml.load(old, Loader=yaml.Loader)
+        self.assertIsInstance(tournament.rounds[0], Round)
+        self.assertEqual(tournament.rounds[0][1], Match(0, 2, 0))
+        self.assertEqual(yaml.load(yaml.dump(Match(0, 2, 0)), Loader=yaml.Loader), Match(0, 2, 0))
+
+
 class TournamentTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -434,6 +1800,49 @@ class TournamentTestCase(unittest.TestCase):
     def test_generate_pairing(self):
         self.assertEqual(self.tournament.pairing_score(self.pairing), 0)
 
+    def test_load_dump(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.black)
+        self.tournament.start_new_round(self.tournament.generate_pairing(0, mode='matching'))
+        self.tournament.forbid_pair(3, 4)
+        text = dump(self.tournament)
+        self.assertIn('0: !player [Ma Wang, 7, 12345, [', text)
+        self.assertIn('forbidden_pairs: !pairs 3-4\n', text)
+        self.assertIn('  winner: ~ ~ ~', text)
+        self.assertEqual(load(text), self.tournament)
+        self.assertEqual(load(text).verify_mm_score(), [])
+        # player mappings and flow sequences, as the first !round files had
+        self.assertEqual(load('[!player {aga_id: 1, division: 1, mm_init: 0, mm_score: [1, 0, 0],'
+                              ' name: A, rank: 1}, !pairs [[0, 1]], !players [0, 1],'
+                              ' !round {boards: [1, 3], white: [0, 2], black: [1, 3],'
+                              ' winner: [1, null]}]'),
+                         [Player('A', 1, 1, [1, 0, 0], 0, 1), {frozenset([0, 1])}, {0, 1},
+                          Round({1: Match(0, 1, 1), 3: Match(2, 3)})])
+        # files written by earlier versions, with python tags in them
+        legacy = yaml.dump(self.tournament)
+        self.assertIn('python/object/apply:builtins.frozenset', legacy)
+        self.assertEqual(load(legacy), self.tournament)
+        self.assertEqual(load('[!!python/object:mcmahon.Match {_winner: 1, black: 1, white: 0},'
+                              ' !match [0, 1, null]]'), [Match(0, 1, 1), Match(0, 1)])
+        with self.assertRaises(yaml.constructor.ConstructorError):
+            load('!!python/object/apply:os.system ["true"]')
+        # the first version counted a win for an unfinished round; its files
+        # are rescored on load
+        inflated = load('!tournament\n'
+                        'current_players: !!set {0: null, 1: null}\n'
+                        'id_ctr: 2\n'
+                        'old_pairs: !!set {}\n'
+                        'players:\n'
+                        '  0: !player {aga_id: 1, division: 1, mm_init: 0, mm_score: [1, 0, 0],'
+                        ' name: A, rank: 1}\n'
+                        '  1: !player {aga_id: 2, division: 1, mm_init: 0, mm_score: [0, 0, 0],'
+                        ' name: B, rank: 1}\n'
+                        'rounds:\n'
+                        '- 1: !!python/object:mcmahon.Match {_winner: null, black: 1, white: 0}\n')
+        self.assertEqual(inflated.players[0].mm_score, [0, 0, 0])
+        self.assertEqual(inflated.verify_mm_score(), [])
+
     def test_new_round(self):
         self.tournament.start_new_round(self.pairing)
         # check that a round was generated and added to the list
@@ -453,6 +1862,324 @@ class TournamentTestCase(unittest.TestCase):
                                                   else match.black))
         self.assertTrue(self.tournament.round_is_finished(0))
 
+    def test_incremental_mm_score(self):
+        rng = random.Random(3)
+        for round_idx in range(4):
+            self.tournament.start_new_round(
+                self.tournament.generate_pairing(0, mode='matching'))
+            round_ = self.tournament.rounds[round_idx]
+            boards = list(round_.items())
+            rng.shuffle(boards)
+            for board, match in boards:
+                self.tournament.add_result(round_idx, board, rng.choice([match.white,
+                                                                         match.black]))
+            # correct one result, then clear and re-enter another
+            board, match = boards[0]
+            self.tournament.add_result(round_idx, board, match.white)
+            board, match = boards[1]
+            self.tournament.add_result(round_idx, board, None)
+            self.assertFalse(self.tournament.round_is_finished(round_idx))
+            self.assertEqual(self.tournament.verify_mm_score(), [])
+            self.tournament.add_result(round_idx, board, match.black)
+            self.assertEqual(self.tournament.verify_mm_score(), [])
+        self.tournament.players[0].mm_score[0] += 1
+        self.assertEqual(self.tournament.verify_mm_score(), [0])
+
+    def test_tiebreaks(self):
+        for round_idx in range(2):
+            self.tournament.start_new_round(
+                self.tournament.generate_pairing(0, mode='matching'))
+            for board, match in self.tournament.rounds[round_idx].items():
+                self.tournament.add_result(round_idx, board, match.white)
+        self.tournament.start_new_round(self.tournament.generate_pairing(0, mode='matching'))
+        values = self.tournament.tiebreaks()
+        for player_id, player in self.tournament.players.items():
+            self.assertEqual([values[name][player_id] for name in STANDINGS_ORDER],
+                             player.mm_score)
+            opponents = [match.black if match.white == player_id else match.white
+                         for round_ in self.tournament.rounds[:2]
+                         for match in round_.values() if player_id in (match.white, match.black)]
+            self.assertEqual(values['sosos'][player_id],
+                             sum(values['sos'][opponent] for opponent in opponents))
+        self.assertEqual(self.tournament.standings(list(STANDINGS_ORDER)),
+                         self.tournament.standings())
+        order = self.tournament.standings(['sosos', 'score'])
+        self.assertEqual([values['sosos'][k] for k in order],
+                         sorted(values['sosos'].values(), reverse=True))
+        with self.assertRaises(ValueError):
+            self.tournament.standings(['sos', 'rating'])
+
+    def test_write_wall(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.black)
+        self.tournament.start_new_round(self.tournament.generate_pairing(0, mode='matching'))
+        outputs = {}
+        for format in WALL_FORMATS:
+            h = io.StringIO()
+            self.tournament.write_wall(h, format)
+            outputs[format] = h.getvalue()
+        self.assertEqual(outputs['text'], self.tournament.wall_list() + '\n')
+        rows = list(csv.reader(io.StringIO(outputs['csv'])))
+        players = json.loads(outputs['json'])
+        self.assertEqual(len(rows), 21)
+        self.assertEqual(rows[0][-2:], ['Round 1', 'Round 2'])
+        self.assertEqual(outputs['html'].count('<tr>'), 21)
+        standings = self.tournament.standings()
+        self.assertEqual([player['id'] for player in players], standings)
+        place = {player_id: i for i, player_id in enumerate(standings, 1)}
+        for player in players:
+            match = [m for m in self.tournament.rounds[0].values()
+                     if player['id'] in (m.white, m.black)][0]
+            if player['id'] == match.black:
+                expected = '+B{}'.format(place[match.white])
+            else:
+                expected = '-W{}'.format(place[match.black])
+            self.assertEqual(player['results'], [expected, ''])
+            self.assertEqual(rows[player['place']][-2:], [expected, ''])
+        # the unfinished round is one blank column wide
+        self.assertEqual(outputs['text'].splitlines()[2].split('|')[-1],
+                         '{:15}'.format(players[0]['results'][0].rjust(5) + ' ' * 6))
+
+    def test_matching_pairing(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.white)
+        self.tournament.calculate_mm_score()
+        sampled = self.tournament.generate_pairing(100)
+        matched = self.tournament.generate_pairing(0, mode='matching')
+        self.assertEqual(sorted(matched), sorted(self.tournament.current_players))
+        self.assertTrue(self.tournament._pairing_is_valid(matched))
+        self.assertLessEqual(self.tournament.pairing_score(matched),
+                             self.tournament.pairing_score(sampled))
+        with self.assertRaises(ValueError):
+            self.tournament.generate_pairing(100, mode='bogus')
+
+    def test_anytime_pairing(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.white)
+        # forbid every neighbour in the standings, so the greedy start repeats
+        standings = [k for k in self.tournament.standings()
+                     if self.tournament.players[k].division == 1]
+        for first, second in zip(standings, standings[1:]):
+            self.tournament.forbid_pair(first, second)
+        local = self.tournament.generate_pairing(0, mode='anytime', seed=3)
+        self.assertEqual(sorted(local), sorted(self.tournament.current_players))
+        self.assertTrue(self.tournament._pairing_is_valid(local))
+        start = time.perf_counter()
+        bounded = self.tournament.generate_pairing(0, mode='anytime', seed=3, time_limit=0.2)
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertTrue(self.tournament._pairing_is_valid(bounded))
+        matched = self.tournament.generate_pairing(0, mode='matching')
+        self.assertLessEqual(self.tournament.pairing_score(bounded),
+                             self.tournament.pairing_score(local))
+        self.assertLessEqual(self.tournament.pairing_score(matched),
+                             self.tournament.pairing_score(bounded))
+        # with every pair forbidden there is no pairing without repeats; the
+        # time limit still holds
+        small = Tournament.new_tournament(
+            [Player('P{}'.format(i), 1, i, [0, 0, 0], 0, 1) for i in range(4)])
+        for first, second in itertools.combinations(range(4), 2):
+            small.forbid_pair(first, second)
+        start = time.perf_counter()
+        stuck = small.generate_pairing(0, mode='anytime', seed=3, time_limit=0.05)
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(sorted(stuck), [0, 1, 2, 3])
+
+    def test_find_players(self):
+        tournament = self.tournament
+        self.assertEqual(tournament.find_players('ma'), [0, 6, 16])
+        self.assertEqual(tournament.find_players('WANG'), [0])
+        self.assertEqual(tournament.find_players('ma w'), [0])
+        self.assertEqual(tournament.find_players('5723'), [4] + list(range(6, 20)))
+        tournament.add_player(Player('Zoë Åberg', 2, 777, [0, 0, 0], 0, 1))
+        tournament.add_player(Player('Dan Ho', 2, 778, [0, 0, 0], 0, 1))
+        self.assertEqual(tournament.find_players('aberg'), [20])
+        # a second index built from the players agrees with the maintained one
+        self.assertEqual(PlayerIndex(tournament.players.items()).keys,
+                         tournament.player_index().keys)
+        self.assertEqual(tournament.resolve_player('aga:777'), 20)
+        self.assertEqual(tournament.resolve_player('zoe'), 20)
+        self.assertEqual(tournament.resolve_player('3'), 3)
+        self.assertEqual(tournament.resolve_player('eD'), 7)
+        # the exact name picks Dan over Dan Ho
+        self.assertEqual(tournament.resolve_player('dan'), 12)
+        self.assertEqual(tournament.resolve_player('dan h'), 21)
+        self.assertRaises(ValueError, tournament.resolve_player, 'david')
+        self.assertRaises(KeyError, tournament.resolve_player, 'nobody')
+        self.assertRaises(KeyError, tournament.resolve_player, 22)
+        self.assertEqual(load(dump(tournament)).find_players('zoe'), [20])
+
+    def test_opponent_index(self):
+        index = OpponentIndex(3)
+        index.add(0, 2)
+        index.add(2, 0)
+        index.add(1, 20)
+        self.assertTrue(index.blocked(2, 0))
+        self.assertFalse(index.blocked(0, 1))
+        self.assertTrue(index.blocked(20, 1))
+        self.assertFalse(index.blocked(20, 0))
+        self.assertEqual(index.neighbors[0], [2])
+        self.assertEqual(index.neighbors[20], [1])
+
+    def test_forbid_pair(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.white)
+        # the round just played is blocked before generate_pairing adds it to
+        # old_pairs
+        played = [player for match in self.tournament.rounds[0].values()
+                  for player in (match.white, match.black)]
+        self.assertFalse(self.tournament._pairing_is_valid(played))
+        matched = self.tournament.generate_pairing(0, mode='matching')
+        self.tournament.forbid_pair(matched[0], matched[1])
+        self.assertFalse(self.tournament._pairing_is_valid(matched))
+        for mode in PAIRING_MODES:
+            self.assertTrue(self.tournament._pairing_is_valid(
+                self.tournament.generate_pairing(5000, mode=mode)))
+        self.assertEqual(yaml.load(yaml.dump(self.tournament), Loader=yaml.Loader),
+                         self.tournament)
+        self.tournament.allow_pair(matched[0], matched[1])
+        self.assertTrue(self.tournament._pairing_is_valid(matched))
+        with self.assertRaises(KeyError):
+            self.tournament.forbid_pair(0, 99)
+
+    def test_repair_round(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.white)
+        self.tournament.start_new_round(self.tournament.generate_pairing(0, mode='matching'))
+        round_ = self.tournament.rounds[1]
+        self.tournament.add_result(1, 1, round_[1].white)
+        before = dict(round_)
+        self.tournament._opponent_index()
+        self.tournament._game_index()
+        # one player drops, a late arrival joins division 1
+        dropped = round_[3].black
+        self.tournament.drop_player(dropped)
+        scores = [0, 0, 0]
+        self.tournament.add_player(Player('Late', 2, 999, scores, 6, 1))
+        self.assertEqual(scores, [0, 0, 0])
+        self.assertEqual(self.tournament.players[self.tournament.id_ctr - 1].mm_score, [6, 0, 0])
+        changed = self.tournament.repair_round()
+        self.assertIn(3, changed)
+        self.assertLessEqual(len(changed), 4)
+        self.assertEqual({board: round_[board] for board in before if board not in changed},
+                         {board: before[board] for board in before if board not in changed})
+        seated = [player for match in round_.values() for player in (match.white, match.black)]
+        self.assertEqual(sorted(seated), sorted(self.tournament.current_players))
+        for match in round_.values():
+            self.assertNotIn(frozenset([match.white, match.black]), self.tournament.old_pairs)
+        rebuilt = OpponentIndex(self.tournament.id_ctr)
+        for r in self.tournament.rounds:
+            for match in r.values():
+                rebuilt.add(match.white, match.black)
+        self.assertEqual(self.tournament._opponents.rows, rebuilt.rows)
+        self.assertEqual(self.tournament.repair_round(), [])
+
+        # both players of the open boards leave: the round is over and counts
+        for board, match in list(round_.items()):
+            if match.winner is None and board != 2:
+                self.tournament.add_result(1, board, match.black)
+        self.tournament.drop_player(round_[2].white)
+        self.tournament.drop_player(round_[2].black)
+        self.assertEqual(self.tournament.repair_round(), [2])
+        self.assertTrue(self.tournament.round_is_finished(1))
+        self.assertEqual(self.tournament.verify_mm_score(), [])
+        with self.assertRaises(RuntimeError):
+            self.tournament.repair_round()
+
+    def test_pairing_key(self):
+        key = self.tournament.pairing_key('anytime', 3)
+        self.assertEqual(key, Tournament.new_tournament(
+            [Player(p.name, p.rank, p.aga_id, [0, 0, 0], p.mm_init, p.division)
+             for p in self.tournament.players.values()]).pairing_key('anytime', 3))
+        self.assertNotEqual(key, self.tournament.pairing_key('anytime', 4))
+        self.assertNotEqual(key, self.tournament.pairing_key('random', 3))
+        self.tournament.forbid_pair(0, 1)
+        self.assertNotEqual(key, self.tournament.pairing_key('anytime', 3))
+
+    def test_warm_start(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.white)
+        best = self.tournament.generate_pairing(0, mode='matching')
+        warm = self.tournament.generate_pairing(0, mode='anytime', initial=list(best))
+        self.assertEqual(self.tournament.pairing_score(warm), self.tournament.pairing_score(best))
+
+    def test_parallel_pairing(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.black)
+        self.tournament.calculate_mm_score()
+        serial = self.tournament.generate_pairing(2500, seed=7)
+        parallel = self.tournament.generate_pairing(2500, seed=7, workers=2)
+        self.assertEqual(serial, parallel)
+        self.assertTrue(self.tournament._pairing_is_valid(parallel))
+        for mode in ('matching', 'anytime'):
+            self.assertEqual(self.tournament.generate_pairing(0, mode=mode, seed=7),
+                             self.tournament.generate_pairing(0, mode=mode, seed=7, workers=2))
+
+    def test_division_budgets(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.black)
+        uniform = self.tournament.generate_pairing(1500, seed=7)
+        # division 1 comes first whatever the budgets
+        per_division = self.tournament.generate_pairing({1: 1500, 2: 3}, seed=7)
+        self.assertEqual(per_division[:10], uniform[:10])
+        self.assertEqual(sorted(self.tournament.players[k].division for k in per_division),
+                         [1] * 10 + [2] * 10)
+        with self.assertRaises(ValueError):
+            self.tournament.generate_pairing({1: 1500}, seed=7)
+        start = time.perf_counter()
+        self.tournament.generate_pairing(0, mode='anytime', time_limit={1: 0.1, 2: 0.2})
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_batch_evaluator(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.white)
+        self.tournament.calculate_mm_score()
+        player_ids = sorted(self.tournament.current_players)
+        evaluator = BatchEvaluator(self.tournament, player_ids)
+        candidates = evaluator.sample(numpy.random.default_rng(0), 200)
+        scores, valid = evaluator.evaluate(candidates)
+        for candidate, score, is_valid in zip(candidates, scores, valid):
+            pairing = [player_ids[i] for i in candidate]
+            self.assertEqual(score, self.tournament.pairing_score(pairing))
+            self.assertEqual(is_valid, self.tournament._pairing_is_valid(pairing))
+
+    def test_instrument(self):
+        self.tournament.start_new_round(self.pairing)
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.white)
+        pairing = self.tournament.generate_pairing(2500, seed=7)
+        instrument = Instrument()
+        self.tournament.instrument = instrument
+        try:
+            self.assertEqual(self.tournament.generate_pairing(2500, seed=7), pairing)
+            self.tournament.wall_list()
+        finally:
+            del self.tournament.instrument
+        report = instrument.report()
+        self.assertEqual(report['phases']['generate_pairing']['calls'], 1)
+        self.assertEqual(report['phases']['random division 2']['calls'], 1)
+        self.assertEqual(report['phases']['wall_list']['calls'], 1)
+        self.assertEqual(report['counters']['candidates'], 2 * 2500)
+        self.assertTrue(0 < report['valid_fraction'] <= 1)
+        final = 0
+        for division in (1, 2):
+            scores = [best['score'] for best in report['best_over_time']
+                      if best['division'] == division]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+            final += scores[-1]
+        self.assertEqual(final, self.tournament.pairing_score(pairing))
+        self.tournament.generate_pairing(10, seed=7)
+        self.assertEqual(instrument.phases['generate_pairing'][0], 1)
+
 
 class HandiTournamentTestCase(unittest.TestCase):
 
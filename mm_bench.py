@@ -0,0 +1,253 @@
+#! /usr/bin/env python3
+# Benchmarks for mgamcmahon program
+#
+# Builds synthetic tournaments of a given size and times the pairing,
+# scoring, rendering, YAML persistence and export paths on them. Results are written
+# as JSON and can be compared with a stored baseline run:
+#
+#     python mm_bench.py --players 50 1000 10000 --output baseline.json
+#     python mm_bench.py --players 50 1000 10000 --baseline baseline.json
+
+import argparse
+import io
+import json
+import math
+import platform
+import random
+import sys
+import time
+import unittest
+
+import yaml
+
+import mcmahon
+import mm_export
+
+# rank distributions for synthetic_tournament; ranks use the numbering of
+# mm_import.parse_rank, 1d is 1 and 1k is 0
+RANK_DISTRIBUTIONS = ('uniform', 'normal')
+
+DEFAULT_PLAYERS = (50, 200, 1000)
+DEFAULT_SAMPLES = (10, 100, 1000)
+
+
+def synthetic_ranks(count, distribution, rng):
+    if distribution == 'uniform':
+        return [rng.randint(-29, 7) for i in range(count)]
+    if distribution == 'normal':
+        # club players around 5k, clipped to 30k..9d
+        return [max(-29, min(9, int(round(rng.gauss(-4, 6))))) for i in range(count)]
+    raise ValueError("'distribution' must be one of {}".format(', '.join(RANK_DISTRIBUTIONS)))
+
+
+def synthetic_tournament(players, divisions=1, rounds=3, distribution='normal', handi=False,
+                         seed=0):
+    # a tournament of players split evenly into divisions by rank, with rounds
+    # played out by pairing neighbours in the standings and letting the
+    # stronger player win more often. Every round but the last has results,
+    # so there are standings and a current round to show.
+    rng = random.Random(seed)
+    cls = mcmahon.HandiTournament if handi else mcmahon.Tournament
+    ranks = sorted(synthetic_ranks(players, distribution, rng), reverse=True)
+    # divisions hold an even number of players, the last one takes the rest
+    size = 2 * max(1, players // (2 * divisions))
+    tournament = cls.new_tournament(
+        [mcmahon.Player('Player {}'.format(i), rank, 10000 + i, [0, 0, 0], 0,
+                        min(i // size, divisions - 1) + 1)
+         for i, rank in enumerate(ranks)])
+    # the weakest player of a division with an odd count sits out, as a
+    # tournament director would give them a bye, so every division pairs
+    for division in range(1, divisions + 1):
+        members = [player_id for player_id in tournament.current_players
+                   if tournament.players[player_id].division == division]
+        if len(members) % 2:
+            tournament.drop_player(max(members))
+
+    for round_ in range(rounds):
+        pairing = []
+        for division in range(1, divisions + 1):
+            members = [player_id for player_id in tournament.current_players
+                       if tournament.players[player_id].division == division]
+            members.sort(key=lambda k: tournament.players[k].mm_score, reverse=True)
+            pairing.extend(members)
+        tournament.start_new_round(pairing)
+        if round_ == rounds - 1:
+            break
+        for board, match in tournament.rounds[round_].items():
+            rank_diff = tournament.players[match.white].rank - tournament.players[match.black].rank
+            white_wins = rng.random() < 1 / (1 + math.exp(-rank_diff / 2))
+            tournament.add_result(round_, board, match.white if white_wins else match.black)
+    return tournament
+
+
+def timed(function, repeat):
+    # best and median wall time of repeat calls, in seconds
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {'best': times[0], 'median': times[len(times) // 2], 'repeat': repeat}
+
+
+def benchmarks(tournament, samples):
+    # (name, function) for every timed operation on tournament
+    res = []
+    for sample_size in samples:
+        res.append(('generate_pairing[samples={}]'.format(sample_size),
+                    lambda sample_size=sample_size: tournament.generate_pairing(sample_size,
+                                                                                seed=0)))
+    res.append(('calculate_mm_score', tournament.calculate_mm_score))
+    res.append(('standings', tournament.standings))
+    res.append(('tiebreaks', tournament.tiebreaks))
+    res.append(('wall_list', tournament.wall_list))
+    res.append(('pairings_list', tournament.pairings_list))
+    res.append(('yaml_dump', lambda: yaml.dump(tournament)))
+    text = yaml.dump(tournament)
+    res.append(('yaml_load', lambda: yaml.load(text, Loader=yaml.Loader)))
+    res.append(('dump', lambda: mcmahon.dump(tournament)))
+    fast_text = mcmahon.dump(tournament)
+    res.append(('load', lambda: mcmahon.load(fast_text)))
+    res.append(('export_aga', lambda: mm_export.write_aga_results(io.StringIO(), tournament)))
+    res.append(('export_columns', lambda: mm_export.write_archive(io.BytesIO(),
+                                                                  [('bench', tournament)])))
+    return res
+
+
+def run(players=DEFAULT_PLAYERS, samples=DEFAULT_SAMPLES, divisions=1, rounds=3,
+        distribution='normal', handi=False, repeat=3, only=None, log=None):
+    # times every benchmark for each field size, returns the JSON report
+    results = {}
+    for count in players:
+        tournament = synthetic_tournament(count, divisions, rounds, distribution, handi)
+        for name, function in benchmarks(tournament, samples):
+            key = '{}[players={}]'.format(name, count)
+            if only is not None and not any(pattern in key for pattern in only):
+                continue
+            # one run is plenty once a single call takes seconds
+            result = timed(function, 1)
+            if result['best'] < 1 and repeat > 1:
+                result = timed(function, repeat)
+            results[key] = result
+            if log is not None:
+                log.write('{:60} {:10.4f}s\n'.format(key, result['best']))
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': mcmahon.numpy.__version__ if mcmahon.numpy else None,
+                     'yaml_libyaml': yaml.__with_libyaml__,
+                     'divisions': divisions, 'rounds': rounds, 'distribution': distribution,
+                     'handi': handi},
+            'results': results}
+
+
+def compare(report, baseline, threshold=1.25, min_delta=0.001):
+    # (key, baseline seconds, seconds, ratio) for benchmarks in both runs, and
+    # the keys that got slower than threshold times the baseline; slowdowns of
+    # less than min_delta seconds are timer noise
+    rows = []
+    regressions = []
+    for key, result in sorted(report['results'].items()):
+        if key not in baseline['results']:
+            continue
+        before = baseline['results'][key]['best']
+        ratio = result['best'] / before if before else float('inf')
+        rows.append((key, before, result['best'], ratio))
+        if ratio > threshold and result['best'] - before >= min_delta:
+            regressions.append(key)
+    return rows, regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Time pairing, scoring, rendering and YAML round trips on synthetic '
+                    'tournaments')
+    parser.add_argument('--players', '-p',
+                        type=int,
+                        nargs='+',
+                        default=list(DEFAULT_PLAYERS),
+                        help="Field sizes. Default is {}".format(
+                            ' '.join(str(n) for n in DEFAULT_PLAYERS)))
+    parser.add_argument('--samples', '-n',
+                        type=int,
+                        nargs='+',
+                        default=list(DEFAULT_SAMPLES),
+                        help="Sample sizes for generate_pairing. Default is {}".format(
+                            ' '.join(str(n) for n in DEFAULT_SAMPLES)))
+    parser.add_argument('--divisions', '-d', type=int, default=1,
+                        help="Default is 1")
+    parser.add_argument('--rounds', '-r', type=int, default=3,
+                        help="Rounds played, the last without results. Default is 3")
+    parser.add_argument('--ranks',
+                        choices=RANK_DISTRIBUTIONS,
+                        default='normal',
+                        help="Rank distribution. Default is 'normal'")
+    parser.add_argument('--handi', '-H', action="store_true", default=False,
+                        help="Use a handicap tournament")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs per benchmark under a second, the best is kept. "
+                             "Default is 3")
+    parser.add_argument('--only', nargs='+', default=None,
+                        help="Run only benchmarks whose name contains one of these")
+    parser.add_argument('--output', '-o', default=None,
+                        help="Write the JSON report here instead of standard output")
+    parser.add_argument('--baseline', '-b', default=None,
+                        help="JSON report to compare with; exits 1 on a regression")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="Slowdown against the baseline counted as a regression. "
+                             "Default is 1.25")
+    args = parser.parse_args(argv)
+
+    report = run(args.players, args.samples, args.divisions, args.rounds, args.ranks,
+                 args.handi, args.repeat, args.only, log=sys.stderr)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as h:
+            h.write(text + '\n')
+
+    if args.baseline is not None:
+        with open(args.baseline) as h:
+            baseline = json.load(h)
+        rows, regressions = compare(report, baseline, args.threshold)
+        sys.stderr.write('\n{:60} {:>10} {:>10} {:>7}\n'.format('Benchmark', 'Baseline', 'Now',
+                                                              'Ratio'))
+        for key, before, after, ratio in rows:
+            sys.stderr.write('{:60} {:10.4f} {:10.4f} {:6.2f}x{}\n'.format(
+                key, before, after, ratio, ' REGRESSION' if key in regressions else ''))
+        if regressions:
+            exit(1)
+
+
+class BenchTestCase(unittest.TestCase):
+
+    def test_synthetic_tournament(self):
+        tournament = synthetic_tournament(21, divisions=2, rounds=3)
+        self.assertEqual(len(tournament.players), 21)
+        self.assertEqual(sorted(set(p.division for p in tournament.players.values())), [1, 2])
+        self.assertEqual(len(tournament.rounds), 3)
+        self.assertTrue(tournament.round_is_finished(1))
+        self.assertFalse(tournament.round_is_finished(2))
+        self.assertEqual(tournament.verify_mm_score(), [])
+        self.assertEqual(yaml.dump(synthetic_tournament(21, divisions=2, rounds=3)),
+                         yaml.dump(tournament))
+        # the odd player out sits out, so every division can be paired
+        self.assertEqual(len(tournament.current_players), 20)
+        self.assertEqual(len(tournament.generate_pairing(50, seed=0)), 20)
+
+    def test_run_and_compare(self):
+        report = run(players=[20], samples=[50], repeat=1)
+        self.assertIn('wall_list[players=20]', report['results'])
+        self.assertIn('generate_pairing[samples=50][players=20]', report['results'])
+        slower = json.loads(json.dumps(report))
+        slower['results']['wall_list[players=20]']['best'] += 1
+        slower['results']['standings[players=20]']['best'] *= 2
+        rows, regressions = compare(slower, report)
+        self.assertEqual(len(rows), len(report['results']))
+        self.assertEqual(regressions, ['wall_list[players=20]'])
+        odd = run(players=[21], samples=[50], divisions=2, repeat=1)
+        self.assertIn('generate_pairing[samples=50][players=21]', odd['results'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,17 +2,82 @@
 # CLI interface for mgamcmahon program
 
 import argparse
+import cProfile
+import io
+import json
+import pstats
 import sys
 import os
 
-import yaml
+import mm_client
 
-import mcmahon
+# the tournament model and storage modules import PyYAML and numpy; they are
+# loaded by MMCli, so commands handed to a running daemon start quickly
+mcmahon = None
+mm_daemon = None
+mm_export = None
+mm_import = None
+mm_storage = None
+
+
+def load_modules():
+    global mcmahon, mm_daemon, mm_export, mm_import, mm_storage
+    import mcmahon
+    import mm_daemon
+    import mm_export
+    import mm_import
+    import mm_storage
+
+
+# output of mm_cli --profile: a phase summary or JSON report from
+# mcmahon.Instrument, or cProfile statistics
+PROFILE_MODES = ('summary', 'json', 'cprofile')
+
+
+def add_file_arguments(parser):
+    parser.add_argument('--filename', '-f',
+                        action="store",
+                        default="tournament.yaml",
+                        help="Default is 'tournament.yaml'")
+    parser.add_argument('--storage', '-s',
+                        action="store",
+                        choices=mm_storage.STORAGE_TYPES,
+                        default=None,
+                        help="'yaml' rewrites the file on every change, 'journal' appends "
+                             "changes to <filename>.journal, 'sqlite' updates single rows. "
+                             "Default is 'sqlite' for .db/.sqlite files, 'journal' when a "
+                             "journal exists, else 'yaml'")
+
+
+def player_id(store, key):
+    # internal ids are passed on as they are, aga:<AGA ID> and names are
+    # looked up, see mcmahon.PlayerIndex.resolve
+    if key.strip().isdigit():
+        return int(key)
+    return store.player_index().resolve(key)
+
+
+def division_values(parser, entries, type_):
+    # {division: value} from DIV=VALUE option entries
+    res = {}
+    for entry in entries:
+        division, _, value = entry.partition('=')
+        try:
+            res[int(division)] = type_(value)
+        except ValueError:
+            parser.error('expected DIV=VALUE, got {!r}'.format(entry))
+    return res
 
 
 class MMCli(object):
 
-    def __init__(self):
+    def __init__(self, argv=None, store=None):
+        # argv defaults to the command line; store replaces the one named by
+        # --filename/--storage, which is how mm_daemon serves commands
+        self.argv = sys.argv[1:] if argv is None else argv
+        self.store = store
+        self.instrument = None  # mcmahon.Instrument while running with --profile
+        load_modules()
 
         parser = argparse.ArgumentParser(
             description='CLI interface for mgamcmahon program',
@@ -20,12 +85,33 @@ class MMCli(object):
 
             Command options:
 
-            newround
-            show <[pairings], [standings]>
-            add-result <round#, board#, winner#>''')
+            newround [--mode <random, matching, anytime>] [--samples N] [--workers N] [--seed N]
+                     [--time-limit SECONDS] [--division-samples DIV=N]
+                     [--division-time-limit DIV=SECONDS]
+            show <[pairings], [standings]> [--format <text, csv, html, json>] [--out FILE]
+                 [--tiebreaks <score, sos, sodos, sosos> ...]
+            add-result <round#, board#, winner#>
+            forbid <player_id> <player_id> [--allow]
+            find <aga_id or name>
+            export [--format <aga, columns>] [--out FILE] [--name NAME] [--start DATE]
+            repair [--radius N]
+            addresults <file, - for stdin>
+            importplayers <file, - for stdin> [--column field=name]
+            rescore
+            compact
+            convert <source> <target>
+            serve
+
+            Any command takes --profile <summary, json, cprofile> [--profile-output FILE]''')
+
+        # --profile is accepted anywhere on the command line
+        profile_parser = argparse.ArgumentParser(add_help=False)
+        profile_parser.add_argument('--profile', choices=PROFILE_MODES, default=None)
+        profile_parser.add_argument('--profile-output', default=None)
+        profile_args, self.argv = profile_parser.parse_known_args(self.argv)
 
         parser.add_argument('command', help='Subcommand to run')
-        args = parser.parse_args(sys.argv[1:2])
+        args = parser.parse_args(self.argv[0:1])
         # simple way to get command names, but does not allow
         # dashes in name
         if not hasattr(self, args.command):
@@ -33,124 +119,503 @@ class MMCli(object):
             parser.print_help()
             exit(1)
         # tournament is not loaded until all args and subargs parsed
-        getattr(self, args.command)()
+        if profile_args.profile is None:
+            getattr(self, args.command)()
+        else:
+            self.profile(getattr(self, args.command), profile_args.profile,
+                         profile_args.profile_output)
+
+    def profile(self, command, mode, output):
+        # run command with mcmahon.Tournament.instrument set and the store's
+        # loads and saves timed, then report to output or stderr
+        self.instrument = mcmahon.Instrument()
+        mcmahon.Tournament.instrument = self.instrument
+        profiler = cProfile.Profile() if mode == 'cprofile' else None
+        try:
+            with self.instrument.phase('command'):
+                if profiler is None:
+                    command()
+                else:
+                    profiler.runcall(command)
+        finally:
+            mcmahon.Tournament.instrument = None
+            if mode == 'cprofile' and output is not None:
+                profiler.dump_stats(output)
+            else:
+                if mode == 'cprofile':
+                    text = io.StringIO()
+                    pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(30)
+                    text = text.getvalue()
+                elif mode == 'json':
+                    text = json.dumps(self.instrument.report(), indent=2, sort_keys=True) + '\n'
+                else:
+                    text = self.instrument.summary() + '\n'
+                if output is None:
+                    sys.stderr.write(text)
+                else:
+                    with open(output, 'w') as h:
+                        h.write(text)
+
+    def _store(self, args):
+        store = self.store
+        if store is None:
+            store = mm_storage.open_store(args.filename, args.storage)
+            store.show_cache = True
+        if self.instrument is not None:
+            for name in ('load', 'save', 'render'):
+                setattr(store, name, self.instrument.timed('store ' + name, getattr(store, name)))
+        return store
 
     def newround(self):
         parser = argparse.ArgumentParser(
             description='Generate new round')
-        parser.add_argument('--filename', '-f',
+        add_file_arguments(parser)
+        parser.add_argument('--mode', '-m',
+                            action="store",
+                            choices=mcmahon.PAIRING_MODES,
+                            default="random",
+                            help="'random' keeps the best of many shuffles, 'matching' "
+                                 "computes the optimal pairing, 'anytime' improves a greedy "
+                                 "pairing until --time-limit. Default is 'random'")
+        parser.add_argument('--samples', '-n',
+                            action="store",
+                            type=int,
+                            default=10000,
+                            help="Shuffles per division in random mode. Default is 10000")
+        parser.add_argument('--workers', '-w',
+                            action="store",
+                            type=int,
+                            default=1,
+                            help="Worker processes; divisions are paired concurrently. "
+                                 "Default is 1")
+        parser.add_argument('--seed',
+                            action="store",
+                            type=int,
+                            default=None,
+                            help="Random seed, gives the same pairing for any --workers")
+        parser.add_argument('--time-limit', '-t',
                             action="store",
-                            default="tournament.yaml",
-                            help="Default is 'tournament.yaml'")
-        args = parser.parse_args(sys.argv[2:])
+                            type=float,
+                            default=None,
+                            help="Seconds the anytime search may take, it returns the best "
+                                 "pairing found by then. Default stops at the first local "
+                                 "optimum")
+        parser.add_argument('--division-samples',
+                            action="append",
+                            default=[],
+                            metavar='DIV=N',
+                            help="Shuffles for one division, overrides --samples")
+        parser.add_argument('--division-time-limit',
+                            action="append",
+                            default=[],
+                            metavar='DIV=SECONDS',
+                            help="Time limit for one division on its own, overrides "
+                                 "--time-limit")
+        parser.add_argument('--no-cache',
+                            action="store_true",
+                            default=False,
+                            help="Ignore and do not update the pairings cached in "
+                                 "<filename>.pairings.json")
+        args = parser.parse_args(self.argv[1:])
+        division_samples = division_values(parser, args.division_samples, int)
+        division_time_limits = division_values(parser, args.division_time_limit, float)
+
+        store = self._store(args)
+        # other terminals wait to change the file until the round is saved
+        with store.locked():
+            tournament = store.load()
 
-        h = open(args.filename, 'r')
-        tournament = yaml.load(h.read())
-        h.close()
+            # with overrides every division gets its own budget, see
+            # Tournament.generate_pairing
+            samples = args.samples
+            time_limit = args.time_limit
+            divisions = set(tournament.players[k].division for k in tournament.current_players)
+            if division_samples:
+                samples = dict.fromkeys(divisions, args.samples)
+                samples.update(division_samples)
+            if division_time_limits:
+                time_limit = dict.fromkeys(divisions, args.time_limit)
+                time_limit.update(division_time_limits)
 
-        tournament.calculate_mm_score()
-        tournament.start_new_round(tournament.generate_pairing(10000))
-        h = open(args.filename, 'w')
-        h.write(yaml.dump(tournament))
-        h.close()
+            # the best pairing found for this exact state is reused as it is when
+            # it came from an exact matching or at least as many shuffles, else the
+            # anytime search starts from it and random sampling has to beat it
+            cache = None
+            entry = None
+            effort = 0
+            if args.mode == 'random':
+                effort = max(samples.values()) if division_samples else samples
+            if not args.no_cache:
+                cache = mm_storage.PairingCache(mm_storage.PairingCache.path(args.filename))
+                key = tournament.pairing_key(args.mode, args.seed)
+                entry = cache.get(key)
+            if entry is not None and (args.mode == 'matching' or
+                                      args.mode == 'random' and entry['samples'] >= effort):
+                pairing = list(entry['pairing'])
+            else:
+                initial = None
+                if entry is not None and args.mode == 'anytime':
+                    initial = entry['pairing']
+                pairing = tournament.generate_pairing(samples, mode=args.mode, seed=args.seed,
+                                                      workers=args.workers, time_limit=time_limit,
+                                                      initial=initial)
+            if cache is not None:
+                if division_samples:
+                    effort = min(samples.values())
+                entry = cache.put(key, pairing, tournament.pairing_score(pairing), effort)
+                pairing = list(entry['pairing'])
+                cache.save()
+            store.apply(tournament, 'start_new_round', pairing)
 
     def show(self):
         parser = argparse.ArgumentParser(
             description='Print out pairings or standings')
-        parser.add_argument('--filename', '-f',
-                            action="store",
-                            default="tournament.yaml",
-                            help="Default is 'tournament.yaml'")
+        add_file_arguments(parser)
         parser.add_argument('output',
                             choices=['pairings', 'standings'])
-        args = parser.parse_args(sys.argv[2:])
-
-        h = open(args.filename, 'r')
-        tournament = yaml.load(h.read())
-        h.close()
-        tournament.calculate_mm_score()
+        parser.add_argument('--tiebreaks',
+                            nargs='+',
+                            choices=mcmahon.TIEBREAKS,
+                            default=None,
+                            help="Standings order, compared in turn. Default is {}".format(
+                                ' '.join(mcmahon.STANDINGS_ORDER)))
+        parser.add_argument('--format',
+                            choices=mcmahon.WALL_FORMATS,
+                            default='text',
+                            help="Standings format. Default is 'text'")
+        parser.add_argument('--out',
+                            default=None,
+                            help="Write the standings to this file instead of standard output")
+        args = parser.parse_args(self.argv[1:])
+        if args.output == 'pairings' and (args.format != 'text' or args.out is not None):
+            parser.error('--format and --out only apply to standings')
 
+        store = self._store(args)
+        if (self.store is None and args.tiebreaks is None and
+                args.output not in store.row_render):
+            # the cache was missing or stale, see show_from_cache; stamped
+            # with the files as loaded, a write in between leaves it stale.
+            # Row-level mutations leave it stale on purpose, and a store that
+            # renders this output from a few rows skips the rebuild
+            stamp = mm_storage.show_cache_stamp(args.filename)
+            mm_storage.write_show_cache(args.filename, store.load(), stamp)
+            if show_from_cache(self.argv[1:]):
+                return
         if args.output == 'pairings':
-#            for round_ in tournament.rounds:
-#                print(round_)
-            print(tournament.pairings_list())
+            print(store.render(args.output))
+        elif args.out is None:
+            store.render(args.output, args.tiebreaks, args.format, sys.stdout)
         else:
-            print(tournament.wall_list())
+            with open(args.out, 'w') as h:
+                store.render(args.output, args.tiebreaks, args.format, h)
 
     def addresult(self):
         parser = argparse.ArgumentParser(
-            description='Add a result. Round#, Board#, Winner#')
-        parser.add_argument('--filename', '-f',
-                            action="store",
-                            default="tournament.yaml",
-                            help="Default is 'tournament.yaml'")
+            description='Add a result. Round#, Board#, Winner#; the winner may also be '
+                        'aga:<AGA ID> or a name')
+        add_file_arguments(parser)
         parser.add_argument('result', nargs='*')
         #haven't figured out why nargs 3 or 5 doesn't work
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv[1:])
         print(args)
 
-        h = open(args.filename, 'r')
-        tournament = yaml.load(h.read())
-        h.close()
-        tournament.calculate_mm_score()
+        store = self._store(args)
         if args.result:
             round_ = int(args.result[0]) - 1
             board = int(args.result[1])
-            winner = int(args.result[2])
-            tournament.add_result(round_, board, winner)
-            h = open(args.filename, 'w')
-            h.write(yaml.dump(tournament))
-            h.close()
+            winner = player_id(store, ' '.join(args.result[2:]))
+            store.mutate('add_result', round_, board, winner)
+
+    def addresults(self):
+        parser = argparse.ArgumentParser(
+            description='Add many results at once, one "round# board# winner#" per line, '
+                        'separated by spaces or commas; the winner may also be aga:<AGA ID> '
+                        'or a one word name. Lines that fail are reported and skipped, the '
+                        'rest are saved together')
+        add_file_arguments(parser)
+        parser.add_argument('results',
+                            type=argparse.FileType('r'),
+                            help="File of results, '-' reads standard input")
+        args = parser.parse_args(self.argv[1:])
+
+        store = self._store(args)
+        lines = []
+        results = []
+        errors = []
+        for line_number, line in enumerate(args.results, 1):
+            fields = line.split('#')[0].replace(',', ' ').split()
+            if not fields:
+                continue
+            try:
+                round_, board, winner = fields
+                round_, board, winner = int(round_), int(board), player_id(store, winner)
+                if round_ < 1:
+                    raise ValueError('round numbers start at 1')
+            except (KeyError, ValueError) as e:
+                errors.append((line_number, '{}: {}'.format(type(e).__name__, e)))
+                continue
+            lines.append(line_number)
+            results.append((round_ - 1, board, winner))
+
+        added = 0
+        for line_number, error in zip(lines, store.mutate_many('add_result', results)):
+            if error is None:
+                added += 1
+            else:
+                errors.append((line_number, '{}: {}'.format(type(error).__name__, error)))
+        for line_number, error in sorted(errors):
+            print('line {}: {}'.format(line_number, error))
+        print('Added {} of {} results'.format(added, added + len(errors)))
+        if errors:
+            exit(1)
 
     def addplayer(self):
         parser = argparse.ArgumentParser(
             description='Add a player. Name, rank, AGA ID, division')
-        parser.add_argument('--filename', '-f',
-                            action="store",
-                            default="tournament.yaml",
-                            help="Default is 'tournament.yaml'")
+        add_file_arguments(parser)
         parser.add_argument('player', nargs='*')
         #haven't figured out why nargs 3 or 5 doesn't work
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv[1:])
 
-        h = open(args.filename, 'r')
-        tournament = yaml.load(h.read())
-        h.close()
-        tournament.calculate_mm_score()
+        store = self._store(args)
         if args.player:
             name = args.player[0]
             rank = int(args.player[1])
             aga_id = int(args.player[2])
             division = int(args.player[3])
             player = mcmahon.Player(name, rank, aga_id, [0, 0, 0], 0, division)
-            tournament.add_player(player)
-            h = open(args.filename, 'w')
-            h.write(yaml.dump(tournament))
-            h.close()
+            store.mutate('add_player', player)
             print('Player {} successfully added'.format(player))
 
+    def importplayers(self):
+        parser = argparse.ArgumentParser(
+            description='Register players from a CSV or TSV file with a header row. Rows '
+                        'that fail or repeat an AGA ID are reported and skipped, the rest '
+                        'are saved together')
+        add_file_arguments(parser)
+        parser.add_argument('players',
+                            type=argparse.FileType('r'),
+                            help="File of players, '-' reads standard input")
+        parser.add_argument('--column', '-c',
+                            action="append",
+                            default=[],
+                            metavar='FIELD=NAME',
+                            help="Column holding a field, for fields {}. Default is the "
+                                 "field name; division defaults to 1 and mm_init to 0 "
+                                 "without a column. Ranks are numbers or like 3d, 5k"
+                                 .format(', '.join(sorted(mm_import.COLUMNS))))
+        args = parser.parse_args(self.argv[1:])
+
+        columns = {}
+        for mapping in args.column:
+            field, _, name = mapping.partition('=')
+            if field not in mm_import.COLUMNS or not name:
+                parser.error('--column must be FIELD=NAME for fields {}'
+                             .format(', '.join(sorted(mm_import.COLUMNS))))
+            columns[field] = name
+
+        store = self._store(args)
+        with store.locked():
+            tournament = store.load()
+            added, errors = mm_import.import_players(
+                tournament, mm_import.read_players(args.players, columns))
+            if added:
+                store.save(tournament)
+        for line_number, error in errors:
+            print('line {}: {}: {}'.format(line_number, type(error).__name__, error))
+        print('Added {} of {} players'.format(added, added + len(errors)))
+        if errors:
+            exit(1)
+
     def drop_player(self):
         parser = argparse.ArgumentParser(
-            description='Drop a player by player ID')
-        parser.add_argument('--filename', '-f',
-                            action="store",
-                            default="tournament.yaml",
-                            help="Default is 'tournament.yaml'")
+            description='Drop a player by player ID, aga:<AGA ID> or name')
+        add_file_arguments(parser)
         parser.add_argument('player_id', nargs='*')
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv[1:])
 
-        h = open(args.filename, 'r')
-        tournament = yaml.load(h.read())
-        h.close()
-        tournament.calculate_mm_score()
+        store = self._store(args)
         if args.player_id:
-            player_id = int(args.player_id[0])
-            tournament.drop_player(player_id)
-            player = tournament.players[player_id]
-            h = open(args.filename, 'w')
-            h.write(yaml.dump(tournament))
-            h.close()
-            print('Player {}: {} successfully dropped'.format(player_id, player))
+            dropped = player_id(store, ' '.join(args.player_id))
+            store.mutate('drop_player', dropped)
+            player = store.player(dropped)
+            print('Player {}: {} successfully dropped'.format(dropped, player))
+
+    def forbid(self):
+        parser = argparse.ArgumentParser(
+            description='Never pair two players, e.g. from the same family or club')
+        add_file_arguments(parser)
+        parser.add_argument('players', nargs=2, metavar='player_id',
+                            help="Player ID, aga:<AGA ID> or name")
+        parser.add_argument('--allow',
+                            action="store_true",
+                            default=False,
+                            help="Lift an earlier forbid instead")
+        args = parser.parse_args(self.argv[1:])
+
+        store = self._store(args)
+        players = [player_id(store, key) for key in args.players]
+        if args.allow:
+            store.mutate('allow_pair', *players)
+            print('Players {} and {} may be paired again'.format(*players))
+        else:
+            store.mutate('forbid_pair', *players)
+            print('Players {} and {} will not be paired'.format(*players))
+
+    def find(self):
+        parser = argparse.ArgumentParser(
+            description='Find players by AGA ID, or by the start of their name or of any '
+                        'word in it, ignoring case and accents')
+        add_file_arguments(parser)
+        parser.add_argument('query', nargs='+')
+        args = parser.parse_args(self.argv[1:])
+
+        store = self._store(args)
+        found = store.player_index().find(' '.join(args.query))
+        for key in found:
+            player = store.player(key)
+            print('{:>5}  {:30} rank {:>3}  aga_id {:>6}  division {}'.format(
+                key, player.name, player.rank, player.aga_id, player.division))
+        if not found:
+            print('No players match {!r}'.format(' '.join(args.query)))
+            exit(1)
+
+    def repair(self):
+        parser = argparse.ArgumentParser(
+            description='Re-pair the current round after players dropped or joined, '
+                        'changing as few boards as possible')
+        add_file_arguments(parser)
+        parser.add_argument('--radius', '-r',
+                            action="store",
+                            type=int,
+                            default=mcmahon.REPAIR_RADIUS,
+                            help="Boards either side of each unseated player that may be "
+                                 "re-paired at first. Default is {}".format(
+                                     mcmahon.REPAIR_RADIUS))
+        args = parser.parse_args(self.argv[1:])
+
+        store = self._store(args)
+        with store.locked():
+            tournament = store.load()
+            try:
+                changed = store.apply(tournament, 'repair_round', args.radius)
+            except RuntimeError as e:
+                # an odd number of unseated players in a division
+                print('Cannot repair round {}: {}. Add or drop a player in that division and '
+                      'run repair again'.format(len(tournament.rounds), e))
+                exit(1)
+        if not changed:
+            print('No boards to repair')
+            return
+        round_ = tournament.rounds[-1]
+        for board in changed:
+            if board in round_:
+                match = round_[board]
+                print('Board {}: {} - {}'.format(board, tournament.players[match.white].name,
+                                                 tournament.players[match.black].name))
+            else:
+                print('Board {}: removed'.format(board))
+
+    def rescore(self):
+        parser = argparse.ArgumentParser(
+            description='Recompute all MM scores from the recorded rounds')
+        add_file_arguments(parser)
+        args = parser.parse_args(self.argv[1:])
+
+        store = self._store(args)
+        with store.locked():
+            tournament = store.load()
+            fixed = tournament.verify_mm_score()
+            if fixed:
+                store.save(tournament)
+        if fixed:
+            print('Corrected MM scores of players {}'.format(fixed))
+        else:
+            print('All MM scores are up to date')
+
+    def compact(self):
+        parser = argparse.ArgumentParser(
+            description='Fold the journal into a new snapshot')
+        add_file_arguments(parser)
+        args = parser.parse_args(self.argv[1:])
+
+        store = self._store(args)
+        if not isinstance(store, mm_storage.JournalStore):
+            print('{} has no journal to compact'.format(args.filename))
+            return
+        with store.locked():
+            store.compact(store.load())
+        print('Journal compacted into {}'.format(args.filename))
+
+    def convert(self):
+        parser = argparse.ArgumentParser(
+            description='Copy a tournament between storage backends, e.g. YAML to SQLite')
+        parser.add_argument('source')
+        parser.add_argument('target')
+        parser.add_argument('--target-storage',
+                            action="store",
+                            choices=mm_storage.STORAGE_TYPES,
+                            default=None,
+                            help="Default is 'sqlite' for .db/.sqlite files, else 'yaml'")
+        args = parser.parse_args(self.argv[1:])
+
+        if os.path.isfile(args.target):
+            raise RuntimeError('File {} already exists!'.format(args.target))
+        tournament = mm_storage.open_store(args.source).load()
+        mm_storage.open_store(args.target, args.target_storage).save(tournament)
+        print('Tournament {} written to {}'.format(args.source, args.target))
+
+    def serve(self):
+        parser = argparse.ArgumentParser(
+            description='Keep the tournament in memory and serve mm_cli commands for it '
+                        'over <filename>.sock until interrupted')
+        add_file_arguments(parser)
+        args = parser.parse_args(self.argv[1:])
+
+        # commands run in each client's working directory, see
+        # mm_daemon.TournamentDaemon.execute
+        filename = os.path.abspath(args.filename)
+        store = mm_storage.open_store(filename, args.storage)
+        store.show_cache = True
+        path = mm_client.socket_path(filename)
+        print('Serving {} on {}'.format(args.filename, path))
+        mm_daemon.serve(store, path, MMCli)
+
+    def export(self):
+        parser = argparse.ArgumentParser(
+            description='Export the tournament as an AGA results file or a columnar archive, '
+                        'see mm_export.py for archives of many events')
+        add_file_arguments(parser)
+        parser.add_argument('--format',
+                            choices=mm_export.EXPORT_FORMATS,
+                            default='aga',
+                            help="Default is 'aga'")
+        parser.add_argument('--out', '-o', default=None,
+                            help="Output file, required for 'columns'. Default is standard "
+                                 "output")
+        parser.add_argument('--name', default=None,
+                            help="Tournament name in the AGA header. Default is the file name")
+        parser.add_argument('--start', default=None,
+                            help="Start date for the AGA header, e.g. 2026-10-16")
+        parser.add_argument('--finish', default=None,
+                            help="Finish date for the AGA header")
+        args = parser.parse_args(self.argv[1:])
+
+        store = self._store(args)
+        tournament = store.load()
+        name = os.path.splitext(os.path.basename(args.filename))[0]
+        if args.format == 'columns':
+            if args.out is None:
+                parser.error('--out is required for the columns format')
+            with open(args.out, 'wb') as h:
+                mm_export.write_archive(h, [(name, tournament)])
+        elif args.out is None:
+            mm_export.write_aga_results(sys.stdout, tournament, args.name or name, args.start,
+                                        args.finish)
+        else:
+            with open(args.out, 'w') as h:
+                mm_export.write_aga_results(h, tournament, args.name or name, args.start,
+                                            args.finish)
 
     def newtournament(self):
         parser = argparse.ArgumentParser(
@@ -159,11 +624,8 @@ class MMCli(object):
                             action="store_true",
                             default=False,
                             help="Make tournament handicapped")
-        parser.add_argument('--filename', '-f',
-                            action="store",
-                            default="tournament.yaml",
-                            help="Default is 'tournament.yaml'")
-        args = parser.parse_args(sys.argv[2:])
+        add_file_arguments(parser)
+        args = parser.parse_args(self.argv[1:])
 
         if os.path.isfile(args.filename):
             raise RuntimeError('File {} already exists!'.format(args.filename))
@@ -173,10 +635,59 @@ class MMCli(object):
         else:
             tournament = mcmahon.Tournament.new_tournament()
 
-        h = open(args.filename, 'w')
-        h.write(yaml.dump(tournament))
-        h.close()
+        store = mm_storage.open_store(args.filename, args.storage)
+        store.save(tournament)
         print('New tournament started and written to {}'.format(args.filename))
 
+def show_from_cache(argv):
+    # print what show would from the cache the mutating commands keep next to
+    # the tournament file, without loading it or the tournament model. Returns
+    # False when the cache is out of date or the arguments need the model
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('output')
+    parser.add_argument('--filename', '-f', default="tournament.yaml")
+    parser.add_argument('--storage', '-s', default=None)
+    parser.add_argument('--format', default='text')
+    parser.add_argument('--out', default=None)
+    try:
+        args, rest = parser.parse_known_args(argv)
+    except SystemExit:
+        return False
+    if rest:
+        return False
+    text = mm_client.read_show_cache(args.filename, args.output, args.format)
+    if text is None:
+        return False
+    if args.out is None:
+        sys.stdout.write(text)
+    else:
+        with open(args.out, 'w') as h:
+            h.write(text)
+    return True
+
+
+def main(argv):
+    # hand the command to a running daemon for the same file, if any
+    if argv and argv[0] not in mm_client.LOCAL_COMMANDS:
+        file_parser = argparse.ArgumentParser(add_help=False)
+        file_parser.add_argument('--filename', '-f', default="tournament.yaml")
+        file_args, rest = file_parser.parse_known_args(argv[1:])
+        stdin = None
+        if argv[0] in mm_client.STDIN_COMMANDS and '-' in rest:
+            # the daemon cannot read our standard input, pass it along
+            stdin = sys.stdin.read()
+        response = mm_client.send(mm_client.socket_path(file_args.filename), argv, stdin=stdin)
+        if response is not None:
+            status, output = response
+            sys.stdout.write(output)
+            exit(status)
+        if stdin is not None:
+            # no daemon after all, the command reads what was consumed
+            sys.stdin = io.StringIO(stdin)
+    if argv and argv[0] == 'show' and show_from_cache(argv[1:]):
+        return
+    MMCli(argv)
+
+
 if __name__ == '__main__':
-    MMCli()
+    main(sys.argv[1:])
@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+# Client side of the mgamcmahon tournament daemon (see mm_daemon)
+#
+# Only uses the standard library, so that mm_cli can hand a command to a
+# running daemon, or print standings from the display cache, without
+# importing the tournament model.
+
+import hashlib
+import json
+import os
+import socket
+
+# commands that must run in the client process, not in the daemon
+LOCAL_COMMANDS = ('serve', 'newtournament', 'convert', 'compact', 'export')
+
+# commands that only read the tournament; the daemon runs them while it is
+# saving
+READ_ONLY_COMMANDS = ('show', 'find')
+
+# commands that take '-' as a file argument to read standard input
+STDIN_COMMANDS = ('addresults', 'importplayers')
+
+
+def socket_path(filename):
+    return filename + '.sock'
+
+
+def send(path, argv, timeout=None, stdin=None):
+    # run a command in the daemon listening on path, returns (status, output)
+    # or None when no daemon is running. stdin is text the command reads as
+    # its standard input. The command runs in our working directory, where
+    # relative paths in argv are resolved
+    if not os.path.exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # stale socket left behind by a daemon that died
+        client.close()
+        return None
+    with client, client.makefile('rwb') as h:
+        request = {'argv': list(argv), 'cwd': os.getcwd()}
+        if stdin is not None:
+            request['stdin'] = stdin
+        h.write((json.dumps(request) + '\n').encode())
+        h.flush()
+        response = json.loads(h.readline().decode())
+    return response['status'], response['output']
+
+
+def show_cache_path(filename):
+    return filename + '.show.json'
+
+
+def file_stats(filename):
+    # [name, mtime, size] of the tournament file and the journal or SQLite
+    # write-ahead log next to it, which change with it
+    res = []
+    for name in (filename, filename + '.journal', filename + '-wal'):
+        try:
+            stat = os.stat(name)
+        except FileNotFoundError:
+            continue
+        res.append([os.path.basename(name), stat.st_mtime_ns, stat.st_size])
+    return res
+
+
+def file_digest(filename):
+    # sha256 of the contents of the files in file_stats
+    digest = hashlib.sha256()
+    for name, mtime, size in file_stats(filename):
+        with open(os.path.join(os.path.dirname(filename), name), 'rb') as h:
+            for block in iter(lambda: h.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def read_show_cache(filename, output, format='text'):
+    # the text mm_cli show prints for output ('pairings' or 'standings') in
+    # format, from the cache mm_storage.write_show_cache keeps next to
+    # filename, or None when it is missing or the file changed since. The file
+    # is only hashed when its mtime or size differ from the cached ones
+    try:
+        with open(show_cache_path(filename)) as h:
+            cache = json.load(h)
+        text = cache['outputs'][output][format]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if cache['stats'] != file_stats(filename) and cache['sha256'] != file_digest(filename):
+        return None
+    return text
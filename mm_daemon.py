@@ -0,0 +1,306 @@
+#! /usr/bin/env python3
+# Tournament daemon for mgamcmahon program
+#
+# Keeps one tournament in memory and runs mm_cli commands against it over a
+# unix socket, so score keepers do not pay for loading the file on every
+# command. The protocol is one JSON object per line each way:
+#     request  {"argv": ["addresult", "2", "7", "13"], "cwd": "/home/td"}
+#     request  {"argv": ["addresults", "-"], "stdin": "2 7 13\n2 8 4\n"}
+#     response {"status": 0, "output": "..."}
+# Commands run one at a time on the event loop, so mutations are serialized.
+# Changes are written to the backing store in the background, in a worker
+# thread, coalescing bursts of results into one save or one journal append.
+
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import unittest
+
+import mcmahon
+import mm_client
+import mm_storage
+
+
+class MemoryStore(mm_storage.YamlStore):
+    # serves the in-memory tournament; changes are kept as journal entries
+    # for the daemon to persist to the backing store
+
+    # commands are run one at a time, there is nothing to coalesce
+    coalesce = False
+
+    def __init__(self, backing, log=None):
+        mm_storage.YamlStore.__init__(self, backing.filename)
+        self.backing = backing
+        self.log = sys.stderr.write if log is None else log
+        # the files as loaded, to notice writers that bypass the daemon
+        self.stamp = mm_storage.show_cache_stamp(backing.filename)
+        self.tournament = backing.load()
+        self.entries = []  # changes not yet persisted
+        self.full = False  # set by save, the changes cannot be replayed
+        self.changed = None  # asyncio.Event set by the daemon
+        self.flushing = threading.Lock()  # one flush at a time, e.g. at shutdown
+
+    @property
+    def dirty(self):
+        return self.full or bool(self.entries)
+
+    def load(self):
+        return self.tournament
+
+    def save(self, tournament):
+        self.full = True
+        self._record(tournament, None)
+
+    def locked(self):
+        # the file is only written by flush, under the backing store's lock
+        return contextlib.nullcontext()
+
+    def _entry(self, op, args):
+        return mm_storage.journal_entry(op, args)
+
+    def _record(self, tournament, entry):
+        self._record_many(tournament, [entry])
+
+    def _record_many(self, tournament, entries):
+        self.entries.extend(entry for entry in entries if entry is not None)
+        if self.changed is not None:
+            self.changed.set()
+
+    def flush(self):
+        # persist the changes: appended to a journal backing, else a full
+        # save. When another process wrote the files since they were loaded,
+        # the changes are replayed on its version instead of overwriting it;
+        # changes that cannot be replayed are kept back and reported
+        with self.flushing, self.backing.locked():
+            if not self.dirty:
+                return
+            if (mm_client.file_stats(self.filename) != self.stamp['stats'] and
+                    mm_client.file_digest(self.filename) != self.stamp['sha256']):
+                if self.full:
+                    self.log('{} changed on disk; the daemon has changes it cannot merge and '
+                             'did not overwrite it\n'.format(self.filename))
+                    return
+                tournament = self.backing.load()
+                for entry in self.entries:
+                    try:
+                        mm_storage.replay(tournament, entry)
+                    except Exception as e:
+                        self.log('{} changed on disk; dropped {} {}: {}: {}\n'.format(
+                            self.filename, entry['op'], entry['args'], type(e).__name__, e))
+                self.tournament = tournament
+                self.backing.save(tournament)
+            elif isinstance(self.backing, mm_storage.JournalStore) and not self.full:
+                self.backing._record_many(self.tournament, self.entries)
+            else:
+                self.backing.save(self.tournament)
+            self.entries = []
+            self.full = False
+            self.stamp = mm_storage.show_cache_stamp(self.filename)
+
+
+class TournamentDaemon(object):
+
+    def __init__(self, store, path, command, flush_delay=0.2):
+        # command is called as command(argv, store), e.g. mm_cli.MMCli
+        self.store = MemoryStore(store)
+        self.path = path
+        self.command = command
+        self.flush_delay = flush_delay
+
+    def execute(self, argv, stdin=None, cwd=None):
+        # run one command against the in-memory store, returns (status, output).
+        # cwd is the client's working directory; the command runs there, so
+        # relative paths such as --out mean what they do to the client. The
+        # store's own paths are absolute and do not depend on it
+        if not argv or argv[0] in mm_client.LOCAL_COMMANDS:
+            return 1, 'Command must be run without the daemon\n'
+        output = io.StringIO()
+        status = 0
+        saved_stdin = sys.stdin
+        sys.stdin = io.StringIO(stdin or '')
+        saved_cwd = os.getcwd()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                if cwd is not None:
+                    os.chdir(cwd)
+                self.command(argv, self.store)
+            except SystemExit as e:
+                # argparse usage errors and unknown commands
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                print('{}: {}'.format(type(e).__name__, e))
+                status = 1
+            finally:
+                sys.stdin = saved_stdin
+                os.chdir(saved_cwd)
+        return status, output.getvalue()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode())
+                    argv = request['argv']
+                    if argv and argv[0] in mm_client.READ_ONLY_COMMANDS:
+                        status, output = self.execute(argv, request.get('stdin'),
+                                                      request.get('cwd'))
+                    else:
+                        # changes wait for a save in progress to finish
+                        async with self.lock:
+                            status, output = self.execute(argv, request.get('stdin'),
+                                                          request.get('cwd'))
+                except (ValueError, KeyError, TypeError):
+                    status, output = 1, 'Malformed request\n'
+                writer.write((json.dumps({'status': status, 'output': output}) + '\n').encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def persist(self):
+        while True:
+            await self.store.changed.wait()
+            # let a burst of changes accumulate before writing
+            await asyncio.sleep(self.flush_delay)
+            self.store.changed.clear()
+            # saved off the event loop, so commands that only read keep being
+            # answered while a large tournament is written
+            async with self.lock:
+                await asyncio.get_running_loop().run_in_executor(None, self.store.flush)
+
+    async def run(self):
+        self.store.changed = asyncio.Event()
+        self.lock = asyncio.Lock()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        persister = asyncio.ensure_future(self.persist())
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            persister.cancel()
+            self.store.flush()
+            os.unlink(self.path)
+
+
+def serve(store, path, command):
+    # run a daemon for store on the unix socket path until SIGINT/SIGTERM
+    asyncio.run(TournamentDaemon(store, path, command).run())
+
+
+def _echo_command(argv, store):
+    # stands in for mm_cli.MMCli in the tests
+    if argv[0] == 'drop':
+        store.mutate('drop_player', int(argv[1]))
+    elif argv[0] == 'touch':
+        open(argv[1], 'w').close()
+    elif argv[0] == 'dropmany':
+        errors = store.mutate_many('drop_player', [(int(line),) for line in sys.stdin])
+        print([type(e).__name__ for e in errors])
+    print(sorted(store.load().current_players))
+
+
+class TournamentDaemonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'tournament.yaml')
+        tournament = mcmahon.Tournament.new_tournament(
+            [mcmahon.Player('P{}'.format(i), 1, i, [0, 0, 0], 0, 1) for i in range(4)])
+        self.backing = mm_storage.YamlStore(self.filename)
+        self.backing.save(tournament)
+        self.path = mm_client.socket_path(self.filename)
+        self.daemon = TournamentDaemon(self.backing, self.path, _echo_command, flush_delay=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_execute(self):
+        self.assertEqual(self.daemon.execute(['drop', '2']), (0, '[0, 1, 3]\n'))
+        self.assertEqual(self.daemon.execute(['drop', '2']), (1, 'KeyError: 2\n'))
+        self.assertEqual(self.daemon.execute(['serve'])[0], 1)
+        # relative paths are the client's
+        cwd = os.getcwd()
+        self.daemon.execute(['touch', 'out.txt'], cwd=self.directory)
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, 'out.txt')))
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(self.daemon.execute(['touch', 'out.txt'],
+                                             cwd=os.path.join(self.directory, 'none'))[0], 1)
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(self.daemon.execute(['dropmany'], '0\n2\n'),
+                         (0, "['NoneType', 'KeyError']\n[1, 3]\n"))
+        self.assertTrue(self.daemon.store.dirty)
+        self.assertEqual(self.backing.load().current_players, {0, 1, 2, 3})
+        self.daemon.store.flush()
+        self.assertEqual(self.backing.load().current_players, {1, 3})
+
+    def test_journal_backing(self):
+        # a flush appends the changes instead of writing a snapshot
+        backing = mm_storage.JournalStore(self.filename)
+        backing.save(self.backing.load())
+        snapshot = os.stat(self.filename).st_mtime_ns
+        store = MemoryStore(backing)
+        store.mutate('drop_player', 1)
+        store.mutate('drop_player', 2)
+        store.flush()
+        self.assertEqual(os.stat(self.filename).st_mtime_ns, snapshot)
+        self.assertEqual(mm_storage.JournalStore(self.filename).load().current_players, {0, 3})
+
+    def test_changed_on_disk(self):
+        # a write that bypassed the daemon is kept and the changes replayed on it
+        log = []
+        store = MemoryStore(self.backing, log.append)
+        store.mutate('drop_player', 1)
+        store.mutate('drop_player', 3)
+        outside = self.backing.load()
+        outside.drop_player(3)
+        outside.add_player(mcmahon.Player('P4', 1, 4, [0, 0, 0], 0, 1))
+        self.backing.save(outside)
+        store.flush()
+        self.assertEqual(self.backing.load().current_players, {0, 2, 4})
+        self.assertEqual(store.load().current_players, {0, 2, 4})
+        self.assertEqual(len(log), 1)
+        # changes that cannot be replayed are not written over another one
+        store.save(store.load())
+        self.backing.mutate('drop_player', 0)
+        store.flush()
+        self.assertTrue(store.dirty)
+        self.assertIn('did not overwrite', log[-1])
+        self.assertEqual(self.backing.load().current_players, {2, 4})
+
+    def test_socket(self):
+        self.assertIsNone(mm_client.send(self.path, ['show']))
+
+        async def session():
+            task = asyncio.ensure_future(self.daemon.run())
+            while not os.path.exists(self.path):
+                await asyncio.sleep(0.01)
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(None, mm_client.send, self.path, ['drop', '1'])
+            await asyncio.sleep(0.05)
+            os.kill(os.getpid(), signal.SIGTERM)
+            await task
+            return response
+
+        self.assertEqual(asyncio.run(session()), (0, '[0, 2, 3]\n'))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.backing.load().current_players, {0, 2, 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,370 @@
+#! /usr/bin/env python3
+# Event export for mgamcmahon program
+#
+# Writes the game record of finished or running tournaments for ratings
+# submission and analysis. write_aga_results writes the AGA results text
+# format. ArchiveWriter writes a columnar archive of any number of events:
+# each event adds a chunk of every column of its games and players tables as
+# raw little-endian 64-bit integers, and a JSON footer records where each
+# chunk is, so events are written one at a time and Archive (or
+# numpy.memmap with the recorded offsets) reads a column without building
+# Player or Match objects:
+#
+#     python mm_export.py --format aga --out results.txt tournament.yaml
+#     python mm_export.py --format columns --out season.mmcol events/*.yaml
+
+import argparse
+import array
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+import mcmahon
+import mm_storage
+
+EXPORT_FORMATS = ('aga', 'columns')
+
+# komi of an even game in the AGA results file; handicap games have none
+EVEN_KOMI = 7
+
+# one row per game, in round and board order. white, black and winner are
+# player ids of the event (winner is -1 while the game is unfinished) and
+# the scores are McMahon scores when the round was paired
+GAME_COLUMNS = ('round', 'board', 'white', 'black', 'winner', 'handicap', 'white_score',
+                'black_score')
+
+# one row per player, in player id order; place counts from 1 in the
+# standings and score, sos and sodos are the final values
+PLAYER_COLUMNS = ('player_id', 'aga_id', 'rank', 'division', 'mm_init', 'active', 'place',
+                  'score', 'sos', 'sodos')
+
+# first and last bytes of an archive
+ARCHIVE_MAGIC = b'MMCOL\x00\x01\n'
+
+
+def aga_rank(rank):
+    # the inverse of mm_import.parse_rank: 1 is 1d, 0 is 1k, -4 is 5k
+    return '{}d'.format(rank) if rank >= 1 else '{}k'.format(1 - rank)
+
+
+def handicap(tournament, white, black):
+    # stones given in a game of a HandiTournament, else 0
+    if not isinstance(tournament, mcmahon.HandiTournament):
+        return 0
+    return abs(tournament.players[white].rank - tournament.players[black].rank)
+
+
+def write_aga_results(h, tournament, name='', start=None, finish=None, rules='AGA'):
+    # the AGA results file of tournament: header, players as "aga_id name rank"
+    # (names are written as registered, ideally "Last, First") and every
+    # finished game as "white black W|B handicap komi", round by round
+    h.write('TOURNEY {}\n'.format(name))
+    if start is not None:
+        h.write('\tstart={}\n'.format(start))
+    if finish is not None:
+        h.write('\tfinish={}\n'.format(finish))
+    h.write('\trules={}\n\nPLAYERS\n'.format(rules))
+    for player_id in sorted(tournament.players):
+        player = tournament.players[player_id]
+        h.write('{:>8} {} {}\n'.format(player.aga_id, player.name, aga_rank(player.rank)))
+    h.write('\nGAMES\n')
+    players = tournament.players
+    for round_idx, round_ in enumerate(tournament.rounds, 1):
+        h.write('# Round {}\n'.format(round_idx))
+        for white, black, winner in zip(round_.white, round_.black, round_.winner):
+            if winner == round_.NO_WINNER:
+                continue
+            stones = handicap(tournament, white, black)
+            h.write('{} {} {} {} {}\n'.format(players[white].aga_id, players[black].aga_id,
+                                              'W' if winner == white else 'B', stones,
+                                              0 if stones else EVEN_KOMI))
+
+
+def game_columns(tournament):
+    # {name: array('q')} for GAME_COLUMNS
+    columns = {name: array.array('q') for name in GAME_COLUMNS}
+    score = {player_id: player.mm_init for player_id, player in tournament.players.items()}
+    for round_idx, round_ in enumerate(tournament.rounds):
+        count = len(round_.boards)
+        columns['round'].extend([round_idx] * count)
+        columns['board'].extend(round_.boards)
+        columns['white'].extend(round_.white)
+        columns['black'].extend(round_.black)
+        columns['winner'].extend(round_.winner)
+        columns['handicap'].extend(handicap(tournament, white, black)
+                                   for white, black in zip(round_.white, round_.black))
+        columns['white_score'].extend(score[white] for white in round_.white)
+        columns['black_score'].extend(score[black] for black in round_.black)
+        for winner in round_.winner:
+            if winner != round_.NO_WINNER:
+                score[winner] += 1
+    return columns
+
+
+def player_columns(tournament):
+    # {name: array('q')} for PLAYER_COLUMNS, and the names in the same order
+    ids = sorted(tournament.players)
+    values = tournament.tiebreaks(mcmahon.STANDINGS_ORDER)
+    place = {player_id: i for i, player_id in enumerate(tournament.standings(), 1)}
+    players = [tournament.players[player_id] for player_id in ids]
+    columns = {
+        'player_id': array.array('q', ids),
+        'aga_id': array.array('q', (player.aga_id for player in players)),
+        'rank': array.array('q', (player.rank for player in players)),
+        'division': array.array('q', (player.division for player in players)),
+        'mm_init': array.array('q', (player.mm_init for player in players)),
+        'active': array.array('q', (player_id in tournament.current_players
+                                    for player_id in ids)),
+        'place': array.array('q', (place[player_id] for player_id in ids)),
+    }
+    for name in mcmahon.STANDINGS_ORDER:
+        columns[name] = array.array('q', (values[name][player_id] for player_id in ids))
+    return columns, [player.name for player in players]
+
+
+class ArchiveWriter(object):
+    # writes events to the binary file h as they are added; close writes the
+    # footer:
+    #
+    #     ARCHIVE_MAGIC, chunks, footer JSON, footer length ('<Q'), ARCHIVE_MAGIC
+    #
+    # Every chunk starts on an 8 byte boundary. The footer lists the events
+    # with their name, kind, row counts and, for each 'games.<column>' and
+    # 'players.<column>', the offset and row count of its chunk. Player names
+    # are 'players.name', UTF-8 text at the offsets in 'players.name_offsets'
+
+    def __init__(self, h):
+        self.h = h
+        self.events = []
+        self.offset = 0
+        self._write(ARCHIVE_MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+
+    def _write(self, data):
+        self.h.write(data)
+        self.offset += len(data)
+
+    def _chunk(self, values):
+        # write one column chunk, returns [offset, rows]
+        if isinstance(values, array.array):
+            if sys.byteorder != 'little':
+                values = array.array('q', values)
+                values.byteswap()
+            data = values.tobytes()
+        else:
+            data = values
+        self._write(bytes(-self.offset % 8))
+        res = [self.offset, len(values)]
+        self._write(data)
+        return res
+
+    def add(self, tournament, name=''):
+        games = game_columns(tournament)
+        players, names = player_columns(tournament)
+        encoded = [player_name.encode() for player_name in names]
+        name_offsets = array.array('q', [0])
+        for text in encoded:
+            name_offsets.append(name_offsets[-1] + len(text))
+        chunks = {}
+        for column, values in games.items():
+            chunks['games.' + column] = self._chunk(values)
+        for column, values in players.items():
+            chunks['players.' + column] = self._chunk(values)
+        chunks['players.name_offsets'] = self._chunk(name_offsets)
+        chunks['players.name'] = self._chunk(b''.join(encoded))
+        self.events.append({'name': name, 'kind': type(tournament).__name__,
+                            'rounds': len(tournament.rounds), 'games': len(games['round']),
+                            'players': len(names), 'chunks': chunks})
+
+    def close(self):
+        footer = json.dumps({'version': 1, 'byteorder': 'little', 'itemsize': 8,
+                             'events': self.events}, sort_keys=True).encode()
+        self._write(footer)
+        self._write(struct.pack('<Q', len(footer)))
+        self._write(ARCHIVE_MAGIC)
+
+
+def write_archive(h, events):
+    # events is an iterable of (name, tournament), read one at a time
+    writer = ArchiveWriter(h)
+    for name, tournament in events:
+        writer.add(tournament, name)
+    writer.close()
+    return len(writer.events)
+
+
+class Archive(object):
+    # a memory-mapped archive written by ArchiveWriter. Columns are returned
+    # as memoryviews of int64 into the file, valid until close
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(ARCHIVE_MAGIC)
+        if self.map[:size] != ARCHIVE_MAGIC or self.map[-size:] != ARCHIVE_MAGIC:
+            self.close()
+            raise ValueError('{} is not a columnar archive'.format(filename))
+        footer_size, = struct.unpack('<Q', self.map[-size - 8:-size])
+        footer = json.loads(self.map[-size - 8 - footer_size:-size - 8])
+        self.events = footer['events']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def column(self, table, name, event=None):
+        # the column of one event, or an array of it over all events
+        if event is None:
+            res = array.array('q')
+            for i in range(len(self.events)):
+                view = self.column(table, name, i)
+                res.extend(view)
+                if isinstance(view, memoryview):
+                    view.release()
+            return res
+        offset, rows = self.events[event]['chunks']['{}.{}'.format(table, name)]
+        view = memoryview(self.map)[offset:offset + 8 * rows].cast('q')
+        if sys.byteorder != 'little':
+            res = array.array('q', view)
+            view.release()
+            res.byteswap()
+            return res
+        return view
+
+    def names(self, event):
+        # player names of an event, in player id order
+        offsets = self.column('players', 'name_offsets', event)
+        start = self.events[event]['chunks']['players.name'][0]
+        res = [self.map[start + offsets[i]:start + offsets[i + 1]].decode()
+               for i in range(len(offsets) - 1)]
+        if isinstance(offsets, memoryview):
+            offsets.release()
+        return res
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Export tournaments as AGA results or as a columnar archive')
+    parser.add_argument('filenames', nargs='+',
+                        help="Tournament files; the aga format takes one")
+    parser.add_argument('--format',
+                        choices=EXPORT_FORMATS,
+                        default='aga',
+                        help="Default is 'aga'")
+    parser.add_argument('--out', '-o', default=None,
+                        help="Output file, required for 'columns'. Default is standard "
+                             "output")
+    parser.add_argument('--name', default=None,
+                        help="Tournament name in the AGA header. Default is the file name")
+    parser.add_argument('--start', default=None,
+                        help="Start date for the AGA header, e.g. 2026-10-16")
+    parser.add_argument('--finish', default=None,
+                        help="Finish date for the AGA header")
+    args = parser.parse_args(argv)
+
+    if args.format == 'aga':
+        if len(args.filenames) != 1:
+            parser.error('the aga format takes one tournament file')
+        filename = args.filenames[0]
+        tournament = mm_storage.open_store(filename).load()
+        name = os.path.splitext(os.path.basename(filename))[0] if args.name is None else args.name
+        if args.out is None:
+            write_aga_results(sys.stdout, tournament, name, args.start, args.finish)
+        else:
+            with open(args.out, 'w') as h:
+                write_aga_results(h, tournament, name, args.start, args.finish)
+    else:
+        if args.out is None:
+            parser.error('--out is required for the columns format')
+        events = ((os.path.splitext(os.path.basename(filename))[0],
+                   mm_storage.open_store(filename).load()) for filename in args.filenames)
+        with open(args.out, 'wb') as h:
+            count = write_archive(h, events)
+        sys.stderr.write('Wrote {} events to {}\n'.format(count, args.out))
+
+
+class ExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tournament = mcmahon.HandiTournament.new_tournament(
+            [mcmahon.Player('P{}'.format(i), 3 - i, 1000 + i, [0, 0, 0], 2 if i < 2 else 0, 1)
+             for i in range(6)])
+        self.tournament.start_new_round([0, 1, 2, 3, 4, 5])
+        for board, match in self.tournament.rounds[0].items():
+            self.tournament.add_result(0, board, match.black)
+        self.tournament.start_new_round([0, 2, 1, 4, 3, 5])
+        self.tournament.add_result(1, 1, self.tournament.rounds[1][1].white)
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.unlink(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def test_aga_results(self):
+        h = io.StringIO()
+        write_aga_results(h, self.tournament, 'Test', '2026-10-16')
+        lines = h.getvalue().splitlines()
+        self.assertEqual(lines[:4], ['TOURNEY Test', '\tstart=2026-10-16', '\trules=AGA', ''])
+        self.assertIn('    1000 P0 3d', lines)
+        self.assertIn('    1005 P5 3k', lines)
+        games = lines[lines.index('GAMES') + 1:]
+        self.assertEqual(len(games), 6)
+        self.assertEqual(games[4], '# Round 2')
+        match = self.tournament.rounds[1][1]
+        self.assertEqual(games[5].split(), [str(1000 + match.white), str(1000 + match.black),
+                                            'W', str(handicap(self.tournament, match.white,
+                                                              match.black)), '0'])
+        self.assertEqual([aga_rank(rank) for rank in (1, 0, -4)], ['1d', '1k', '5k'])
+
+    def test_archive(self):
+        filename = os.path.join(self.directory, 'events.mmcol')
+        plain = mcmahon.Tournament.new_tournament(
+            [mcmahon.Player('Zoë', 1, 7, [0, 0, 0], 0, 1),
+             mcmahon.Player('Al', 1, 8, [0, 0, 0], 0, 1)])
+        with open(filename, 'wb') as h:
+            self.assertEqual(write_archive(h, [('handi', self.tournament), ('plain', plain)]), 2)
+
+        with Archive(filename) as archive:
+            self.assertEqual([event['name'] for event in archive.events], ['handi', 'plain'])
+            self.assertEqual(archive.events[0]['games'], 6)
+            self.assertEqual(archive.names(1), ['Zoë', 'Al'])
+            self.assertEqual(list(archive.column('players', 'aga_id')),
+                             [1000, 1001, 1002, 1003, 1004, 1005, 7, 8])
+            games = game_columns(self.tournament)
+            for name in GAME_COLUMNS:
+                view = archive.column('games', name, 0)
+                self.assertEqual(list(view), list(games[name]))
+                view.release()
+            # McMahon scores when paired: round 2 starts from the round 1 wins
+            first = self.tournament.rounds[0]
+            self.assertEqual(list(games['white_score'][3:]),
+                             [self.tournament.players[player_id].mm_init +
+                              (player_id in first.winner)
+                              for player_id in self.tournament.rounds[1].white])
+            self.assertEqual(list(games['winner'][3:]),
+                             [self.tournament.rounds[1][1].white, -1, -1])
+            score = archive.column('players', 'score', 0)
+            self.assertEqual(list(score), [self.tournament.players[player_id].mm_score[0]
+                                           for player_id in range(6)])
+            score.release()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+# Player registration import for mgamcmahon program
+#
+# Reads pre-registration lists exported as CSV or TSV one row at a time, so
+# files of any length are read in constant memory. The first row names the
+# columns; COLUMNS gives the names looked for by default and can be
+# overridden per field.
+
+import csv
+import io
+import unittest
+
+import mcmahon
+
+# field: default column name, matched case-insensitively
+COLUMNS = {'name': 'name', 'rank': 'rank', 'aga_id': 'aga_id', 'division': 'division',
+           'mm_init': 'mm_init'}
+
+# fields that may be missing from the file, with their values
+DEFAULTS = {'division': 1, 'mm_init': 0}
+
+
+def parse_rank(text):
+    # plain integers are kept, higher is stronger. '3d' and '5k' are mapped so
+    # that one stone is one step: 1d is 1, 1k is 0, 5k is -4
+    text = text.strip().lower()
+    if text[-1:] in ('d', 'k'):
+        value = int(text[:-1])
+        if value < 1:
+            raise ValueError('invalid rank {!r}'.format(text))
+        return value if text[-1] == 'd' else 1 - value
+    return int(text)
+
+
+def read_players(h, columns=None, delimiter=None):
+    # yields (line_number, Player) for each row, or (line_number, ValueError)
+    # for a row that cannot be read. columns maps fields to column names,
+    # delimiter defaults to tab when the header has one, else comma
+    header_line = h.readline()
+    if delimiter is None:
+        delimiter = '\t' if '\t' in header_line else ','
+    header = [name.strip().lower() for name in next(csv.reader([header_line],
+                                                               delimiter=delimiter))]
+    names = dict(COLUMNS, **(columns or {}))
+    index = {}
+    for field, name in names.items():
+        if name.lower() in header:
+            index[field] = header.index(name.lower())
+        elif field not in DEFAULTS:
+            raise ValueError('No column {!r} for {} in {}'.format(name, field, header))
+
+    reader = csv.reader(h, delimiter=delimiter)
+    for row in reader:
+        # line numbers count the header, so they match the file
+        line_number = reader.line_num + 1
+        if not any(field.strip() for field in row):
+            continue
+        try:
+            values = {}
+            for field, column in index.items():
+                if column >= len(row) or not row[column].strip():
+                    if field in DEFAULTS:
+                        continue
+                    raise ValueError('missing {}'.format(field))
+                values[field] = row[column].strip()
+            player = mcmahon.Player(values['name'], parse_rank(values['rank']),
+                                    int(values['aga_id']), [0, 0, 0],
+                                    int(values.get('mm_init', DEFAULTS['mm_init'])),
+                                    int(values.get('division', DEFAULTS['division'])))
+        except ValueError as e:
+            yield line_number, e
+            continue
+        yield line_number, player
+
+
+def import_players(tournament, rows):
+    # adds the players from read_players to tournament, returns the number
+    # added and a list of (line_number, error) for the rows skipped, including
+    # aga_ids already registered
+    registered = set(player.aga_id for player in tournament.players.values())
+    added = 0
+    errors = []
+    for line_number, player in rows:
+        if isinstance(player, Exception):
+            errors.append((line_number, player))
+        elif player.aga_id in registered:
+            errors.append((line_number, ValueError('duplicate aga_id {}'.format(player.aga_id))))
+        else:
+            registered.add(player.aga_id)
+            tournament.add_player(player)
+            added += 1
+    return added, errors
+
+
+class ImportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tournament = mcmahon.Tournament.new_tournament(
+            [mcmahon.Player('Andrew', 10, 1000, [0, 0, 0], 0, 1)])
+
+    def test_parse_rank(self):
+        self.assertEqual([parse_rank(rank) for rank in ('3d', '1D', '1k', '5k', ' 7 ')],
+                         [3, 1, 0, -4, 7])
+        with self.assertRaises(ValueError):
+            parse_rank('0k')
+        with self.assertRaises(ValueError):
+            parse_rank('')
+
+    def test_import(self):
+        h = io.StringIO('Name,AGA #,Rank,Band\n'
+                        'Bob,1001,2d,2\n'
+                        '\n'
+                        'Carol,1002,5k,\n'
+                        'Dave,x,5k,1\n'
+                        '"Eve, Jr",1003,3,1\n')
+        rows = read_players(h, columns={'aga_id': 'AGA #', 'division': 'band'})
+        added, errors = import_players(self.tournament, rows)
+        self.assertEqual(added, 3)
+        self.assertEqual([line_number for line_number, error in errors], [5])
+        self.assertEqual(self.tournament.players[1],
+                         mcmahon.Player('Bob', 2, 1001, [0, 0, 0], 0, 2))
+        self.assertEqual(self.tournament.players[2].division, 1)
+        self.assertEqual(self.tournament.players[3].name, 'Eve, Jr')
+
+    def test_duplicates(self):
+        h = io.StringIO('name\trank\taga_id\tmm_init\n'
+                        'Bob\t1\t1001\t-2\n'
+                        'Andrew\t10\t1000\t0\n'
+                        'Bobby\t1\t1001\t0\n')
+        added, errors = import_players(self.tournament, read_players(h))
+        self.assertEqual(added, 1)
+        self.assertEqual([line_number for line_number, error in errors], [3, 4])
+        self.assertEqual(self.tournament.players[1].mm_score, [-2, 0, 0])
+
+    def test_missing_column(self):
+        with self.assertRaises(ValueError):
+            next(read_players(io.StringIO('name,rank\n')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+#! /usr/bin/env python3
+# Tournament simulation for mgamcmahon program
+#
+# Plays complete events with synthetic players to judge pairing settings.
+# Every player has a true strength, their rank plus noise, and each game is
+# won with a probability that depends on the strength difference less the
+# handicap. Many events are simulated in parallel processes for every
+# setting, on the same seeds, and the averages are reported:
+#
+#     python mm_sim.py --players 200 --rounds 5 --mode random matching --samples 1000
+#     python mm_sim.py --players 80 --handi --mode anytime --time-limit 0.2 --events 50
+
+import argparse
+import concurrent.futures
+import json
+import math
+import random
+import statistics
+import sys
+import time
+import unittest
+
+import mcmahon
+import mm_bench
+
+# standard deviation, in stones, of true strength around rank
+STRENGTH_SIGMA = 1.0
+
+# strength difference, in stones, that makes the stronger player win about
+# 73% of even games
+WIN_SCALE = 2.0
+
+# metrics averaged over the events of a setting
+METRICS = ('pairing_time', 'repeats', 'score_diff', 'handicap', 'handicap_max', 'accuracy')
+
+
+def win_probability(strength_diff, handicap=0, scale=WIN_SCALE):
+    # chance that a player strength_diff stones stronger than the opponent
+    # wins while giving handicap stones
+    return 1 / (1 + math.exp(-(strength_diff - handicap) / scale))
+
+
+def synthetic_field(players, divisions=1, distribution='normal', handi=False, sigma=STRENGTH_SIGMA,
+                    seed=0):
+    # a new tournament of players (rounded down to even) split evenly into
+    # divisions by rank, and {player_id: true strength}. McMahon scores start
+    # at the rank above the weakest player
+    rng = random.Random(seed)
+    cls = mcmahon.HandiTournament if handi else mcmahon.Tournament
+    players -= players % 2
+    ranks = sorted(mm_bench.synthetic_ranks(players, distribution, rng), reverse=True)
+    size = 2 * max(1, players // (2 * divisions))
+    tournament = cls.new_tournament(
+        [mcmahon.Player('Player {}'.format(i), rank, 10000 + i, [0, 0, 0], rank - ranks[-1],
+                        min(i // size, divisions - 1) + 1)
+         for i, rank in enumerate(ranks)])
+    strength = {player_id: player.rank + rng.gauss(0, sigma)
+                for player_id, player in tournament.players.items()}
+    return tournament, strength
+
+
+def rank_correlation(order, strength):
+    # Spearman correlation of the places in order with the places by strength
+    count = len(order)
+    if count < 2:
+        return 1.0
+    true_place = {player_id: i for i, player_id in
+                  enumerate(sorted(order, key=lambda k: strength[k], reverse=True))}
+    distance = sum((i - true_place[player_id]) ** 2 for i, player_id in enumerate(order))
+    return 1 - 6 * distance / (count * (count * count - 1))
+
+
+def simulate(setting, seed):
+    # play one event with the setting (a dict of simulation arguments, see
+    # run), returns its metrics; per round ones are lists
+    tournament, strength = synthetic_field(setting['players'], setting['divisions'],
+                                           setting['distribution'], setting['handi'],
+                                           setting['sigma'], seed)
+    rng = random.Random(seed)
+    played = set()
+    res = {'pairing_time': [], 'repeats': [], 'score_diff': [], 'handicap': [],
+           'handicap_max': []}
+    for round_idx in range(setting['rounds']):
+        start = time.perf_counter()
+        pairing = tournament.generate_pairing(setting['samples'], mode=setting['mode'],
+                                              seed=rng.getrandbits(32),
+                                              time_limit=setting['time_limit'])
+        res['pairing_time'].append(time.perf_counter() - start)
+        tournament.start_new_round(pairing)
+
+        round_ = tournament.rounds[round_idx]
+        repeats = 0
+        score_diffs = []
+        handicaps = []
+        for board, match in round_.items():
+            white = tournament.players[match.white]
+            black = tournament.players[match.black]
+            pair = frozenset([match.white, match.black])
+            repeats += pair in played
+            played.add(pair)
+            score_diffs.append(abs(white.mm_score[0] - black.mm_score[0]))
+            # the stones a handicap game would give; even games give none
+            handicaps.append(abs(white.rank - black.rank))
+            stones = handicaps[-1] if setting['handi'] else 0
+            if white.rank >= black.rank:
+                white_wins = rng.random() < win_probability(
+                    strength[match.white] - strength[match.black], stones)
+            else:
+                white_wins = rng.random() >= win_probability(
+                    strength[match.black] - strength[match.white], stones)
+            tournament.add_result(round_idx, board, match.white if white_wins else match.black)
+        res['repeats'].append(repeats)
+        res['score_diff'].append(statistics.mean(score_diffs))
+        res['handicap'].append(statistics.mean(handicaps))
+        res['handicap_max'].append(max(handicaps))
+    res['accuracy'] = rank_correlation(tournament.standings(), strength)
+    return res
+
+
+def _simulate(args):
+    return simulate(*args)
+
+
+def run(players=100, rounds=5, mode='random', samples=1000, time_limit=None, divisions=1,
+        distribution='normal', handi=False, sigma=STRENGTH_SIGMA, events=20, seed=0, workers=1):
+    # simulate events tournaments of the setting, in workers processes.
+    # Returns the setting, the metrics of each event and a summary of
+    # per round means and overall means over the events
+    setting = {'players': players, 'rounds': rounds, 'mode': mode, 'samples': samples,
+               'time_limit': time_limit, 'divisions': divisions, 'distribution': distribution,
+               'handi': handi, 'sigma': sigma}
+    jobs = [(setting, seed + i) for i in range(events)]
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_simulate, jobs))
+    else:
+        results = [_simulate(job) for job in jobs]
+
+    summary = {}
+    for metric in METRICS:
+        values = [result[metric] for result in results]
+        if isinstance(values[0], list):
+            summary[metric + '_per_round'] = [statistics.mean(column) for column in zip(*values)]
+            values = [value for result in values for value in result]
+        summary[metric] = statistics.mean(values)
+    summary['repeats'] = sum(sum(result['repeats']) for result in results)
+    return {'setting': setting, 'events': results, 'summary': summary}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Simulate tournaments to compare pairing modes and settings')
+    parser.add_argument('--players', '-p', type=int, default=100,
+                        help="Players per event. Default is 100")
+    parser.add_argument('--rounds', '-r', type=int, default=5,
+                        help="Default is 5")
+    parser.add_argument('--mode', '-m',
+                        nargs='+',
+                        choices=mcmahon.PAIRING_MODES,
+                        default=['random'],
+                        help="Pairing modes to compare. Default is 'random'")
+    parser.add_argument('--samples', '-n',
+                        type=int,
+                        nargs='+',
+                        default=[1000],
+                        help="Sample sizes to compare in random mode. Default is 1000")
+    parser.add_argument('--time-limit', '-t', type=float, default=None,
+                        help="Seconds per division in anytime mode")
+    parser.add_argument('--divisions', '-d', type=int, default=1,
+                        help="Default is 1")
+    parser.add_argument('--ranks',
+                        choices=mm_bench.RANK_DISTRIBUTIONS,
+                        default='normal',
+                        help="Rank distribution. Default is 'normal'")
+    parser.add_argument('--handi', '-H', action="store_true", default=False,
+                        help="Simulate handicap tournaments")
+    parser.add_argument('--sigma', type=float, default=STRENGTH_SIGMA,
+                        help="Spread of true strength around rank, in stones. "
+                             "Default is {}".format(STRENGTH_SIGMA))
+    parser.add_argument('--events', '-e', type=int, default=20,
+                        help="Events simulated per setting. Default is 20")
+    parser.add_argument('--seed', '-s', type=int, default=0,
+                        help="Seed of the first event. Default is 0")
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help="Processes simulating events. Default is 1")
+    parser.add_argument('--output', '-o', default=None,
+                        help="Write the JSON report here instead of standard output")
+    args = parser.parse_args(argv)
+
+    reports = []
+    sys.stderr.write('{:24} {:>10} {:>8} {:>10} {:>9} {:>8} {:>9}\n'.format(
+        'Setting', 'Time/rnd', 'Repeats', 'Score diff', 'Handicap', 'Max', 'Accuracy'))
+    for mode in args.mode:
+        # samples only matter in random mode
+        for samples in (args.samples if mode == 'random' else [args.samples[0]]):
+            report = run(args.players, args.rounds, mode, samples, args.time_limit,
+                         args.divisions, args.ranks, args.handi, args.sigma, args.events,
+                         args.seed, args.workers)
+            reports.append(report)
+            summary = report['summary']
+            name = '{}[samples={}]'.format(mode, samples) if mode == 'random' else mode
+            sys.stderr.write('{:24} {:10.4f} {:8d} {:10.3f} {:9.3f} {:8.3f} {:9.3f}\n'.format(
+                name, summary['pairing_time'], summary['repeats'], summary['score_diff'],
+                summary['handicap'], summary['handicap_max'], summary['accuracy']))
+
+    text = json.dumps(reports, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as h:
+            h.write(text + '\n')
+
+
+class SimTestCase(unittest.TestCase):
+
+    def test_win_probability(self):
+        self.assertEqual(win_probability(0), 0.5)
+        self.assertEqual(win_probability(3, 3), 0.5)
+        self.assertGreater(win_probability(2), 0.7)
+        self.assertEqual(rank_correlation([1, 2, 3], {1: 5, 2: 1, 3: 0}), 1)
+        self.assertEqual(rank_correlation([3, 2, 1], {1: 5, 2: 1, 3: 0}), -1)
+
+    def test_run(self):
+        report = run(players=21, rounds=3, mode='matching', divisions=2, events=2)
+        summary = report['summary']
+        self.assertEqual(len(report['events']), 2)
+        self.assertEqual(len(summary['pairing_time_per_round']), 3)
+        self.assertEqual(summary['repeats'], 0)
+        self.assertTrue(-1 <= summary['accuracy'] <= 1)
+
+    def test_parallel(self):
+        # the same seeds give the same events in worker processes, apart from
+        # the timings
+        serial, parallel = [[dict(event, pairing_time=None) for event in
+                             run(players=20, rounds=3, mode='random', samples=50, events=3,
+                                 workers=workers)['events']] for workers in (1, 2)]
+        self.assertEqual(serial, parallel)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
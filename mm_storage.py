@@ -0,0 +1,1174 @@
+#! /usr/bin/env python3
+# Tournament storage for mgamcmahon program
+#
+# YamlStore rewrites the whole tournament file on every change. JournalStore
+# keeps the same file as a periodic snapshot and appends each change to a
+# journal next to it, which is replayed on load and folded back into the
+# snapshot on compaction. SqliteStore keeps players, matches and old pairs in
+# indexed tables and touches only the rows a change needs.
+
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import errno
+import fcntl
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+import uuid
+
+import mcmahon
+import mm_client
+
+STORAGE_TYPES = ('yaml', 'journal', 'sqlite')
+
+# filename extensions opened as SQLite databases
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+
+def _write_atomic(filename, text):
+    # write to a temporary file in the same directory and rename over the
+    # target, so readers never see a partially written file
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as h:
+            h.write(text)
+            h.flush()
+            os.fsync(h.fileno())
+        # mkstemp makes the file private; keep the mode the target had, or
+        # give a new one the mode open() would
+        try:
+            mode = os.stat(filename).st_mode & 0o7777
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp_name, mode)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def show_cache_stamp(filename):
+    # the state of the tournament files a show cache is keyed by, see
+    # mm_client.read_show_cache
+    return {'stats': mm_client.file_stats(filename), 'sha256': mm_client.file_digest(filename)}
+
+
+def write_show_cache(filename, tournament, stamp=None):
+    # render the pairings and the standings in every format for mm_cli show
+    # and keep them next to filename, keyed by stamp. stamp defaults to the
+    # state of the files as they are now, which is only right while they
+    # cannot change; otherwise take it with show_cache_stamp before loading
+    # tournament, so a change in between makes the cache stale, not wrong
+    if stamp is None:
+        stamp = show_cache_stamp(filename)
+    outputs = {'standings': {}}
+    if tournament.rounds:
+        outputs['pairings'] = {'text': tournament.pairings_list() + '\n'}
+    for format in mcmahon.WALL_FORMATS:
+        h = io.StringIO()
+        tournament.write_wall(h, format)
+        outputs['standings'][format] = h.getvalue()
+    _write_atomic(mm_client.show_cache_path(filename), json.dumps(dict(stamp, outputs=outputs)))
+
+
+class YamlStore(object):
+
+    # rewrite the mm_cli show cache whenever a change reaches the disk
+    show_cache = False
+
+    # queue changes from concurrent processes and save them together, see
+    # _submit
+    coalesce = True
+
+    # outcomes kept in <filename>.done for processes still to pick them up
+    done_kept = 10000
+
+    # outputs render builds from a few rows, without loading the tournament;
+    # mm_cli show calls render for them rather than rebuild a stale show cache
+    row_render = ()
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tournament = None  # last tournament loaded by mutate
+        self._lock_file = None
+        self._lock_depth = 0
+
+    def exists(self):
+        return os.path.isfile(self.filename)
+
+    def load(self):
+        h = open(self.filename, 'r')
+        tournament = mcmahon.load(h.read())
+        h.close()
+        return tournament
+
+    def save(self, tournament):
+        _write_atomic(self.filename, mcmahon.dump(tournament))
+        self._written(tournament)
+
+    def apply(self, tournament, op, *args):
+        # run a mutating Tournament method and persist the change
+        entry = self._entry(op, args)
+        result = getattr(tournament, op)(*args)
+        self._record(tournament, entry)
+        return result
+
+    @contextlib.contextmanager
+    def locked(self):
+        # hold the advisory lock on <filename>.lock; every read-modify-write
+        # of the file happens under it. Nested use in one store is allowed
+        if self._lock_depth == 0:
+            self._lock_file = open(self.filename + '.lock', 'a')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                self._lock_file.close()
+                self._lock_file = None
+
+    def mutate(self, op, *args):
+        # load, apply one change and persist it
+        result, error = self._submit([(op, args)])[0]
+        if error is not None:
+            raise error
+        return result
+
+    def mutate_many(self, op, arglists):
+        # load once, apply op for each argument tuple and persist all changes
+        # together. Returns one entry per tuple, None or the error that
+        # rejected it; a rejected change leaves the tournament untouched and
+        # does not stop the rest.
+        outcomes = self._submit([(op, args) for args in arglists])
+        for result, error in outcomes:
+            if error is not None and not isinstance(error, (LookupError, ValueError,
+                                                            RuntimeError)):
+                raise error
+        return [error for result, error in outcomes]
+
+    def _submit(self, changes):
+        # run the (op, args) changes, returns a (result, error) pair for each.
+        # Other processes may be changing the same file: each one adds its
+        # changes to <filename>.queue and waits for the lock, and whoever gets
+        # it applies everything queued so far with one load and one save and
+        # leaves the outcomes in <filename>.done for the others to pick up
+        if not self.coalesce:
+            with self.locked():
+                return self._apply_many(changes)
+        ticket = uuid.uuid4().hex
+        lines = [json.dumps({'ticket': ticket, 'op': op,
+                             'args': [_encode_arg(arg) for arg in args]}) + '\n'
+                 for op, args in changes]
+        with open(self.filename + '.queue', 'a+b') as h:
+            fcntl.flock(h, fcntl.LOCK_EX)
+            text = ''.join(lines).encode()
+            size = h.seek(0, os.SEEK_END)
+            if size:
+                # a process that crashed while queueing may have left a torn
+                # line; ours start on a line of their own
+                h.seek(size - 1)
+                if h.read(1) != b'\n':
+                    text = b'\n' + text
+            h.write(text)
+        with self.locked():
+            outcomes = self._outcomes(ticket)
+            if outcomes is None:
+                self._drain()
+                outcomes = self._outcomes(ticket)
+        if outcomes is None or len(outcomes) != len(changes):
+            raise RuntimeError('No outcome found for changes queued for {}'.format(self.filename))
+        return outcomes
+
+    def _drain(self):
+        # apply every queued change and record the outcomes, holding the lock.
+        # The queue is cut only once the outcomes are written, so changes
+        # stay queued when a process fails or crashes before that. Before
+        # saving, the outcomes are kept in <filename>.applying with the state
+        # of the files; when a crash left them there and the files changed
+        # since, the save went through and they are recorded, not applied again
+        queue = self.filename + '.queue'
+        with open(queue, 'a+b') as h:
+            fcntl.flock(h, fcntl.LOCK_EX)
+            h.seek(0)
+            data = h.read()
+        queued = []
+        rejected = []
+        for line in data.splitlines():
+            try:
+                entry = json.loads(line)
+                entry['ticket'], entry['op'], entry['args']
+            except (ValueError, TypeError, KeyError):
+                rejected.append(line + b'\n')
+                continue
+            queued.append(entry)
+        if rejected:
+            # torn lines from crashed processes; kept for inspection
+            with open(self.filename + '.rejected', 'ab') as h:
+                h.write(b''.join(rejected))
+            sys.stderr.write('Moved {} unreadable queued changes to {}.rejected\n'
+                             .format(len(rejected), self.filename))
+        done = self.filename + '.done'
+        lines = []
+        if os.path.isfile(done):
+            with open(done) as h:
+                lines = h.readlines()[-self.done_kept:]
+        recorded = set(json.loads(line)['ticket'] for line in lines)
+        applying = self.filename + '.applying'
+        stamp = show_cache_stamp(self.filename)
+        if os.path.isfile(applying):
+            with open(applying) as h:
+                interrupted = json.load(h)
+            if (interrupted['stamp']['stats'] != stamp['stats'] and
+                    interrupted['stamp']['sha256'] != stamp['sha256']):
+                for line in interrupted['done']:
+                    if json.loads(line)['ticket'] not in recorded:
+                        lines.append(line)
+                recorded.update(json.loads(line)['ticket'] for line in interrupted['done'])
+        queued = [entry for entry in queued if entry['ticket'] not in recorded]
+
+        def outcome_lines(outcomes):
+            res = []
+            for entry, (result, error) in zip(queued, outcomes):
+                if error is not None:
+                    error = [type(error).__name__, list(error.args)]
+                res.append(json.dumps({'ticket': entry['ticket'], 'result': result,
+                                       'error': error}, default=str) + '\n')
+            return res
+
+        def prepare(outcomes):
+            _write_atomic(applying, json.dumps({'stamp': stamp,
+                                                'done': outcome_lines(outcomes)}))
+
+        outcomes = self._apply_many([(entry['op'], [_decode_arg(arg) for arg in entry['args']])
+                                     for entry in queued], prepare)
+        lines.extend(outcome_lines(outcomes))
+        _write_atomic(done, ''.join(lines))
+        with open(queue, 'r+b') as h:
+            # keep what was queued meanwhile
+            fcntl.flock(h, fcntl.LOCK_EX)
+            h.seek(len(data))
+            rest = h.read()
+            h.seek(0)
+            h.write(rest)
+            h.truncate()
+        if os.path.isfile(applying):
+            os.unlink(applying)
+
+    def _outcomes(self, ticket):
+        # the (result, error) pairs left in <filename>.done for ticket, None if
+        # its changes have not been applied yet
+        done = self.filename + '.done'
+        if not os.path.isfile(done):
+            return None
+        outcomes = []
+        with open(done) as h:
+            for line in h:
+                entry = json.loads(line)
+                if entry['ticket'] != ticket:
+                    continue
+                error = entry['error']
+                if error is not None:
+                    error = _ERRORS.get(error[0], RuntimeError)(*error[1])
+                outcomes.append((entry['result'], error))
+        return outcomes or None
+
+    def _apply_many(self, changes, prepare=None):
+        # load once, apply each change and persist the ones that succeeded;
+        # prepare is called with the outcomes before they are persisted
+        self.tournament = self.load()
+        outcomes = []
+        entries = []
+        for op, args in changes:
+            entry = self._entry(op, args)
+            try:
+                result = getattr(self.tournament, op)(*args)
+            except Exception as e:
+                outcomes.append((None, e))
+                continue
+            outcomes.append((result, None))
+            entries.append(entry)
+        if prepare is not None:
+            prepare(outcomes)
+        if len(entries) == 1:
+            self._record(self.tournament, entries[0])
+        elif entries:
+            self._record_many(self.tournament, entries)
+        return outcomes
+
+    def player(self, player_id):
+        if self.tournament is None:
+            self.tournament = self.load()
+        return self.tournament.players[player_id]
+
+    def player_index(self):
+        # mcmahon.PlayerIndex of the players, for finding and resolving them
+        if self.tournament is None:
+            self.tournament = self.load()
+        return self.tournament.player_index()
+
+    def render(self, output, order=None, format='text', h=None):
+        # text for mm_cli show, output is 'pairings' or 'standings'; order is
+        # the standings order, see Tournament.standings. Given a file h, the
+        # standings are written to it in format as they are produced instead
+        tournament = self.load()
+        if output == 'pairings':
+            return tournament.pairings_list()
+        if h is not None:
+            tournament.write_wall(h, format, order)
+        elif format == 'text':
+            return tournament.wall_list(order)
+        else:
+            h = io.StringIO()
+            tournament.write_wall(h, format, order)
+            return h.getvalue()
+
+    def _entry(self, op, args):
+        return None
+
+    def _record(self, tournament, entry):
+        self.save(tournament)
+
+    def _record_many(self, tournament, entries):
+        self.save(tournament)
+
+    def _written(self, tournament):
+        if self.show_cache:
+            write_show_cache(self.filename, tournament)
+
+
+# errors passed back from the process that applied a queued change
+_ERRORS = {cls.__name__: cls for cls in (KeyError, IndexError, LookupError, ValueError,
+                                         RuntimeError, TypeError)}
+
+
+def _encode_arg(arg):
+    if isinstance(arg, mcmahon.Player):
+        return {'player': {'name': arg.name, 'rank': arg.rank, 'aga_id': arg.aga_id,
+                           'mm_init': arg.mm_init, 'division': arg.division}}
+    return arg
+
+
+def _decode_arg(arg):
+    if isinstance(arg, dict) and 'player' in arg:
+        fields = arg['player']
+        return mcmahon.Player(fields['name'], fields['rank'], fields['aga_id'],
+                              [fields['mm_init'], 0, 0], fields['mm_init'], fields['division'])
+    return arg
+
+
+def journal_entry(op, args):
+    # a change as JournalStore writes it; copied before the call, since
+    # methods like start_new_round consume their arguments
+    return {'op': op, 'args': copy.deepcopy([_encode_arg(arg) for arg in args])}
+
+
+def replay(tournament, entry):
+    # apply a change made by journal_entry
+    return getattr(tournament, entry['op'])(*[_decode_arg(arg) for arg in entry['args']])
+
+
+class JournalStore(YamlStore):
+
+    # first line of a snapshot, records the last journal entry folded into it
+    header = '# journal-seq: {}\n'
+
+    def __init__(self, filename, compact_every=500):
+        YamlStore.__init__(self, filename)
+        self.journal = filename + '.journal'
+        self.compact_every = compact_every
+        self.seq = 0  # sequence number of the last entry applied
+        self.pending = 0  # journal entries not yet in the snapshot
+
+    def load(self):
+        h = open(self.filename, 'r')
+        first_line = h.readline()
+        h.seek(0)
+        tournament = mcmahon.load(h.read())
+        h.close()
+        self.seq = 0
+        if first_line.startswith(self.header.split('{')[0]):
+            self.seq = int(first_line.split(':')[1])
+        self.pending = 0
+
+        if os.path.isfile(self.journal):
+            if self._lock_depth:
+                # only a writer may cut a torn write, a reader could be
+                # looking at one still in progress
+                self._cut_torn_write()
+            h = open(self.journal, 'rb')
+            for line in h:
+                if not line.endswith(b'\n'):
+                    # a torn final write from a crash, the change never completed
+                    break
+                entry = self._parse(line)
+                if entry is None:
+                    continue
+                if entry['seq'] <= self.seq:
+                    # already folded into the snapshot
+                    continue
+                replay(tournament, entry)
+                self.seq = entry['seq']
+                self.pending += 1
+            h.close()
+        return tournament
+
+    @staticmethod
+    def _parse(line):
+        # the entry on a journal line, None if there is none. Journals written
+        # before torn writes were cut can hold a complete entry appended to
+        # the remains of a torn one on the same line
+        try:
+            return json.loads(line)
+        except ValueError:
+            pass
+        start = line.rfind(b'{"args": ')
+        while start > 0:
+            try:
+                return json.loads(line[start:])
+            except ValueError:
+                start = line.rfind(b'{"args": ', 0, start)
+        return None
+
+    def _cut_torn_write(self):
+        # truncate the journal after its last complete line, so the next
+        # entry starts on a line of its own
+        if not os.path.isfile(self.journal):
+            return
+        with open(self.journal, 'r+b') as h:
+            size = h.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            h.seek(size - 1)
+            if h.read(1) != b'\n':
+                h.seek(0)
+                h.truncate(h.read().rfind(b'\n') + 1)
+
+    def save(self, tournament):
+        # write a snapshot holding every change so far, then start a new journal
+        _write_atomic(self.filename, self.header.format(self.seq) + mcmahon.dump(tournament))
+        _write_atomic(self.journal, '')
+        self.pending = 0
+        self._written(tournament)
+
+    compact = save
+
+    def _entry(self, op, args):
+        return journal_entry(op, args)
+
+    def _record(self, tournament, entry):
+        self._record_many(tournament, [entry])
+
+    def _record_many(self, tournament, entries):
+        # one write and fsync for the whole batch
+        lines = [json.dumps(dict(entry, seq=self.seq + i), sort_keys=True) + '\n'
+                 for i, entry in enumerate(entries, 1)]
+        self._cut_torn_write()
+        h = open(self.journal, 'a')
+        h.write(''.join(lines))
+        h.flush()
+        os.fsync(h.fileno())
+        h.close()
+        self.seq += len(entries)
+        self.pending += len(entries)
+        if self.pending >= self.compact_every:
+            self.save(tournament)
+        else:
+            self._written(tournament)
+
+
+class SqliteStore(YamlStore):
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        CREATE TABLE IF NOT EXISTS players (
+            id INTEGER PRIMARY KEY, name TEXT NOT NULL, rank INTEGER NOT NULL,
+            aga_id INTEGER, mm_init INTEGER NOT NULL, division INTEGER NOT NULL,
+            active INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS players_aga_id ON players (aga_id);
+        CREATE TABLE IF NOT EXISTS matches (
+            round INTEGER NOT NULL, board INTEGER NOT NULL, white INTEGER NOT NULL,
+            black INTEGER NOT NULL, winner INTEGER, PRIMARY KEY (round, board));
+        CREATE INDEX IF NOT EXISTS matches_white ON matches (white);
+        CREATE INDEX IF NOT EXISTS matches_black ON matches (black);
+        CREATE TABLE IF NOT EXISTS old_pairs (
+            player1 INTEGER NOT NULL, player2 INTEGER NOT NULL,
+            PRIMARY KEY (player1, player2));
+        CREATE TABLE IF NOT EXISTS forbidden_pairs (
+            player1 INTEGER NOT NULL, player2 INTEGER NOT NULL,
+            PRIMARY KEY (player1, player2));
+    '''
+
+    # meta 'kind' value for each tournament class
+    kinds = {'tournament': mcmahon.Tournament, 'handitournament': mcmahon.HandiTournament}
+
+    # SQLite transactions already serialize writers and record each change
+    coalesce = False
+
+    row_render = ('pairings',)
+
+    def __init__(self, filename):
+        YamlStore.__init__(self, filename)
+        self._db = None
+
+    @property
+    def db(self):
+        # only save creates a database, reading a missing one is an error as
+        # it is for a missing YAML file
+        if self._db is None:
+            if not os.path.isfile(self.filename):
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), self.filename)
+            self._connect()
+        return self._db
+
+    def _connect(self):
+        self._db = sqlite3.connect(self.filename)
+        self._db.executescript(self.schema)
+
+    def _meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise ValueError('{} holds no tournament'.format(self.filename))
+        return row[0]
+
+    def _kind(self):
+        return self.kinds[self._meta('kind')]
+
+    def _player(self, row):
+        player_id, name, rank, aga_id, mm_init, division = row
+        return player_id, mcmahon.Player(name, rank, aga_id, [mm_init, 0, 0], mm_init, division)
+
+    def load(self):
+        # scores are derived data and are not stored, they are recomputed here
+        db = self.db
+        players = {}
+        current_players = set()
+        for row in db.execute('SELECT id, name, rank, aga_id, mm_init, division, active '
+                              'FROM players'):
+            player_id, player = self._player(row[:6])
+            players[player_id] = player
+            if row[6]:
+                current_players.add(player_id)
+        rounds = [mcmahon.Round() for i in range(self._meta('rounds'))]
+        for round_, board, white, black, winner in db.execute(
+                'SELECT round, board, white, black, winner FROM matches ORDER BY round, board'):
+            rounds[round_].add(board, white, black, winner)
+        old_pairs = set(frozenset(pair) for pair in
+                        db.execute('SELECT player1, player2 FROM old_pairs'))
+        forbidden_pairs = set(frozenset(pair) for pair in
+                              db.execute('SELECT player1, player2 FROM forbidden_pairs'))
+        tournament = self._kind()(players, self._meta('id_ctr'), rounds, old_pairs,
+                                  current_players, forbidden_pairs)
+        tournament.calculate_mm_score()
+        return tournament
+
+    def save(self, tournament):
+        kind = [name for name, cls in self.kinds.items() if type(tournament) is cls][0]
+        if self._db is None:
+            self._connect()
+        with self.db as db:
+            for table in ('meta', 'players', 'matches', 'old_pairs', 'forbidden_pairs'):
+                db.execute('DELETE FROM {}'.format(table))
+            db.executemany('INSERT INTO meta VALUES (?, ?)',
+                           [('kind', kind), ('id_ctr', tournament.id_ctr),
+                            ('rounds', len(tournament.rounds))])
+            db.executemany('INSERT INTO players VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           [(player_id, player.name, player.rank, player.aga_id,
+                             player.mm_init, player.division,
+                             player_id in tournament.current_players)
+                            for player_id, player in tournament.players.items()])
+            for i in range(len(tournament.rounds)):
+                self._insert_round(db, tournament, i)
+            db.executemany('INSERT INTO old_pairs VALUES (?, ?)',
+                           [sorted(pair) for pair in tournament.old_pairs])
+            db.executemany('INSERT INTO forbidden_pairs VALUES (?, ?)',
+                           [sorted(pair) for pair in tournament.forbidden_pairs])
+        self._written(tournament)
+
+    def _insert_round(self, db, tournament, round_):
+        db.executemany('INSERT INTO matches VALUES (?, ?, ?, ?, ?)',
+                       [(round_, board, match.white, match.black, match.winner)
+                        for board, match in tournament.rounds[round_].items()])
+
+    def _entry(self, op, args):
+        return (op, args)
+
+    def _record(self, tournament, entry):
+        # write only the rows touched by the change, anything else is a full save
+        op, args = entry
+        if op not in ('add_result', 'drop_player', 'repair_round', 'forbid_pair',
+                      'allow_pair', 'add_player', 'start_new_round'):
+            self.save(tournament)
+            return
+        with self.db as db:
+            if op == 'add_result':
+                self._update_result(db, *args)
+            elif op == 'drop_player':
+                db.execute('UPDATE players SET active = 0 WHERE id = ?', args)
+            elif op == 'repair_round':
+                round_ = len(tournament.rounds) - 1
+                db.execute('DELETE FROM matches WHERE round = ?', (round_,))
+                self._insert_round(db, tournament, round_)
+            elif op == 'forbid_pair':
+                db.execute('INSERT OR IGNORE INTO forbidden_pairs VALUES (?, ?)', sorted(args))
+            elif op == 'allow_pair':
+                db.execute('DELETE FROM forbidden_pairs WHERE player1 = ? AND player2 = ?',
+                           sorted(args))
+            elif op == 'add_player':
+                player_id = tournament.id_ctr - 1
+                self._insert_player(db, player_id, tournament.players[player_id])
+            elif op == 'start_new_round':
+                round_ = len(tournament.rounds) - 1
+                self._insert_round(db, tournament, round_)
+                db.executemany('INSERT OR IGNORE INTO old_pairs VALUES (?, ?)',
+                               [sorted(pair) for pair in tournament.old_pairs])
+                db.execute("UPDATE meta SET value = ? WHERE key = 'rounds'",
+                           (len(tournament.rounds),))
+        self._written(tournament)
+
+    def _insert_player(self, db, player_id, player):
+        db.execute('INSERT INTO players VALUES (?, ?, ?, ?, ?, ?, 1)',
+                   (player_id, player.name, player.rank, player.aga_id, player.mm_init,
+                    player.division))
+        db.execute("UPDATE meta SET value = ? WHERE key = 'id_ctr'", (player_id + 1,))
+
+    def _update_result(self, db, round_, board, winner):
+        # one UPDATE; the WHERE clause applies the Match.winner rules
+        cursor = db.execute('UPDATE matches SET winner = ? WHERE round = ? AND board = ? '
+                            'AND (? IS NULL OR ? IN (white, black))',
+                            (winner, round_, board, winner, winner))
+        if cursor.rowcount == 0:
+            if db.execute('SELECT 1 FROM matches WHERE round = ? AND board = ?',
+                          (round_, board)).fetchone() is None:
+                raise KeyError('No board {} in round {}'.format(board, round_ + 1))
+            raise ValueError("'winner' must be equal to either 'white' or 'black' (or 'None')")
+
+    def mutate(self, op, *args):
+        # results, drops and registrations do not need the tournament loaded;
+        # without it the show cache is not rewritten, it goes stale with the
+        # file and the next mm_cli show rebuilds it. They still take the lock,
+        # or a command saving a whole tournament it loaded earlier, such as
+        # importplayers, would write over them
+        if op not in ('add_result', 'drop_player', 'add_player'):
+            return YamlStore.mutate(self, op, *args)
+        with self.locked(), self.db as db:
+            if op == 'add_result':
+                self._update_result(db, *args)
+            elif op == 'drop_player':
+                if db.execute('UPDATE players SET active = 0 WHERE id = ? AND active = 1',
+                              args).rowcount == 0:
+                    raise KeyError(args[0])
+            else:
+                # id_ctr is read and bumped in one write transaction, so two
+                # registrations never take the same id
+                db.execute('BEGIN IMMEDIATE')
+                self._insert_player(db, self._meta('id_ctr'), args[0])
+
+    def mutate_many(self, op, arglists):
+        if op != 'add_result':
+            return YamlStore.mutate_many(self, op, arglists)
+        # one transaction; a rejected UPDATE changes no rows
+        errors = []
+        with self.locked(), self.db as db:
+            for args in arglists:
+                try:
+                    self._update_result(db, *args)
+                except (KeyError, ValueError) as e:
+                    errors.append(e)
+                else:
+                    errors.append(None)
+        return errors
+
+    def player(self, player_id):
+        row = self.db.execute('SELECT id, name, rank, aga_id, mm_init, division FROM players '
+                              'WHERE id = ?', (player_id,)).fetchone()
+        if row is None:
+            raise KeyError(player_id)
+        return self._player(row)[1]
+
+    def player_index(self):
+        return mcmahon.PlayerIndex(self._player(row) for row in self.db.execute(
+            'SELECT id, name, rank, aga_id, mm_init, division FROM players'))
+
+    def render(self, output, order=None, format='text', h=None):
+        if output != 'pairings':
+            return YamlStore.render(self, output, order, format, h)
+        # the pairings only need the last round and the players seated in it
+        round_ = self._meta('rounds') - 1
+        players = {}
+        current = {}
+        for board, white, black, winner, *rows in self.db.execute(
+                'SELECT m.board, m.white, m.black, m.winner, '
+                'w.id, w.name, w.rank, w.aga_id, w.mm_init, w.division, '
+                'b.id, b.name, b.rank, b.aga_id, b.mm_init, b.division '
+                'FROM matches m JOIN players w ON w.id = m.white JOIN players b ON b.id = m.black '
+                'WHERE m.round = ? ORDER BY m.board', (round_,)):
+            for row in (rows[:6], rows[6:]):
+                player_id, player = self._player(row)
+                players[player_id] = player
+            current[board] = mcmahon.Match(white, black, winner)
+        # a tournament holding only what pairings_list reads
+        partial = self._kind()(players, 0, [{}] * round_ + [current], set(), set())
+        return partial.pairings_list()
+
+
+class PairingCache(object):
+    # best pairings found so far, keyed by Tournament.pairing_key, in a JSON
+    # file next to the tournament. Holds at most capacity entries and drops
+    # the least recently used.
+
+    def __init__(self, filename, capacity=64):
+        self.filename = filename
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()  # oldest first
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as h:
+                    entries = json.load(h)
+            except ValueError:
+                # a damaged cache is only lost work
+                entries = []
+            for entry in entries:
+                self.entries[entry['key']] = entry
+
+    @staticmethod
+    def path(filename):
+        return filename + '.pairings.json'
+
+    def get(self, key):
+        # the entry for key, a dict with 'pairing', 'score' and 'samples', or None
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, pairing, score, samples=0):
+        # keep pairing unless the entry holds one at least as good
+        entry = self.entries.get(key)
+        if entry is None or score < entry['score']:
+            entry = {'key': key, 'pairing': list(pairing), 'score': score,
+                     'samples': max(samples, entry['samples'] if entry else 0)}
+        else:
+            entry['samples'] = max(samples, entry['samples'])
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return entry
+
+    def save(self):
+        _write_atomic(self.filename, json.dumps(list(self.entries.values())))
+
+
+def open_store(filename, storage=None):
+    # storage defaults to 'sqlite' for database extensions, else to 'journal'
+    # when a journal exists next to the file
+    if storage is None:
+        if os.path.splitext(filename)[1] in SQLITE_EXTENSIONS:
+            storage = 'sqlite'
+        elif os.path.isfile(filename + '.journal'):
+            storage = 'journal'
+        else:
+            storage = 'yaml'
+    if storage == 'sqlite':
+        return SqliteStore(filename)
+    elif storage == 'journal':
+        return JournalStore(filename)
+    elif storage == 'yaml':
+        return YamlStore(filename)
+    raise ValueError("'storage' must be one of {}".format(', '.join(STORAGE_TYPES)))
+
+
+class WriteAtomicTestCase(unittest.TestCase):
+
+    def test_mode(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'tournament.yaml')
+            _write_atomic(filename, 'a')
+            umask = os.umask(0)
+            os.umask(umask)
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o666 & ~umask)
+            os.chmod(filename, 0o640)
+            _write_atomic(filename, 'b')
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o640)
+        finally:
+            shutil.rmtree(directory)
+
+
+class JournalStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'tournament.yaml')
+        self.store = JournalStore(self.filename)
+        self.tournament = mcmahon.Tournament.new_tournament()
+        self.store.save(self.tournament)
+        for i in range(8):
+            self.store.apply(self.tournament, 'add_player',
+                             mcmahon.Player('P{}'.format(i), 5 - i, 100 + i, [0, 0, 0], 0, 1))
+        self.store.apply(self.tournament, 'start_new_round', [0, 1, 2, 3, 4, 5, 6, 7])
+        for board, match in self.tournament.rounds[0].items():
+            self.store.apply(self.tournament, 'add_result', 0, board, match.white)
+        self.store.apply(self.tournament, 'drop_player', 3)
+        self.store.apply(self.tournament, 'forbid_pair', 1, 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        loaded = open_store(self.filename).load()
+        self.assertEqual(loaded, self.tournament)
+        self.assertEqual([player.mm_score for player in loaded.players.values()],
+                         [player.mm_score for player in self.tournament.players.values()])
+
+    def test_compact(self):
+        store = JournalStore(self.filename)
+        tournament = store.load()
+        self.assertEqual(store.pending, 15)
+        store.compact(tournament)
+        self.assertEqual(os.path.getsize(self.filename + '.journal'), 0)
+        self.assertEqual(JournalStore(self.filename).load(), self.tournament)
+
+    def test_crash_during_compact(self):
+        # snapshot written but journal not yet truncated: entries already in
+        # the snapshot must not be applied twice
+        store = JournalStore(self.filename)
+        tournament = store.load()
+        _write_atomic(self.filename, store.header.format(store.seq) + mcmahon.dump(tournament))
+        self.assertEqual(JournalStore(self.filename).load(), self.tournament)
+
+    def test_torn_write(self):
+        h = open(self.filename + '.journal', 'a')
+        h.write('{"seq": 15, "op": "drop_pl')
+        h.close()
+        self.assertEqual(JournalStore(self.filename).load(), self.tournament)
+
+    def test_writes_after_torn_write(self):
+        h = open(self.filename + '.journal', 'a')
+        h.write('{"seq": 15, "op": "drop_pl')
+        h.close()
+        store = JournalStore(self.filename)
+        store.mutate('add_player', mcmahon.Player('P8', 0, 108, [0, 0, 0], 0, 1))
+        store.mutate('drop_player', 4)
+        self.tournament.add_player(mcmahon.Player('P8', 0, 108, [0, 0, 0], 0, 1))
+        self.tournament.drop_player(4)
+        self.assertEqual(JournalStore(self.filename).load(), self.tournament)
+        # an entry appended to a torn line by earlier versions is still read
+        h = open(self.filename + '.journal', 'a')
+        h.write('{"seq": 18, "op": "drop_pl' + json.dumps(
+            {'args': [5], 'op': 'drop_player', 'seq': 18}, sort_keys=True) + '\n')
+        h.close()
+        self.tournament.drop_player(5)
+        self.assertEqual(JournalStore(self.filename).load(), self.tournament)
+
+    def test_periodic_compaction(self):
+        store = JournalStore(self.filename, compact_every=17)
+        tournament = store.load()
+        store.apply(tournament, 'drop_player', 4)
+        store.apply(tournament, 'drop_player', 5)
+        self.assertEqual(store.pending, 0)
+        self.assertEqual(JournalStore(self.filename).load(), tournament)
+
+    def test_mutate_many(self):
+        store = JournalStore(self.filename)
+        errors = store.mutate_many('drop_player', [(4,), (3,), (5,)])
+        self.assertEqual([type(e) for e in errors], [type(None), KeyError, type(None)])
+        self.assertEqual(store.pending, 17)
+        self.tournament.drop_player(4)
+        self.tournament.drop_player(5)
+        self.assertEqual(JournalStore(self.filename).load(), self.tournament)
+
+
+def _enter_results(filename, results):
+    # one score-entry terminal, see LockTestCase
+    store = open_store(filename)
+    for args in results:
+        store.mutate('add_result', *args)
+
+
+def _register(filename, names):
+    # one registration desk, see SqliteStoreTestCase
+    store = open_store(filename)
+    for name in names:
+        store.mutate('add_player', mcmahon.Player(name, 1, 0, [0, 0, 0], 0, 1))
+
+
+def _rewrite(filename, times):
+    # a command that loads and saves the whole tournament, like rescore
+    store = open_store(filename)
+    for i in range(times):
+        with store.locked():
+            store.save(store.load())
+
+
+class LockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'tournament.yaml')
+        self.tournament = mcmahon.Tournament.new_tournament(
+            [mcmahon.Player('P{}'.format(i), i, i, [0, 0, 0], 0, 1) for i in range(24)])
+        self.tournament.start_new_round(list(range(24)))
+        self.results = [(0, board, match.white)
+                        for board, match in self.tournament.rounds[0].items()]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_concurrent(self):
+        # four terminals entering results at once, while another rewrites the
+        # whole tournament, lose none of them
+        database = os.path.join(self.directory, 'tournament.db')
+        for storage, filename in [('yaml', self.filename), ('journal', self.filename),
+                                  ('sqlite', database)]:
+            open_store(filename, storage).save(self.tournament)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=5) as pool:
+                rewrites = pool.submit(_rewrite, filename, 20)
+                list(pool.map(_enter_results, [filename] * 4,
+                              [self.results[i::4] for i in range(4)]))
+                rewrites.result()
+            round_ = open_store(filename).load().rounds[0]
+            self.assertEqual(round_.pending(), 0)
+
+    def test_coalesce(self):
+        # a change queued by another process is saved with this one
+        store = YamlStore(self.filename)
+        store.save(self.tournament)
+        with open(self.filename + '.queue', 'a') as h:
+            h.write(json.dumps({'ticket': 'other', 'op': 'add_result',
+                                'args': list(self.results[0])}) + '\n')
+        with self.assertRaises(KeyError):
+            store.mutate('add_result', 0, 99, None)
+        store.mutate('add_result', *self.results[1])
+        self.assertEqual(os.path.getsize(self.filename + '.queue'), 0)
+        self.assertEqual(store._outcomes('other'), [(None, None)])
+        self.assertEqual(YamlStore(self.filename).load().rounds[0].pending(),
+                         len(self.results) - 2)
+
+    def test_torn_queue(self):
+        # a line torn by a crashed process is set aside, later changes apply
+        store = YamlStore(self.filename)
+        store.save(self.tournament)
+        with open(self.filename + '.queue', 'a') as h:
+            h.write('{"ticket": "crashed", "op": "add_res')
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            store.mutate('add_result', *self.results[0])
+            store.mutate('add_result', *self.results[1])
+        finally:
+            sys.stderr = stderr
+        with open(self.filename + '.rejected') as h:
+            self.assertEqual(h.read(), '{"ticket": "crashed", "op": "add_res\n')
+        self.assertEqual(YamlStore(self.filename).load().rounds[0].pending(),
+                         len(self.results) - 2)
+
+
+    def test_crash_after_save(self):
+        # a drain that crashed after its save is not applied again; one that
+        # crashed before it is
+        store = YamlStore(self.filename)
+        store.save(self.tournament)
+        for saved in (True, False):
+            ticket = 'crashed-{}'.format(saved)
+            with open(self.filename + '.queue', 'a') as h:
+                h.write(json.dumps({'ticket': ticket, 'op': 'add_player', 'args': [_encode_arg(
+                    mcmahon.Player(ticket, 1, 0, [0, 0, 0], 0, 1))]}) + '\n')
+            _write_atomic(self.filename + '.applying', json.dumps({
+                'stamp': show_cache_stamp(self.filename),
+                'done': [json.dumps({'ticket': ticket, 'result': None, 'error': None}) + '\n']}))
+            if saved:
+                tournament = store.load()
+                tournament.add_player(mcmahon.Player(ticket, 1, 0, [0, 0, 0], 0, 1))
+                store.save(tournament)
+            store.mutate('drop_player', 0 if saved else 1)
+            self.assertEqual(store._outcomes(ticket), [(None, None)])
+            self.assertFalse(os.path.exists(self.filename + '.applying'))
+        names = [player.name for player in YamlStore(self.filename).load().players.values()]
+        self.assertEqual(names[24:], ['crashed-True', 'crashed-False'])
+
+
+class ShowCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'tournament.yaml')
+        self.tournament = mcmahon.Tournament.new_tournament(
+            [mcmahon.Player('P{}'.format(i), i, i, [0, 0, 0], 0, 1) for i in range(6)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_journal(self):
+        store = JournalStore(self.filename)
+        store.show_cache = True
+        store.save(self.tournament)
+        self.assertIsNone(mm_client.read_show_cache(self.filename, 'pairings'))
+        # a change after the stamp was taken leaves the cache stale
+        stamp = show_cache_stamp(self.filename)
+        tournament = store.load()
+        store.mutate('drop_player', 5)
+        write_show_cache(self.filename, tournament, stamp)
+        self.assertIsNone(mm_client.read_show_cache(self.filename, 'standings'))
+        store.mutate('add_player', mcmahon.Player('P5', 5, 5, [0, 0, 0], 0, 1))
+        store.mutate('start_new_round', [0, 1, 2, 3, 4, 6])
+        store.mutate('add_result', 0, 1, store.tournament.rounds[0][1].white)
+        tournament = store.load()
+        self.assertEqual(mm_client.read_show_cache(self.filename, 'standings'),
+                         tournament.wall_list() + '\n')
+        self.assertEqual(mm_client.read_show_cache(self.filename, 'pairings'),
+                         tournament.pairings_list() + '\n')
+        # a touch keeps the contents, another writer does not
+        os.utime(self.filename, ns=(0, 0))
+        self.assertIsNotNone(mm_client.read_show_cache(self.filename, 'standings', 'csv'))
+        store.show_cache = False
+        store.mutate('drop_player', 6)
+        self.assertIsNone(mm_client.read_show_cache(self.filename, 'standings'))
+
+
+class PairingCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = PairingCache.path(os.path.join(self.directory, 'tournament.yaml'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_get(self):
+        cache = PairingCache(self.filename)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', [0, 1, 2, 3], 5, samples=100)
+        cache.put('a', [0, 2, 1, 3], 7, samples=1000)
+        self.assertEqual(cache.get('a'), {'key': 'a', 'pairing': [0, 1, 2, 3], 'score': 5,
+                                          'samples': 1000})
+        cache.put('a', [0, 3, 1, 2], 4)
+        cache.save()
+        self.assertEqual(PairingCache(self.filename).get('a')['pairing'], [0, 3, 1, 2])
+
+    def test_eviction(self):
+        cache = PairingCache(self.filename, capacity=2)
+        cache.put('a', [0, 1], 0)
+        cache.put('b', [0, 1], 0)
+        cache.get('a')
+        cache.put('c', [0, 1], 0)
+        cache.save()
+        self.assertEqual(list(PairingCache(self.filename).entries), ['a', 'c'])
+
+    def test_damaged(self):
+        with open(self.filename, 'w') as h:
+            h.write('[{"key": ')
+        self.assertIsNone(PairingCache(self.filename).get('a'))
+
+
+class SqliteStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'tournament.db')
+        self.store = open_store(self.filename)
+        self.tournament = mcmahon.HandiTournament.new_tournament()
+        self.store.save(self.tournament)
+        for i in range(8):
+            self.store.apply(self.tournament, 'add_player',
+                             mcmahon.Player('P{}'.format(i), 5 - i, 100 + i, [0, 0, 0], 0, 1))
+        self.store.apply(self.tournament, 'start_new_round', [0, 1, 2, 3, 4, 5, 6, 7])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        for board, match in self.tournament.rounds[0].items():
+            self.store.apply(self.tournament, 'add_result', 0, board, match.black)
+        self.store.apply(self.tournament, 'start_new_round', [0, 2, 1, 3, 4, 6, 5, 7])
+        self.store.apply(self.tournament, 'drop_player', 3)
+        self.store.apply(self.tournament, 'forbid_pair', 6, 1)
+        self.store.apply(self.tournament, 'forbid_pair', 2, 5)
+        self.store.apply(self.tournament, 'allow_pair', 1, 6)
+        self.store.apply(self.tournament, 'add_player',
+                         mcmahon.Player('Late', 1, 200, [0, 0, 0], 0, 1))
+        self.store.apply(self.tournament, 'repair_round')
+        loaded = SqliteStore(self.filename).load()
+        self.assertIs(type(loaded), mcmahon.HandiTournament)
+        self.assertEqual(loaded, self.tournament)
+        self.assertEqual([player.mm_score for player in loaded.players.values()],
+                         [player.mm_score for player in self.tournament.players.values()])
+
+    def test_mutate(self):
+        match = self.tournament.rounds[0][2]
+        store = SqliteStore(self.filename)
+        store.mutate('add_result', 0, 2, match.white)
+        with self.assertRaises(ValueError):
+            store.mutate('add_result', 0, 1, match.white)
+        with self.assertRaises(KeyError):
+            store.mutate('add_result', 0, 9, match.white)
+        store.mutate('add_player', mcmahon.Player('Late', 1, 200, [0, 0, 0], 0, 1))
+        store.mutate('drop_player', 5)
+        self.assertEqual(store.player(8).name, 'Late')
+
+        self.tournament.add_result(0, 2, match.white)
+        self.tournament.add_player(mcmahon.Player('Late', 1, 200, [0, 0, 0], 0, 1))
+        self.tournament.drop_player(5)
+        self.assertEqual(store.load(), self.tournament)
+
+    def test_concurrent_registration(self):
+        names = ['R{}'.format(i) for i in range(20)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as pool:
+            list(pool.map(_register, [self.filename] * 4, [names[i::4] for i in range(4)]))
+        tournament = SqliteStore(self.filename).load()
+        self.assertEqual(tournament.id_ctr, 28)
+        self.assertEqual(sorted(tournament.players[i].name for i in range(8, 28)), sorted(names))
+
+    def test_mutate_many(self):
+        results = [(0, 1, self.tournament.rounds[0][1].black),
+                   (0, 2, self.tournament.rounds[0][1].black),
+                   (0, 9, 0),
+                   (0, 3, self.tournament.rounds[0][3].white)]
+        errors = SqliteStore(self.filename).mutate_many('add_result', results)
+        self.assertEqual([type(e) for e in errors],
+                         [type(None), ValueError, KeyError, type(None)])
+        for i in (0, 3):
+            self.tournament.add_result(*results[i])
+        self.assertEqual(SqliteStore(self.filename).load(), self.tournament)
+        yaml_store = YamlStore(os.path.join(self.directory, 'tournament.yaml'))
+        yaml_store.save(SqliteStore(self.filename).load())
+        self.assertEqual([type(e) for e in yaml_store.mutate_many('add_result', results)],
+                         [type(None), ValueError, KeyError, type(None)])
+
+    def test_render(self):
+        store = SqliteStore(self.filename)
+        self.assertEqual(store.render('pairings'), self.tournament.pairings_list())
+        self.assertEqual(store.render('standings'), self.tournament.wall_list())
+
+    def test_missing(self):
+        missing = os.path.join(self.directory, 'missing.db')
+        with self.assertRaises(FileNotFoundError):
+            SqliteStore(missing).render('pairings')
+        self.assertFalse(os.path.exists(missing))
+        sqlite3.connect(missing).close()
+        with self.assertRaises(ValueError):
+            SqliteStore(missing).load()
+
+    def test_convert(self):
+        yaml_store = YamlStore(os.path.join(self.directory, 'tournament.yaml'))
+        yaml_store.save(SqliteStore(self.filename).load())
+        copy = SqliteStore(os.path.join(self.directory, 'copy.db'))
+        copy.save(yaml_store.load())
+        self.assertEqual(copy.load(), self.tournament)
+
+
+if __name__ == '__main__':
+    unittest.main()